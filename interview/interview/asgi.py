@@ -9,8 +9,21 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'interview.settings')
+# serve the users flow with its async views
+os.environ.setdefault('USERS_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
+
+if settings.USERS_WARM_UP:
+    from users.startup import warm_up
+
+    warm_up()
+
+if settings.USERS_SWEEPER["THREAD"]:
+    from users.sweeper import start_sweeper
+
+    start_sweeper()
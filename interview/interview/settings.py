@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,17 +45,37 @@ PROJECT_APPS = ["users"]
 INSTALLED_APPS = PROJECT_APPS + DJANGO_APPS
 
 MIDDLEWARE = [
+    # opt in, profiles everything below it
+    "users.middleware.ProfilingMiddleware",
+    # times everything below it, per view
+    "users.middleware.MetricsMiddleware",
+    # compresses what everything below it returns, padded against BREACH
+    "django.middleware.gzip.GZipMiddleware",
+    # next, so banned clients are turned away before sessions and auth load
+    "users.middleware.BanCheckMiddleware",
+    # opt in, per view concurrency limits and load shedding, before any work
+    "users.middleware.AdmissionControlMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
+    # the state of the sign up steps, kept out of the session
+    "users.middleware.WizardMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    # opt in, authenticates signed tokens without the session and user queries
+    "users.middleware.TokenAuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "users.middleware.HashingUnavailableMiddleware",
 ]
 
 ROOT_URLCONF = "interview.urls"
 
+# route the users flow to its async views, set by interview/asgi.py
+USERS_ASYNC_VIEWS = os.environ.get("USERS_ASYNC_VIEWS") == "1"
+# warm the workers up before they serve, see users/startup.py
+USERS_WARM_UP = os.environ.get("USERS_WARM_UP") == "1"
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -76,13 +97,101 @@ WSGI_APPLICATION = "interview.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# under asgi every request may run in a thread of its own, a persistent
+# connection would be left open in each of them, so only wsgi keeps them
+CONN_MAX_AGE = 0 if USERS_ASYNC_VIEWS else 600
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
-    }
+        # take the write lock when a transaction starts, so waiting for it
+        # honours busy_timeout instead of failing with "database is locked"
+        "OPTIONS": {"transaction_mode": "IMMEDIATE"},
+        # one connection per worker thread, checked before reuse
+        "CONN_MAX_AGE": CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": True,
+    },
+    # the same file opened read only, a stand-in for a replica: with wal its
+    # readers never wait for the writer
+    "replica": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": f"file:{BASE_DIR / 'db.sqlite3'}?mode=ro",
+        "OPTIONS": {"uri": True},
+        "CONN_MAX_AGE": CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": True,
+        "TEST": {"MIRROR": "default"},
+    },
+}
+
+# see users/database.py, wal and the other sqlite pragmas are set per connection
+DATABASE_ROUTERS = ["users.database.ReplicaRouter"]
+# lookups run in `read_from_replica()` use this alias
+USERS_READ_REPLICA = "replica"
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # otps live apart from everything else, so sign-up churn can't cull other keys
+    "otp": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "otp",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+    # the users the login flow looks up, see users/directory.py
+    "directory": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "directory",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+# see users/otp.py
+USERS_OTP_CACHE = "otp"
+USERS_OTP_TTL = 120
+USERS_OTP_MAX_ATTEMPTS = 3
+
+# see users/directory.py
+# seconds, how long a user changed on another host may be served stale
+USERS_DIRECTORY = {"CACHE": "directory", "TTL": 30}
+
+# the form pages are rendered once per process and the per request values
+# spliced in, see users/rendering.py
+USERS_RENDERING = {"ENABLED": True, "PAGES": 256}
+
+# phonenumbers are accepted for these regions only, see users/validators.py
+USERS_PHONENUMBER_REGIONS = ["IR"]
+
+
+# Password hashing
+# pbkdf2 runs in a process pool, see users/hashing.py
+# the pooled hasher keeps the `pbkdf2_sha256` name, so it replaces the stock one
+
+PASSWORD_HASHERS = [
+    "users.hashing.PooledPBKDF2PasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+    "django.contrib.auth.hashers.ScryptPasswordHasher",
+]
+
+USERS_HASHING = {
+    # defaults to the number of cores
+    "WORKERS": None,
+    # hashes allowed to wait for a worker before new ones are refused
+    "QUEUE": None,
+    # seconds
+    "TIMEOUT": 5.0,
 }
 
+# ModelBackend whose async authentication awaits the pool instead of blocking
+AUTHENTICATION_BACKENDS = ["users.backends.PooledModelBackend"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -125,3 +234,114 @@ STATIC_URL = "static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # SESSION_SAVE_EVERY_REQUEST = True
+
+# Login attempts and bans
+# a shared memory table, so every worker process on the host sees the same bans
+USERS_ATTEMPT_COUNTER = "users.bantable.SharedMemoryAttemptCounter"
+# failures are also counted per subnet and per block of phonenumbers, see
+# users/banindex.py: (prefix length, failures in the ban window that ban it)
+# a banned prefix locks out every legitimate user under it too
+USERS_BAN_PREFIXES = {
+    "IPV4": [(24, 30)],
+    "IPV6": [(64, 10), (48, 60)],
+    "PHONE": [(10, 30)],
+}
+
+# Outbound sms, see users/sms.py
+# queued by the views and sent by `manage.py sms_worker`
+USERS_SMS = {
+    "GATEWAY": "users.sms.ConsoleSMSGateway",
+    "BATCH_SIZE": 50,
+    "WORKERS": 4,
+    "MAX_ATTEMPTS": 5,
+    "BACKOFF": 2.0,
+}
+
+# Registered username index, see users/membership.py
+# build it with `manage.py rebuild_username_index`, until then lookups query the db
+USERS_USERNAME_INDEX = {
+    "PATH": None,
+    "CAPACITY": 1_000_000,
+    "ERROR_RATE": 0.01,
+}
+
+# State of the login and sign up steps, see users/wizard.py
+# kept out of the database backed session, which is only written at login
+USERS_WIZARD = {
+    # or "users.wizard.CacheWizardStore", with "CACHE": "<alias>"
+    "BACKEND": "users.wizard.SignedCookieWizardStore",
+    "TTL": 900,
+}
+
+# Metrics of the auth flows at /metrics, see users/metrics.py
+# every process writes its own file in DIR, a private temp directory by default
+USERS_METRICS = {
+    "ENABLED": True,
+    "DIR": None,
+}
+
+# Request profiles, see users/profiling.py and `manage.py profile_report`
+# off unless USERS_PROFILING=1, then 1 in SAMPLE requests and the requests with
+# a token from `profile_report --token` in HEADER are profiled
+USERS_PROFILING = {
+    "ENABLED": os.environ.get("USERS_PROFILING") == "1",
+    "SAMPLE": 1000,
+    "HEADER": "X-Users-Profile",
+    # or "sample", the stack sampled every INTERVAL seconds
+    "MODE": "cprofile",
+    "INTERVAL": 0.001,
+    "DIR": None,
+    "KEEP": 500,
+}
+
+# Signed auth tokens, see users/tokens.py
+# off unless USERS_AUTH_TOKENS=1, then a login also sets a token cookie that
+# authenticates later requests without the session and user queries
+USERS_AUTH_TOKENS = {
+    "ENABLED": os.environ.get("USERS_AUTH_TOKENS") == "1",
+    "TTL": 12 * 3600,
+    "USER_CACHE_SIZE": 1024,
+    "USER_TTL": 60,
+}
+
+# Expired sessions and cache records, see users/sweeper.py
+# swept by `manage.py sweep_sessions`, or by a thread of every worker when
+# USERS_SWEEPER=1, in batches of BATCH_SIZE with PAUSE seconds in between
+USERS_SWEEPER = {
+    "THREAD": os.environ.get("USERS_SWEEPER") == "1",
+    "BATCH_SIZE": 500,
+    "PAUSE": 0.05,
+    "INTERVAL": 600,
+    "PURGE_CACHES": True,
+}
+
+# Admission control, see users/admission.py
+# off unless USERS_ADMISSION=1, then every view of CLASSES runs at most
+# (concurrency, queue) of LIMITS at once, and the classes missing their latency
+# target shed the classes after them first
+USERS_ADMISSION = {
+    "ENABLED": os.environ.get("USERS_ADMISSION") == "1",
+    "CLASSES": {
+        "login": {"VIEWS": ["login_user", "api_login", "logout_user"], "TARGET": 0.5},
+        "check": {"VIEWS": ["check", "api_start"], "TARGET": 0.5},
+        "signup": {
+            "VIEWS": [
+                "register",
+                "register_info",
+                "register_password",
+                "api_verify",
+                "api_register",
+            ],
+            "TARGET": 2.0,
+        },
+    },
+    # fewer slots for the sign up steps that send an otp or hash a new password
+    "LIMITS": {
+        "default": (16, 16),
+        "register": (8, 8),
+        "register_password": (4, 4),
+        "api_register": (4, 4),
+    },
+    "INTERVAL": 1.0,
+    "RETRY_AFTER": 2,
+}
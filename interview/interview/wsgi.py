@@ -9,8 +9,19 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'interview.settings')
 
 application = get_wsgi_application()
+
+if settings.USERS_WARM_UP:
+    from users.startup import warm_up
+
+    warm_up()
+
+if settings.USERS_SWEEPER["THREAD"]:
+    from users.sweeper import start_sweeper
+
+    start_sweeper()
@@ -0,0 +1,290 @@
+"""
+Admission control of the auth flows
+
+every view runs on the same worker threads, so a burst of sign ups, a hash per
+password and an otp per number, takes the threads the logins of the existing
+users need. `AdmissionControlMiddleware` lets a request in only through the
+gate of its view:
+
+    at most `concurrency` requests of the view at once, `queue` more waiting
+    for a turn, first come first served, anything beyond is turned away
+
+with a fast 503 and a `Retry-After`, before the session, the user or anything
+else is loaded. the views are grouped in classes (`CLASSES`), highest priority
+first, each with a latency target: the seconds from arriving at the gate to
+the response, the queueing delay included. a request queued for longer than
+its target missed it anyway and is turned away.
+
+shedding adapts to how the classes are doing, per `INTERVAL`: a class whose
+fastest request of the last interval missed its target has a standing queue.
+until it catches up it stops queueing its own new requests, and every class
+after it sheds all of them at the door, so the sign ups degrade first and the
+logins keep their latency. a class without traffic never holds the others back.
+
+the gates live in memory, per process, and work the same under wsgi threads
+and under asgi. the decisions, the queueing delay and the requests shed per
+view are in `users.metrics`. off unless `USERS_ADMISSION["ENABLED"]`.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.urls import Resolver404, resolve
+
+from .metrics import (ADMISSION_DECISIONS, ADMISSION_RESULTS, ADMISSION_SHED,
+                      count, observe_queue)
+
+DEFAULTS = {
+    "ENABLED": False,
+    # highest priority first, the views of each and its latency target in seconds
+    "CLASSES": {
+        "login": {"VIEWS": ["login_user", "api_login", "logout_user"], "TARGET": 0.5},
+        "check": {"VIEWS": ["check", "api_start"], "TARGET": 0.5},
+        "signup": {
+            "VIEWS": [
+                "register",
+                "register_info",
+                "register_password",
+                "api_verify",
+                "api_register",
+            ],
+            "TARGET": 2.0,
+        },
+    },
+    # (concurrency, queue) per view, "default" for the views not listed
+    "LIMITS": {"default": (16, 16)},
+    # seconds
+    "INTERVAL": 1.0,
+    "RETRY_AFTER": 2,
+}
+
+# the values of `users_admission_decisions_total`
+ADMITTED, QUEUED, FULL, TIMEOUT, SHED = ADMISSION_RESULTS
+
+
+def get_admission_settings():
+    return {**DEFAULTS, **getattr(settings, "USERS_ADMISSION", {})}
+
+
+class Waiter:
+    """
+    A request queued at a gate, woken from the thread leaving the gate
+    """
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else loop.create_future()
+
+    def wake(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.event)
+
+
+def _resolve(future):
+    # gave up waiting in the meantime
+    if not future.done():
+        future.set_result(None)
+
+
+class Gate:
+    """
+    At most `limit` requests at once, and `queue` waiting for their turn
+    """
+
+    def __init__(self, limit, queue):
+        self.limit = limit
+        self.queue = queue
+        self.running = 0
+        self.waiters = deque()
+        self._lock = threading.Lock()
+
+    def enter(self, may_queue=True, loop=None):
+        """
+        True when admitted, a `Waiter` when queued, None when full
+        """
+        with self._lock:
+            if self.running < self.limit and not self.waiters:
+                self.running += 1
+                return True
+            if not may_queue or len(self.waiters) >= self.queue:
+                return None
+            waiter = Waiter(loop)
+            self.waiters.append(waiter)
+            return waiter
+
+    def wait(self, waiter, timeout):
+        """
+        Whether the turn came within `timeout` seconds
+        """
+        waiter.event.wait(timeout)
+        return self._settle(waiter)
+
+    async def await_turn(self, waiter, timeout):
+        try:
+            await asyncio.wait_for(waiter.event, timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # the client went away while queued
+            if self._settle(waiter):
+                self.leave()
+            raise
+        return self._settle(waiter)
+
+    def _settle(self, waiter):
+        with self._lock:
+            if not waiter.granted:
+                self.waiters.remove(waiter)
+            return waiter.granted
+
+    def leave(self):
+        with self._lock:
+            if self.waiters:
+                # the slot goes to the longest waiting as is
+                self.waiters.popleft().wake()
+            else:
+                self.running -= 1
+
+
+class ServiceClass:
+    """
+    The latency of a class of views against its target, per interval
+    """
+
+    def __init__(self, name, target, interval):
+        self.name = name
+        self.target = target
+        self.interval = interval
+        self.window_end = 0
+        self.window_min = None
+        self.late = False
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now >= self.window_end:
+                # the interval that just ended decides for the next one
+                fastest = self.window_min
+                self.late = fastest is not None and fastest > self.target
+                self.window_min = None
+                self.window_end = now + self.interval
+            if self.window_min is None or seconds < self.window_min:
+                self.window_min = seconds
+
+    def missing_target(self, now=None):
+        """
+        Whether the class has a standing queue, only as long as it has traffic
+        """
+        now = time.monotonic() if now is None else now
+        return self.late and now < self.window_end
+
+
+class AdmissionController:
+    """
+    The gates of the views and the classes they belong to
+    """
+
+    def __init__(self, options):
+        self.retry_after = options["RETRY_AFTER"]
+        self.classes = []
+        self.priority = {}
+        for name, service in options["CLASSES"].items():
+            for view in service["VIEWS"]:
+                self.priority[view] = len(self.classes)
+            self.classes.append(
+                ServiceClass(name, service["TARGET"], options["INTERVAL"])
+            )
+        limits = {**DEFAULTS["LIMITS"], **options["LIMITS"]}
+        self.gates = {
+            view: Gate(*limits.get(view, limits["default"])) for view in self.priority
+        }
+
+    def view(self, request):
+        """
+        The gated view `request` is for, None if it isn't gated
+        """
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+        if match.url_name not in self.priority:
+            return None
+        # so a shed request is still reported under its view
+        request.resolver_match = match
+        return match.url_name
+
+    def enter(self, view, now, loop=None):
+        """
+        `(decision, waiter)` for a new request of `view`
+        """
+        priority = self.priority[view]
+        if any(service.missing_target(now) for service in self.classes[:priority]):
+            return SHED, None
+        late = self.classes[priority].missing_target(now)
+        turn = self.gates[view].enter(may_queue=not late, loop=loop)
+        if turn is True:
+            return ADMITTED, None
+        if turn is None:
+            return (SHED if late else FULL), None
+        return QUEUED, turn
+
+    def admit(self, view):
+        """
+        The time the request arrived if it may run, after its turn in the
+        queue, None if it is turned away
+        """
+        arrived = time.monotonic()
+        decision, waiter = self.enter(view, arrived)
+        if waiter is not None:
+            admitted = self.gates[view].wait(waiter, self.timeout(view))
+            decision = ADMITTED if admitted else TIMEOUT
+        return self.record(view, decision, arrived, waiter is not None)
+
+    async def aadmit(self, view):
+        arrived = time.monotonic()
+        decision, waiter = self.enter(view, arrived, asyncio.get_running_loop())
+        if waiter is not None:
+            admitted = await self.gates[view].await_turn(waiter, self.timeout(view))
+            decision = ADMITTED if admitted else TIMEOUT
+        return self.record(view, decision, arrived, waiter is not None)
+
+    def timeout(self, view):
+        return self.classes[self.priority[view]].target
+
+    @staticmethod
+    def record(view, decision, arrived, queued):
+        if queued:
+            count(ADMISSION_DECISIONS, QUEUED)
+        count(ADMISSION_DECISIONS, decision)
+        if decision != ADMITTED:
+            count(ADMISSION_SHED, view)
+            return None
+        observe_queue(view, time.monotonic() - arrived)
+        return arrived
+
+    def leave(self, view, arrived):
+        self.gates[view].leave()
+        self.classes[self.priority[view]].observe(time.monotonic() - arrived)
+
+
+_controller = None
+
+
+def get_admission_controller():
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController(get_admission_settings())
+    return _controller
+
+
+def reset_admission_controller(**kwargs):
+    global _controller
+    _controller = None
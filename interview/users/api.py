@@ -0,0 +1,253 @@
+"""
+JSON api of the login and sign up flow, for the mobile apps
+
+the same forms, ban logic and otp store as the html views, without templates,
+csrf tokens or redirects, and without the wizard state: the phonenumber
+verified by the otp travels in a signed, expiring registration ticket instead.
+
+    POST /api/start/      phonenumber
+        {"next": "login"} for a registered phonenumber, otherwise the otp is
+        texted right away, saving the round trip of a separate call:
+        {"next": "verify", "token": ..., "ttl": ...}
+        at most `START_LIMIT` calls per client ip in a ban period, so the
+        registered phonenumbers can't be enumerated, and the otps texted are
+        throttled per phonenumber and per ip as in the html flow
+    POST /api/verify/     phonenumber, token, otp
+        {"next": "register", "ticket": ...}
+    POST /api/register/   ticket, first_name, last_name, email, password1
+        201 {"ok": true}, logged in
+    POST /api/login/      username, password
+        {"ok": true}, logged in
+
+the body is json, anything else gets a 415: a form can be posted cross-site
+without a csrf token. failures are
+`{"error": <code>, "fields": {<field>: [<message>, ...]}}` with a 4xx status.
+every response tells the limit of failed attempts in `X-RateLimit-Limit`,
+responses to a failure the ones left in `X-RateLimit-Remaining`, and banned
+clients get a 429 with `Retry-After`.
+
+`users.async_api` has the async versions, routed instead when
+`USERS_ASYNC_VIEWS` is on.
+"""
+
+import json
+
+from django.contrib.auth import get_user_model, login
+from django.core import signing
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .attempts import get_attempt_counter
+from .forms import (LoginForm, OTPForm, PhonenumberForm, RegisterInfoForm,
+                    RegisterPasswordForm)
+from .membership import username_exists
+from .otp import OTPResult, get_otp_store, otp_message, send_sms
+from .provisioning import UsernameTaken, provision_user
+from .utils import (get_ban_remaining_seconds, record_failed_attempt,
+                    reset_user_attempts, throttle, throttle_otp)
+from .validators import canonical_phonenumber, normalize_phonenumber
+from .wizard import get_wizard_settings
+
+TICKET_SALT = "users.api.ticket"
+# `start` calls per client ip in a ban period
+START_LIMIT = 30
+# compact json
+SEPARATORS = (",", ":")
+
+auth_user = get_user_model()
+
+
+class BadPayload(Exception):
+    def __init__(self, code="bad_payload", status=400):
+        super().__init__(code)
+        self.code = code
+        self.status = status
+
+
+def api_response(data, status=200, remaining=None, retry_after=None):
+    response = JsonResponse(
+        data, status=status, json_dumps_params={"separators": SEPARATORS}
+    )
+    response["X-RateLimit-Limit"] = str(get_attempt_counter().max_attempts)
+    if remaining is not None:
+        response["X-RateLimit-Remaining"] = str(remaining)
+    if retry_after:
+        response["Retry-After"] = str(retry_after)
+    return response
+
+
+def error_response(code, status=400, form=None, **kwargs):
+    data = {"error": code}
+    if form is not None:
+        data["fields"] = {
+            field: [str(message) for message in messages]
+            for field, messages in form.errors.items()
+        }
+    return api_response(data, status=status, **kwargs)
+
+
+def banned_response(remaining):
+    return error_response("banned", status=429, remaining=0, retry_after=remaining)
+
+
+def failure_response(code, states, form=None):
+    """
+    The response to a failed attempt recorded with `states`, a 429 once banned
+    """
+    counter = get_attempt_counter()
+    banned = max((state.ban_remaining for state in states), default=0)
+    if banned:
+        return banned_response(banned)
+    attempts = max((state.attempts for state in states), default=0)
+    return error_response(
+        code, form=form, remaining=max(counter.max_attempts - attempts, 0)
+    )
+
+
+def payload(request):
+    """
+    The json body of the request, a form could be posted cross-site
+    """
+    if request.content_type != "application/json":
+        raise BadPayload("unsupported_media_type", status=415)
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        raise BadPayload
+    if not isinstance(data, dict):
+        raise BadPayload
+    return {key: "" if value is None else str(value) for key, value in data.items()}
+
+
+def api_view(view):
+    """
+    POST only, json body, no csrf token since a json body can't be sent
+    cross-site
+    """
+
+    def wrapper(request, *args, **kwargs):
+        try:
+            data = payload(request)
+        except BadPayload as error:
+            return error_response(error.code, status=error.status)
+        return view(request, data, *args, **kwargs)
+
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return csrf_exempt(require_POST(wrapper))
+
+
+def issue_ticket(phonenumber):
+    return signing.dumps(phonenumber, salt=TICKET_SALT, compress=True)
+
+
+def read_ticket(ticket):
+    """
+    The phonenumber of a registration ticket, None if forged or expired
+    """
+    try:
+        return signing.loads(
+            ticket or "", salt=TICKET_SALT, max_age=get_wizard_settings()["TTL"]
+        )
+    except signing.BadSignature:
+        return None
+
+
+@api_view
+def start(request, data):
+    """
+    Check the phonenumber, and text an otp to a new one
+    """
+    form = PhonenumberForm(data)
+    if not form.is_valid():
+        return error_response("invalid", form=form)
+    phonenumber = form.cleaned_data["phonenumber"]
+    ip_address = request.META.get("REMOTE_ADDR")
+    # before anything about the phonenumber is told
+    banned = get_ban_remaining_seconds(phonenumber, ip_address)
+    banned = banned or throttle("start", ip_address, START_LIMIT)
+    if banned:
+        return banned_response(banned)
+    # confirmed, no otp for a registered phonenumber the index missed
+    if username_exists(phonenumber, confirm_miss=True):
+        return api_response({"next": "login"})
+    # a text costs, at most a few per phonenumber and per ip
+    banned = throttle_otp(phonenumber, ip_address)
+    if banned:
+        return banned_response(banned)
+    store = get_otp_store()
+    token, otp = store.issue(phonenumber)
+    send_sms(phonenumber, otp_message(otp))
+    return api_response({"next": "verify", "token": token, "ttl": store.ttl})
+
+
+@api_view
+def verify(request, data):
+    """
+    Check the otp, returns the ticket to register with
+    """
+    phonenumber = normalize_phonenumber(data.get("phonenumber"))
+    ip_address = request.META.get("REMOTE_ADDR")
+    form = OTPForm({"otp": data.get("otp"), "otp_cache_key": data.get("token")})
+    if phonenumber is None or not form.is_valid():
+        return error_response("invalid", form=form)
+    banned = get_ban_remaining_seconds(phonenumber, ip_address)
+    if banned:
+        return banned_response(banned)
+    result = get_otp_store().verify(
+        form.cleaned_data["otp_cache_key"], phonenumber, form.cleaned_data["otp"]
+    )
+    if result is not OTPResult.VERIFIED:
+        return failure_response(
+            result.value, record_failed_attempt(phonenumber, ip_address)
+        )
+    reset_user_attempts(phonenumber)
+    return api_response({"next": "register", "ticket": issue_ticket(phonenumber)})
+
+
+@api_view
+def register(request, data):
+    """
+    Create the user of a registration ticket and log them in
+    """
+    username = read_ticket(data.get("ticket"))
+    if username is None:
+        return error_response("bad_ticket", status=403)
+    info = RegisterInfoForm(data)
+    if not info.is_valid():
+        return error_response("invalid", form=info)
+    # validated against the user's attributes, without any query
+    form = RegisterPasswordForm(
+        data, instance=auth_user(username=username, **info.cleaned_data)
+    )
+    if not form.is_valid():
+        return error_response("invalid", form=form)
+    try:
+        user = provision_user(form.instance, form.cleaned_data["password1"])
+    except UsernameTaken:
+        return error_response("taken", status=409)
+    login(request, user)
+    return api_response({"ok": True}, status=201)
+
+
+@api_view
+def login_user(request, data):
+    """
+    Log in with the phonenumber and password
+    """
+    # the same ban key however the phonenumber was typed
+    username = canonical_phonenumber(data.get("username"))
+    ip_address = request.META.get("REMOTE_ADDR")
+    banned = get_ban_remaining_seconds(username, ip_address)
+    if banned:
+        return banned_response(banned)
+    # credentials checked once, by the form
+    form = LoginForm(request, data=data)
+    if not form.is_valid():
+        return failure_response(
+            "invalid_credentials", record_failed_attempt(username, ip_address), form
+        )
+    login(request, form.get_user())
+    reset_user_attempts(username)
+    return api_response({"ok": True})
@@ -4,3 +4,55 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'users'
+
+    def ready(self):
+        from django.conf import settings
+        from django.contrib.auth.signals import user_logged_in, user_logged_out
+        from django.core.signals import setting_changed
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_delete, post_save
+        from django.utils.autoreload import file_changed
+
+        from .admission import reset_admission_controller
+        from .attempts import reset_attempt_counter
+        from .banindex import reset_prefix_index
+        from .database import configure_sqlite
+        from .directory import reset_user_directory, update_directory
+        from .hashing import reset_hashing_service
+        from .metrics import count_queries, reset_metrics_store
+        from .membership import reset_username_index
+        from .otp import reset_otp_store
+        from .rendering import reset_page_cache
+        from .signals import index_username, unindex_username
+        from .tokens import (forget_user, reset_token_authority, token_login,
+                             token_logout)
+        from .wizard import reset_wizard_store
+
+        # these are built from settings, rebuild them when the settings change
+        setting_changed.connect(reset_attempt_counter)
+        setting_changed.connect(reset_prefix_index)
+        setting_changed.connect(reset_otp_store)
+        setting_changed.connect(reset_username_index)
+        setting_changed.connect(reset_wizard_store)
+        setting_changed.connect(reset_metrics_store)
+        setting_changed.connect(reset_token_authority)
+        setting_changed.connect(reset_user_directory)
+        setting_changed.connect(reset_page_cache)
+        setting_changed.connect(reset_admission_controller)
+        setting_changed.connect(reset_hashing_service)
+        # a template edited under runserver, which reloads it without a restart
+        file_changed.connect(reset_page_cache)
+        # keep the username index in sync with the user table
+        post_save.connect(index_username, sender=settings.AUTH_USER_MODEL)
+        post_delete.connect(unindex_username, sender=settings.AUTH_USER_MODEL)
+        # auth tokens are issued and revoked with the session, see users/tokens.py
+        user_logged_in.connect(token_login)
+        user_logged_out.connect(token_logout)
+        post_save.connect(forget_user, sender=settings.AUTH_USER_MODEL)
+        post_save.connect(update_directory, sender=settings.AUTH_USER_MODEL)
+        post_delete.connect(update_directory, sender=settings.AUTH_USER_MODEL)
+        post_delete.connect(forget_user, sender=settings.AUTH_USER_MODEL)
+        # wal, busy timeout and the other pragmas on every sqlite connection
+        connection_created.connect(configure_sqlite)
+        # the queries for /metrics
+        connection_created.connect(count_queries)
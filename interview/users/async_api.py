@@ -0,0 +1,144 @@
+"""
+Async versions of the calls in `users.api`, routed instead of them when
+`USERS_ASYNC_VIEWS` is on
+"""
+
+from django.contrib.auth import aauthenticate, alogin
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .api import (START_LIMIT, BadPayload, api_response, auth_user,
+                  banned_response, error_response, failure_response,
+                  issue_ticket, payload, read_ticket)
+from .forms import (LoginForm, OTPForm, PhonenumberForm, RegisterInfoForm,
+                    RegisterPasswordForm)
+from .membership import ausername_exists
+from .otp import OTPResult, asend_sms, get_otp_store, otp_message
+from .provisioning import UsernameTaken, aprovision_user
+from .utils import (aget_ban_remaining_seconds, arecord_failed_attempt,
+                    areset_user_attempts, athrottle, athrottle_otp)
+from .validators import canonical_phonenumber, normalize_phonenumber
+
+
+def api_view(view):
+    """
+    `users.api.api_view` for coroutines
+    """
+
+    async def wrapper(request, *args, **kwargs):
+        try:
+            data = payload(request)
+        except BadPayload as error:
+            return error_response(error.code, status=error.status)
+        return await view(request, data, *args, **kwargs)
+
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return csrf_exempt(require_POST(wrapper))
+
+
+@api_view
+async def start(request, data):
+    """
+    Check the phonenumber, and text an otp to a new one
+    """
+    form = PhonenumberForm(data)
+    if not form.is_valid():
+        return error_response("invalid", form=form)
+    phonenumber = form.cleaned_data["phonenumber"]
+    ip_address = request.META.get("REMOTE_ADDR")
+    banned = await aget_ban_remaining_seconds(phonenumber, ip_address)
+    banned = banned or await athrottle("start", ip_address, START_LIMIT)
+    if banned:
+        return banned_response(banned)
+    if await ausername_exists(phonenumber, confirm_miss=True):
+        return api_response({"next": "login"})
+    # a text costs, at most a few per phonenumber and per ip
+    banned = await athrottle_otp(phonenumber, ip_address)
+    if banned:
+        return banned_response(banned)
+    store = get_otp_store()
+    token, otp = await store.aissue(phonenumber)
+    await asend_sms(phonenumber, otp_message(otp))
+    return api_response({"next": "verify", "token": token, "ttl": store.ttl})
+
+
+@api_view
+async def verify(request, data):
+    """
+    Check the otp, returns the ticket to register with
+    """
+    phonenumber = normalize_phonenumber(data.get("phonenumber"))
+    ip_address = request.META.get("REMOTE_ADDR")
+    form = OTPForm({"otp": data.get("otp"), "otp_cache_key": data.get("token")})
+    if phonenumber is None or not form.is_valid():
+        return error_response("invalid", form=form)
+    banned = await aget_ban_remaining_seconds(phonenumber, ip_address)
+    if banned:
+        return banned_response(banned)
+    result = await get_otp_store().averify(
+        form.cleaned_data["otp_cache_key"], phonenumber, form.cleaned_data["otp"]
+    )
+    if result is not OTPResult.VERIFIED:
+        return failure_response(
+            result.value, await arecord_failed_attempt(phonenumber, ip_address)
+        )
+    await areset_user_attempts(phonenumber)
+    return api_response({"next": "register", "ticket": issue_ticket(phonenumber)})
+
+
+@api_view
+async def register(request, data):
+    """
+    Create the user of a registration ticket and log them in
+    """
+    username = read_ticket(data.get("ticket"))
+    if username is None:
+        return error_response("bad_ticket", status=403)
+    info = RegisterInfoForm(data)
+    if not info.is_valid():
+        return error_response("invalid", form=info)
+    form = RegisterPasswordForm(
+        data, instance=auth_user(username=username, **info.cleaned_data)
+    )
+    if not form.is_valid():
+        return error_response("invalid", form=form)
+    try:
+        user = await aprovision_user(form.instance, form.cleaned_data["password1"])
+    except UsernameTaken:
+        return error_response("taken", status=409)
+    await alogin(request, user)
+    return api_response({"ok": True}, status=201)
+
+
+@api_view
+async def login_user(request, data):
+    """
+    Log in with the phonenumber and password
+    """
+    username = canonical_phonenumber(data.get("username"))
+    ip_address = request.META.get("REMOTE_ADDR")
+    banned = await aget_ban_remaining_seconds(username, ip_address)
+    if banned:
+        return banned_response(banned)
+    form = LoginForm(data=data)
+    form.check_credentials = False
+    user = None
+    if form.is_valid():
+        # hashed in the pool, not by the form
+        user = await aauthenticate(
+            request,
+            username=form.cleaned_data["username"],
+            password=form.cleaned_data["password"],
+        )
+        if user is None:
+            form.add_error(None, form.get_invalid_login_error())
+    if user is None:
+        return failure_response(
+            "invalid_credentials",
+            await arecord_failed_attempt(username, ip_address),
+            form,
+        )
+    await alogin(request, user)
+    await areset_user_attempts(username)
+    return api_response({"ok": True})
@@ -0,0 +1,252 @@
+"""
+Async versions of the views in `users.views`, routed instead of them when
+`USERS_ASYNC_VIEWS` is on (the default under interview/asgi.py)
+
+orm, cache, session, wizard state and ban lookups are awaited on the event
+loop and password hashing awaits the hashing pool, so a request only hops to a
+thread to insert a new user
+"""
+
+from django.contrib.auth import aauthenticate, alogin, alogout, get_user_model
+from django.http import HttpResponseRedirect
+from django.shortcuts import reverse
+
+from .forms import (LoginForm, OTPForm, PhonenumberForm, RegisterInfoForm,
+                    RegisterPasswordForm)
+from .membership import ausername_exists
+from .otp import (OTP_ERRORS, OTPResult, asend_sms, get_otp_store,
+                  otp_message, otp_throttled_error)
+from .provisioning import UsernameTaken, aprovision_user
+from .rendering import render_page
+from .utils import (aban_user_if_necessary, aget_ban_remaining_time,
+                    aget_ban_remaining_times, areset_user_attempts,
+                    athrottle_otp)
+from .validators import canonical_phonenumber, normalize_phonenumber
+
+auth_user = get_user_model()
+
+
+async def arender(request, template_name, context=None):
+    """
+    `render_page` for async views, templates read `request.user`, which must be
+    loaded before rendering since lazy loading it would hit the orm synchronously
+    """
+    request.user = await request.auser()
+    return render_page(request, template_name, context)
+
+
+async def login_page(request, phonenumber):
+    """
+    `users.views.login_page` for async views
+    """
+    await request.wizard.aset("username", phonenumber)
+    return await arender(
+        request,
+        "users/login.html",
+        {"form": LoginForm(initial={"username": phonenumber})},
+    )
+
+
+async def otp_throttled_page(request, remaining):
+    return await arender(
+        request,
+        "users/phonenumber.html",
+        {"form": PhonenumberForm, "ban_error": [otp_throttled_error(remaining)]},
+    )
+
+
+async def check_phonenumber(request):
+    """
+    Handle logging in with phonenumber
+    """
+    if request.method == "POST":
+        form = PhonenumberForm(request.POST)
+        if form.is_valid():
+            phonenumber = form.cleaned_data.get("phonenumber")
+            # check if the user exists
+            if await ausername_exists(phonenumber):
+                return await login_page(request, phonenumber)
+            # redirect to a register view with the phonenumber
+            return HttpResponseRedirect(
+                reverse("users:register", args=[phonenumber])
+            )
+        # if phonenumber is not valid
+        return await arender(request, "users/phonenumber.html", {"form": form})
+    # show the phonenumber form, with feedback if the user is banned
+    ctx = {"form": PhonenumberForm, "ban_error": []}
+    username_ban, ip_ban = await aget_ban_remaining_times(
+        await request.wizard.aget("username"), request.META.get("REMOTE_ADDR")
+    )
+    if username_ban:
+        ctx["ban_error"].append("user (phonenumber) already banned")
+    if ip_ban:
+        ctx["ban_error"].append("ip already banned")
+    return await arender(request, "users/phonenumber.html", ctx)
+
+
+async def logout_user(request):
+    """
+    Logout user
+    """
+    if request.method == "POST":
+        await alogout(request)
+    return HttpResponseRedirect(reverse("users:check"))
+
+
+async def login_user(request):
+    """
+    Handle login
+    """
+    username = await request.wizard.aget("username")
+    user_ip_address = request.META["REMOTE_ADDR"]
+    ban_remaining_time = await aget_ban_remaining_time(username, user_ip_address)
+    is_user_banned = bool(ban_remaining_time)
+    if request.method == "POST":
+        username = canonical_phonenumber(request.POST.get("username"))
+        if is_user_banned:
+            return await arender(
+                request,
+                "users/login.html",
+                {
+                    "form": LoginForm,
+                    "ban_error": f"user is banned for {ban_remaining_time} minutes",
+                },
+            )
+        form = LoginForm(data=request.POST)
+        form.check_credentials = False
+        user = None
+        if form.is_valid():
+            # credentials are checked here instead of in the form, hashing in the pool
+            user = await aauthenticate(
+                request,
+                username=form.cleaned_data.get("username"),
+                password=form.cleaned_data.get("password"),
+            )
+            if user is None:
+                form.add_error(None, form.get_invalid_login_error())
+        if user is not None:
+            await alogin(request, user)
+            # clear the cache used in login attempts
+            await areset_user_attempts(username)
+            await request.wizard.aclear()
+            return await arender(request, "users/success.html")
+        # record the failure for username and ip together
+        if await aban_user_if_necessary(username, user_ip_address):
+            return HttpResponseRedirect(reverse("users:check"))
+        return await arender(request, "users/login.html", {"form": form})
+    if is_user_banned:
+        return HttpResponseRedirect(reverse("users:check"))
+    return await arender(request, "users/login.html", {"form": LoginForm})
+
+
+async def register_otp(request, phonenumber):
+    """
+    Handle registration
+    """
+    phonenumber = normalize_phonenumber(phonenumber)
+    if phonenumber is None:
+        return HttpResponseRedirect(reverse("users:check"))
+    user_ip_address = request.META["REMOTE_ADDR"]
+    ban_remaining_time = await aget_ban_remaining_time(phonenumber, user_ip_address)
+    if ban_remaining_time:
+        return HttpResponseRedirect(reverse("users:check"))
+    if request.method == "GET":
+        # no otp for a registered phonenumber the username index missed
+        if await ausername_exists(phonenumber, confirm_miss=True):
+            return await login_page(request, phonenumber)
+        store = get_otp_store()
+        # a reload shows the otp already texted, while it can still be typed in
+        otp_cache_key = await request.wizard.aget("otp_token")
+        if not await store.apending(otp_cache_key, phonenumber):
+            throttled = await athrottle_otp(phonenumber, user_ip_address)
+            if throttled:
+                return await otp_throttled_page(request, throttled)
+            # initiate an otp process, bound to the phonenumber
+            otp_cache_key, random_otp = await store.aissue(phonenumber)
+            # queued for the sms workers, the request doesn't wait for the gateway
+            await asend_sms(phonenumber, otp_message(random_otp))
+            await request.wizard.aset("otp_token", otp_cache_key)
+        return await arender(
+            request,
+            "users/register.html",
+            {"form": OTPForm(initial={"otp_cache_key": otp_cache_key})},
+        )
+    if request.method == "POST":
+        form = OTPForm(request.POST)
+        if form.is_valid():
+            otp_result = await get_otp_store().averify(
+                form.cleaned_data.get("otp_cache_key"),
+                phonenumber,
+                form.cleaned_data.get("otp"),
+            )
+            if otp_result is OTPResult.VERIFIED:
+                # clear the cache used in otp attempts
+                await areset_user_attempts(phonenumber)
+                await request.wizard.aset("username", phonenumber)
+                return HttpResponseRedirect(reverse("users:register_info"))
+            # record the failure for phonenumber and ip together
+            if await aban_user_if_necessary(phonenumber, user_ip_address):
+                return HttpResponseRedirect(reverse("users:check"))
+            return await arender(
+                request,
+                "users/register.html",
+                {"form": form, "otp_error": OTP_ERRORS[otp_result]},
+            )
+        return await arender(request, "users/register.html", {"form": form})
+
+
+async def register_info(request):
+    """
+    Register user info, first name, last name and email
+    """
+    if request.method == "POST":
+        form = RegisterInfoForm(request.POST)
+        if form.is_valid():
+            await request.wizard.aupdate(
+                {
+                    "first_name": form.cleaned_data.get("first_name"),
+                    "last_name": form.cleaned_data.get("last_name"),
+                    "email": form.cleaned_data.get("email"),
+                }
+            )
+            return HttpResponseRedirect(reverse("users:register_password"))
+    if await request.wizard.aget("username"):
+        return await arender(
+            request, "users/register_info.html", {"form": RegisterInfoForm}
+        )
+    return HttpResponseRedirect(reverse("users:check"))
+
+
+async def register_password(request):
+    """
+    Register user password and finally create a user object
+    """
+    user_data = {
+        "first_name": await request.wizard.aget("first_name"),
+        "last_name": await request.wizard.aget("last_name"),
+        "email": await request.wizard.aget("email"),
+        "username": await request.wizard.aget("username"),
+    }
+    if request.method == "GET":
+        if all(user_data.values()):
+            return await arender(
+                request, "users/register_password.html", {"form": RegisterPasswordForm}
+            )
+        return HttpResponseRedirect(reverse("users:check"))
+    if request.method == "POST":
+        if not all(user_data.values()):
+            return HttpResponseRedirect(reverse("users:check"))
+        form = RegisterPasswordForm(request.POST, instance=auth_user(**user_data))
+        # no query in the validation, so no thread hop for it
+        if form.is_valid():
+            try:
+                user = await aprovision_user(
+                    form.instance, form.cleaned_data["password1"]
+                )
+            except UsernameTaken:
+                await request.wizard.aclear()
+                return await login_page(request, user_data["username"])
+            await alogin(request, user)
+            await request.wizard.aclear()
+            return await arender(request, "users/success.html")
+        return await arender(request, "users/register_password.html", {"form": form})
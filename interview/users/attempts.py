@@ -0,0 +1,289 @@
+"""
+Attempt counter engines used by the ban logic in `users.utils`
+
+every engine keeps two keys per identifier (username or ip):
+    - an attempt counter, created with a ttl of `BAN_PERIOD_MINUTE` on the first
+      failure and bumped with an atomic increment afterwards
+    - a ban marker holding the ban expiry as integer epoch seconds, added once
+      when the counter crosses `MAX_ATTEMPS` so later failures can't move it
+
+the counter window starts before the ban, so it is always gone by the time the
+ban ends and counting starts over.
+
+checking several identifiers is always a single `get_many`, so the read side
+costs one cache round trip no matter how many identifiers are checked.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from typing import NamedTuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import metered_cache
+
+MAX_ATTEMPS = 3
+BAN_PERIOD_MINUTE = 60
+
+ATTEMPTS_KEY_PREFIX = "attempts"
+BAN_KEY_PREFIX = "ban"
+
+
+class AttemptState(NamedTuple):
+    """
+    State of a single identifier after a failed attempt was recorded
+    `ban_remaining` is in seconds, 0 means not banned
+    """
+
+    attempts: int
+    ban_remaining: int
+
+
+class CacheAttemptCounter:
+    """
+    Attempt counter built on top of the django cache api
+    works with any backend whose `incr` is atomic (LocMemCache, memcached),
+    recording a failure costs one `incr` per identifier in the steady state
+    """
+
+    def __init__(
+        self,
+        alias="default",
+        max_attempts=MAX_ATTEMPS,
+        ban_period=BAN_PERIOD_MINUTE * 60,
+    ):
+        self.alias = alias
+        self.max_attempts = max_attempts
+        self.ban_period = ban_period
+
+    @property
+    def cache(self):
+        # cache connections are thread local, look it up on every use
+        return metered_cache(self.alias)
+
+    @staticmethod
+    def attempts_key(identifier):
+        return f"{ATTEMPTS_KEY_PREFIX}:{identifier}"
+
+    @staticmethod
+    def ban_key(identifier):
+        return f"{BAN_KEY_PREFIX}:{identifier}"
+
+    def remaining(self, identifiers):
+        """
+        Returns remaining ban time in seconds for each identifier, in one round trip
+        """
+        keys = [self.ban_key(identifier) for identifier in identifiers]
+        return self._remaining(keys, self.cache.get_many(keys))
+
+    async def aremaining(self, identifiers):
+        keys = [self.ban_key(identifier) for identifier in identifiers]
+        return self._remaining(keys, await self.cache.aget_many(keys))
+
+    def hit(self, identifiers, limits=None):
+        """
+        Record a failed attempt for every identifier and ban the ones that
+        exceeded `max_attempts`, or their own limit in `limits`, returns an
+        `AttemptState` for each identifier
+        """
+        attempts = self._increment([self.attempts_key(i) for i in identifiers])
+        now = int(time.time())
+        exceeded = self._exceeded(identifiers, attempts, limits)
+        bans = self._ban(exceeded, now + self.ban_period) if exceeded else {}
+        return self._states(identifiers, attempts, bans, now)
+
+    async def ahit(self, identifiers, limits=None):
+        attempts = await self._aincrement([self.attempts_key(i) for i in identifiers])
+        now = int(time.time())
+        exceeded = self._exceeded(identifiers, attempts, limits)
+        bans = await self._aban(exceeded, now + self.ban_period) if exceeded else {}
+        return self._states(identifiers, attempts, bans, now)
+
+    def reset(self, identifiers):
+        """
+        Forget the failed attempts of the identifiers, bans are left untouched
+        """
+        self.cache.delete_many([self.attempts_key(i) for i in identifiers])
+
+    async def areset(self, identifiers):
+        await self.cache.adelete_many([self.attempts_key(i) for i in identifiers])
+
+    @staticmethod
+    def _remaining(keys, bans):
+        now = int(time.time())
+        return [max(bans.get(key, 0) - now, 0) for key in keys]
+
+    def _exceeded(self, identifiers, attempts, limits=None):
+        limits = limits or [self.max_attempts] * len(identifiers)
+        return [
+            identifier
+            for identifier, count, limit in zip(identifiers, attempts, limits)
+            if count > limit
+        ]
+
+    @staticmethod
+    def _states(identifiers, attempts, bans, now):
+        return [
+            AttemptState(count, max(bans.get(identifier, now) - now, 0))
+            for identifier, count in zip(identifiers, attempts)
+        ]
+
+    def _increment(self, keys):
+        return [self._incr(key) for key in keys]
+
+    def _incr(self, key):
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # first failure in the window, the counter doesn't exist yet
+            if self.cache.add(key, 1, timeout=self.ban_period):
+                return 1
+            # another request created it in between
+            return self.cache.incr(key)
+
+    async def _aincrement(self, keys):
+        return [await self._aincr(key) for key in keys]
+
+    async def _aincr(self, key):
+        try:
+            return await self.cache.aincr(key)
+        except ValueError:
+            if await self.cache.aadd(key, 1, timeout=self.ban_period):
+                return 1
+            return await self.cache.aincr(key)
+
+    def _ban(self, identifiers, ban_until):
+        """
+        Add the ban markers, an already running ban keeps its original expiry
+        returns the ban expiry of each identifier
+        """
+        bans = {}
+        for identifier in identifiers:
+            key = self.ban_key(identifier)
+            if self.cache.add(key, ban_until, timeout=self.ban_period):
+                bans[identifier] = ban_until
+            else:
+                # already banned, by an earlier or a concurrent request
+                bans[identifier] = self.cache.get(key, ban_until)
+        return bans
+
+    async def _aban(self, identifiers, ban_until):
+        bans = {}
+        for identifier in identifiers:
+            key = self.ban_key(identifier)
+            if await self.cache.aadd(key, ban_until, timeout=self.ban_period):
+                bans[identifier] = ban_until
+            else:
+                bans[identifier] = await self.cache.aget(key, ban_until)
+        return bans
+
+
+class FileCacheAttemptCounter(CacheAttemptCounter):
+    """
+    Attempt counter for `FileBasedCache`, whose `incr` is a plain get and set,
+    increments are serialized across processes with a lock file in the cache directory
+    """
+
+    lock_name = ".attempts.lock"
+
+    @contextmanager
+    def _locked(self):
+        import fcntl
+
+        path = os.path.join(self.cache._dir, self.lock_name)
+        os.makedirs(self.cache._dir, exist_ok=True)
+        with open(path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _increment(self, keys):
+        # one lock for the whole batch
+        with self._locked():
+            return super()._increment(keys)
+
+    async def _aincrement(self, keys):
+        # the lock blocks, take it in a thread
+        return await sync_to_async(self._increment, thread_sensitive=False)(keys)
+
+
+class RedisAttemptCounter(CacheAttemptCounter):
+    """
+    Attempt counter for django's `RedisCache`
+    all the counters of a request are created and incremented in a single
+    MULTI/EXEC pipeline, so recording a failure is one round trip
+    """
+
+    def _client(self):
+        return self.cache._cache.get_client(write=True)
+
+    def _increment(self, keys):
+        pipeline = self._client().pipeline(transaction=True)
+        for key in keys:
+            key = self.cache.make_and_validate_key(key)
+            # create the counter with the window ttl if missing, then bump it
+            pipeline.set(key, 0, ex=self.ban_period, nx=True)
+            pipeline.incr(key)
+        results = pipeline.execute()
+        return [int(count) for count in results[1::2]]
+
+    async def _aincrement(self, keys):
+        return await sync_to_async(self._increment, thread_sensitive=False)(keys)
+
+    def _ban(self, identifiers, ban_until):
+        pipeline = self._client().pipeline(transaction=True)
+        for identifier in identifiers:
+            key = self.cache.make_and_validate_key(self.ban_key(identifier))
+            pipeline.set(key, ban_until, ex=self.ban_period, nx=True)
+            pipeline.get(key)
+        results = pipeline.execute()
+        return {
+            identifier: int(until)
+            for identifier, until in zip(identifiers, results[1::2])
+        }
+
+    async def _aban(self, identifiers, ban_until):
+        return await sync_to_async(self._ban, thread_sensitive=False)(
+            identifiers, ban_until
+        )
+
+
+# counters picked automatically by cache backend when `USERS_ATTEMPT_COUNTER` is not set
+BACKEND_COUNTERS = {
+    "django.core.cache.backends.filebased.FileBasedCache": FileCacheAttemptCounter,
+    "django.core.cache.backends.redis.RedisCache": RedisAttemptCounter,
+}
+
+_counter = None
+
+
+def get_attempt_counter():
+    """
+    Returns the attempt counter configured for this process
+    `USERS_ATTEMPT_COUNTER` may point to a counter class, otherwise one is chosen
+    based on the backend of the `USERS_BAN_CACHE` cache alias
+    """
+    global _counter
+    if _counter is None:
+        alias = getattr(settings, "USERS_BAN_CACHE", "default")
+        counter_class = getattr(settings, "USERS_ATTEMPT_COUNTER", None)
+        if counter_class is None:
+            backend = settings.CACHES[alias]["BACKEND"]
+            counter_class = BACKEND_COUNTERS.get(backend, CacheAttemptCounter)
+        elif isinstance(counter_class, str):
+            counter_class = import_string(counter_class)
+        _counter = counter_class(alias)
+    return _counter
+
+
+def reset_attempt_counter(**kwargs):
+    """
+    Drop the configured counter, so it is rebuilt on the next use
+    """
+    global _counter
+    _counter = None
@@ -0,0 +1,65 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+from .database import read_from_replica
+from .directory import get_user_directory
+from .hashing import acheck_password, amake_password
+
+UserModel = get_user_model()
+
+
+class PooledModelBackend(ModelBackend):
+    """
+    `ModelBackend` whose async authentication awaits the hashing pool,
+    django's own `aauthenticate` verifies the password on the event loop
+    the user comes from the user directory, or is looked up on the read replica
+    when the directory is disabled, a hash upgrade or `login()` writes it back
+    to the primary
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        directory = get_user_directory()
+        if directory is None:
+            with read_from_replica():
+                return super().authenticate(request, username, password, **kwargs)
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return
+        user = directory.user(username)
+        if user is None:
+            # hash once anyway, so a missing user takes as long as a wrong password
+            UserModel().set_password(password)
+            return
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+
+    async def aauthenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return
+        user = await self._aget_user(username)
+        if user is None:
+            # hash once anyway, so a missing user takes as long as a wrong password
+            await amake_password(password)
+            return
+
+        async def setter(raw_password):
+            # upgrade the stored hash, e.g. after the iterations changed
+            user.password = await amake_password(raw_password)
+            await user.asave(update_fields=["password"])
+
+        if await acheck_password(password, user.password, setter):
+            if self.user_can_authenticate(user):
+                return user
+
+    async def _aget_user(self, username):
+        directory = get_user_directory()
+        if directory is not None:
+            return await directory.auser(username)
+        try:
+            with read_from_replica():
+                return await UserModel._default_manager.aget_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            return None
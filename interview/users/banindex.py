@@ -0,0 +1,109 @@
+"""
+Subnet and number range aggregation of the ban identifiers
+
+a botnet rotating through the addresses of an ipv4 /24 or an ipv6 /64, or a
+script going through a block of phonenumbers, never fails `MAX_ATTEMPS` times
+with the same identifier. so a failure is also counted against every configured
+prefix covering the identifier, each with a limit of its own, and a banned
+prefix bans every identifier under it:
+
+    203.0.113.7        203.0.113.7, net:203.0.113.0/24
+    2001:db8::1        2001:db8::1, net:2001:db8::/64, net:2001:db8::/48
+    +989121234567      +989121234567, phone:+989121234
+
+the identifier and its prefixes are the path from a leaf to the root of a prefix
+tree whose nodes are records of the attempt counter (`users.attempts`), keyed
+by the prefix. only the nodes failures went through take memory, a check is one
+batch lookup of the path, so it costs the number of configured prefixes, and a
+prefix ban is a single record however many addresses it covers.
+
+configured with `USERS_BAN_PREFIXES`, a list of `(prefix length, limit)` per
+kind of identifier, the length in bits for addresses and in characters of the
+canonical phonenumber for phonenumbers, the limit in failures within the ban
+window. an empty list turns the aggregation off for that kind.
+
+a prefix ban is a denial of service too: anyone failing `limit` times over a
+block locks every legitimate user of it out, a banned `phone:` prefix keeps
+all 1000 numbers of a 10 character block out of login and registration for the
+ban period. the limits trade that against the attacks they stop, set them well
+above what the real users of a block fail together, or turn a kind off.
+"""
+
+import ipaddress
+import re
+from functools import lru_cache
+
+from django.conf import settings
+
+from .attempts import MAX_ATTEMPS, get_attempt_counter
+
+DEFAULTS = {
+    "IPV4": [(24, 30)],
+    # a /64 is usually a single subscriber, a /48 a single site
+    "IPV6": [(64, 10), (48, 60)],
+    # the last 3 digits, a block of 1000 numbers, all locked out once banned
+    "PHONE": [(10, 30)],
+}
+
+NETWORK_PREFIX = "net"
+PHONE_PREFIX = "phone"
+
+PHONENUMBER_RE = re.compile(r"^\+\d+$")
+
+
+def get_prefix_settings():
+    return {**DEFAULTS, **getattr(settings, "USERS_BAN_PREFIXES", {})}
+
+
+class PrefixIndex:
+    """
+    Maps an identifier to its path in the prefix tree
+    """
+
+    def __init__(self, options, max_attempts=MAX_ATTEMPS):
+        self.max_attempts = max_attempts
+        # the longest prefixes first, closest to the leaf
+        self.levels = {
+            4: sorted(options["IPV4"], reverse=True),
+            6: sorted(options["IPV6"], reverse=True),
+            PHONE_PREFIX: sorted(options["PHONE"], reverse=True),
+        }
+        self.path = lru_cache(maxsize=4096)(self._path)
+
+    def _path(self, identifier):
+        """
+        `(key, limit)` of the identifier and of every prefix covering it
+        """
+        path = [(identifier, self.max_attempts)]
+        if PHONENUMBER_RE.match(identifier):
+            for length, limit in self.levels[PHONE_PREFIX]:
+                if length < len(identifier):
+                    path.append((f"{PHONE_PREFIX}:{identifier[:length]}", limit))
+            return tuple(path)
+        try:
+            address = ipaddress.ip_address(identifier)
+        except ValueError:
+            return tuple(path)
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        for length, limit in self.levels[address.version]:
+            network = ipaddress.ip_network((address, length), strict=False)
+            path.append((f"{NETWORK_PREFIX}:{network}", limit))
+        return tuple(path)
+
+
+_index = None
+
+
+def get_prefix_index():
+    global _index
+    if _index is None:
+        _index = PrefixIndex(
+            get_prefix_settings(), get_attempt_counter().max_attempts
+        )
+    return _index
+
+
+def reset_prefix_index(**kwargs):
+    global _index
+    _index = None
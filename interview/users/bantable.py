@@ -0,0 +1,406 @@
+"""
+Shared memory ban table
+
+a fixed size hash table in a memory mapped file, so the attempts and bans of
+every worker process on the host live in the same place and an attacker can't
+get `MAX_ATTEMPS` tries per worker.
+
+the table is set associative: a key hashes to one bucket of `WAYS` slots and can
+only live there, a full bucket evicts its expired or least recently seen record,
+so memory stays at `slots * RECORD.size` bytes no matter how many keys are seen.
+a running ban is never evicted: a bucket full of them is banned as a whole
+until the last one ends, failing closed. the hash is keyed with a secret
+derived from `SECRET_KEY`, so keys colliding into one bucket, to push a ban
+out of it or to fill it, can't be computed offline.
+
+each slot is a fixed width record:
+    key hash      u64, 0 marks an empty slot
+    attempts      u32
+    window end    u32, epoch seconds the attempt counter resets at
+    ban until     u32, epoch seconds, 0 if never banned
+    last seen     u32, epoch seconds, used for eviction
+
+`deny` and `denied` use the table as a denylist the same way, no entry is
+lost before it expires.
+
+writers take a striped lock (a thread lock plus an fcntl byte range lock, since
+fcntl locks are per process), readers don't lock at all.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+
+from .attempts import BAN_PERIOD_MINUTE, MAX_ATTEMPS, AttemptState
+from .runtime import private_tempdir
+
+MAGIC = b"UBAARBAN"
+VERSION = 2
+HEADER = struct.Struct("<8sII")
+RECORD = struct.Struct("<QIIII")
+WAYS = 8
+STRIPES = 64
+
+DEFAULT_SLOTS = 1 << 16
+
+KEY, ATTEMPTS, WINDOW_END, BAN_UNTIL, LAST_SEEN = range(5)
+# the key hash of the record denying a whole bucket
+FULL_BUCKET = 1
+
+
+def table_secret():
+    return hashlib.blake2b(
+        settings.SECRET_KEY.encode(), digest_size=32, person=b"users.bantable"
+    ).digest()
+
+
+def key_hash(key, secret):
+    """
+    64 bit keyed hash of `key`, never 0 since 0 marks an empty slot, nor
+    `FULL_BUCKET`
+    """
+    digest = hashlib.blake2b(key.encode(), digest_size=8, key=secret).digest()
+    return max(int.from_bytes(digest, "little"), FULL_BUCKET + 1)
+
+
+class SharedBanTable:
+    """
+    Memory mapped attempt and ban table shared by all the processes opening `path`
+    """
+
+    def __init__(self, path, slots=DEFAULT_SLOTS, secret=None):
+        # every process sharing the table must hash with the same secret
+        self.secret = table_secret() if secret is None else secret
+        # round up to whole buckets
+        self.buckets = max(-(-slots // WAYS), 1)
+        self.slots = self.buckets * WAYS
+        self.path = path
+        self.size = HEADER.size + self.slots * RECORD.size
+        self.bucket = struct.Struct("<" + "QIIII" * WAYS)
+        self._pid = None
+        self._open_lock = threading.Lock()
+
+    def _open(self):
+        """
+        Map the file, once per process since a forked worker must not share
+        the parent's thread locks
+        """
+        if self._pid == os.getpid():
+            return
+        with self._open_lock:
+            if self._pid != os.getpid():
+                self._map()
+
+    def _map(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+            buffer = mmap.mmap(fd, self.size)
+            magic, version, slots = HEADER.unpack_from(buffer)
+            if (magic, version, slots) != (MAGIC, VERSION, self.slots):
+                # new or incompatible table, start from scratch
+                buffer[:] = bytes(self.size)
+                HEADER.pack_into(buffer, 0, MAGIC, VERSION, self.slots)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._buffer = buffer
+        self._locks = [threading.Lock() for _ in range(STRIPES)]
+        self._pid = os.getpid()
+
+    def _offset(self, bucket):
+        return HEADER.size + bucket * WAYS * RECORD.size
+
+    def _read_bucket(self, bucket):
+        values = self.bucket.unpack_from(self._buffer, self._offset(bucket))
+        return [values[i : i + 5] for i in range(0, len(values), 5)]
+
+    def _locked(self, bucket):
+        return _StripeLock(self, bucket % STRIPES)
+
+    def _find(self, records, hashed):
+        for way, record in enumerate(records):
+            if record[KEY] == hashed:
+                return way
+        return None
+
+    def _victim(self, records, now):
+        """
+        Slot to reuse for a new key: an empty or expired one, otherwise the
+        least recently seen that isn't banned, None if every one is
+        """
+        way = self._free(records, now)
+        if way is None:
+            unbanned = [way for way in range(WAYS) if records[way][BAN_UNTIL] <= now]
+            if unbanned:
+                way = min(unbanned, key=lambda way: records[way][LAST_SEEN])
+        return way
+
+    def _free(self, records, now):
+        """
+        An empty or expired slot, None if the bucket is full
+        """
+        for way, record in enumerate(records):
+            if not record[KEY] or self._expired(record, now):
+                return way
+        return None
+
+    def _write(self, bucket, way, record):
+        offset = self._offset(bucket) + way * RECORD.size
+        RECORD.pack_into(self._buffer, offset, *record)
+
+    def _until(self, records, hashed):
+        # the ban of the key itself or of its whole bucket
+        return max(
+            (
+                record[BAN_UNTIL]
+                for record in records
+                if record[KEY] in (hashed, FULL_BUCKET)
+            ),
+            default=0,
+        )
+
+    def _ban_bucket(self, bucket, records, until, now):
+        """
+        Ban the whole bucket until `until` or the last of its bans ends, in the
+        place of its sentinel or of the record ending first
+        returns the expiry
+        """
+        way = self._find(records, FULL_BUCKET)
+        if way is None:
+            way = min(range(WAYS), key=lambda way: records[way][BAN_UNTIL])
+        until = max(until, *(record[BAN_UNTIL] for record in records))
+        self._write(bucket, way, (FULL_BUCKET, 0, 0, until, now))
+        return until
+
+    def ban_until(self, keys):
+        """
+        Returns the ban expiry of every key, without locking
+        """
+        self._open()
+        result = []
+        for key in keys:
+            hashed = key_hash(key, self.secret)
+            result.append(self._until(self._read_bucket(hashed % self.buckets), hashed))
+        return result
+
+    def hit(self, key, max_attempts, period, now=None):
+        """
+        Count a failed attempt for `key`, ban it for `period` seconds once it
+        exceeds `max_attempts` within the window
+        returns the attempts and the ban expiry
+        """
+        self._open()
+        now = int(time.time()) if now is None else now
+        hashed = key_hash(key, self.secret)
+        bucket = hashed % self.buckets
+        with self._locked(bucket):
+            records = self._read_bucket(bucket)
+            way = self._find(records, hashed)
+            if way is None:
+                way = self._victim(records, now)
+                if way is None:
+                    # every slot holds a running ban, fail closed
+                    until = self._ban_bucket(bucket, records, now + period, now)
+                    return max_attempts + 1, until
+                attempts, window_end, ban_until = 0, now + period, 0
+            else:
+                _, attempts, window_end, ban_until, _ = records[way]
+                if window_end <= now:
+                    # the window is over, count from scratch
+                    attempts, window_end = 0, now + period
+            attempts += 1
+            if attempts > max_attempts and ban_until <= now:
+                ban_until = now + period
+            self._write(bucket, way, (hashed, attempts, window_end, ban_until, now))
+        # a ban of the whole bucket covers the key too
+        return attempts, max(ban_until, self._until(records, FULL_BUCKET))
+
+    def deny(self, key, until, now=None):
+        """
+        Deny `key` until `until`, epoch seconds, without evicting a running
+        entry: in a bucket full of them the oldest makes way for a record
+        denying the whole bucket until the last of them ends
+        """
+        self._open()
+        now = int(time.time()) if now is None else now
+        hashed = key_hash(key, self.secret)
+        bucket = hashed % self.buckets
+        with self._locked(bucket):
+            records = self._read_bucket(bucket)
+            way = self._find(records, hashed)
+            if way is not None:
+                until = max(until, records[way][BAN_UNTIL])
+            else:
+                way = self._free(records, now)
+            if way is None:
+                # fail closed, the bucket as a whole covers every entry of it
+                self._ban_bucket(bucket, records, until, now)
+            else:
+                self._write(bucket, way, (hashed, 0, 0, until, now))
+
+    def denied(self, keys, now=None):
+        """
+        Whether each key is denied, by itself or by its full bucket, without
+        locking
+        """
+        self._open()
+        now = int(time.time()) if now is None else now
+        result = []
+        for key in keys:
+            hashed = key_hash(key, self.secret)
+            records = self._read_bucket(hashed % self.buckets)
+            result.append(self._until(records, hashed) > now)
+        return result
+
+    def reset(self, key):
+        """
+        Forget the attempts of `key`, a running ban is kept
+        """
+        self._open()
+        hashed = key_hash(key, self.secret)
+        bucket = hashed % self.buckets
+        with self._locked(bucket):
+            records = self._read_bucket(bucket)
+            way = self._find(records, hashed)
+            if way is not None:
+                _, _, _, ban_until, last_seen = records[way]
+                self._write(bucket, way, (hashed, 0, 0, ban_until, last_seen))
+
+    def clear(self):
+        self._open()
+        for stripe in range(STRIPES):
+            self._locks[stripe].acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            self._buffer[HEADER.size :] = bytes(self.size - HEADER.size)
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        finally:
+            for stripe in range(STRIPES):
+                self._locks[stripe].release()
+
+    def purge(self, now=None):
+        """
+        Empty the slots of the expired records, bucket by bucket
+        returns how many were emptied
+        """
+        self._open()
+        now = int(time.time()) if now is None else now
+        purged = 0
+        for bucket in range(self.buckets):
+            records = self._read_bucket(bucket)
+            if not any(self._expired(record, now) for record in records):
+                continue
+            with self._locked(bucket):
+                # read again, under the lock
+                for way, record in enumerate(self._read_bucket(bucket)):
+                    if self._expired(record, now):
+                        self._write(bucket, way, (0, 0, 0, 0, 0))
+                        purged += 1
+        return purged
+
+    @staticmethod
+    def _expired(record, now):
+        return record[KEY] and max(record[WINDOW_END], record[BAN_UNTIL]) <= now
+
+    def stats(self, now=None):
+        """
+        Returns occupancy of the table
+        """
+        self._open()
+        now = int(time.time()) if now is None else now
+        used = banned = 0
+        for bucket in range(self.buckets):
+            for record in self._read_bucket(bucket):
+                if record[KEY] and max(record[WINDOW_END], record[BAN_UNTIL]) > now:
+                    used += 1
+                    banned += record[BAN_UNTIL] > now
+        return {"slots": self.slots, "bytes": self.size, "used": used, "banned": banned}
+
+
+class _StripeLock:
+    """
+    Lock a stripe of the table for this thread and this process
+    """
+
+    def __init__(self, table, stripe):
+        self.table = table
+        self.stripe = stripe
+
+    def __enter__(self):
+        self.table._locks[self.stripe].acquire()
+        # one byte per stripe, the range only names the stripe for other processes
+        fcntl.lockf(self.table._fd, fcntl.LOCK_EX, 1, self.stripe)
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self.table._fd, fcntl.LOCK_UN, 1, self.stripe)
+        self.table._locks[self.stripe].release()
+
+
+def default_table_path():
+    # one table per project checkout, shared by every worker started from it
+    # and private to the user running them
+    name = hashlib.blake2b(str(settings.BASE_DIR).encode(), digest_size=6).hexdigest()
+    return os.path.join(private_tempdir(), f"ubaar-bans-{name}")
+
+
+class SharedMemoryAttemptCounter:
+    """
+    Attempt counter backed by `SharedBanTable`, same interface as the cache counters
+    the cache `alias` is accepted for compatibility and unused, the table is
+    configured with `USERS_BAN_TABLE = {"PATH": ..., "SLOTS": ...}`
+    """
+
+    def __init__(
+        self,
+        alias=None,
+        max_attempts=MAX_ATTEMPS,
+        ban_period=BAN_PERIOD_MINUTE * 60,
+    ):
+        options = getattr(settings, "USERS_BAN_TABLE", {})
+        self.table = SharedBanTable(
+            options.get("PATH") or default_table_path(),
+            slots=options.get("SLOTS", DEFAULT_SLOTS),
+        )
+        self.max_attempts = max_attempts
+        self.ban_period = ban_period
+
+    def remaining(self, identifiers):
+        now = int(time.time())
+        return [max(until - now, 0) for until in self.table.ban_until(identifiers)]
+
+    def hit(self, identifiers, limits=None):
+        now = int(time.time())
+        limits = limits or [self.max_attempts] * len(identifiers)
+        states = []
+        for identifier, limit in zip(identifiers, limits):
+            attempts, ban_until = self.table.hit(
+                identifier, limit, self.ban_period, now=now
+            )
+            states.append(AttemptState(attempts, max(ban_until - now, 0)))
+        return states
+
+    def reset(self, identifiers):
+        for identifier in identifiers:
+            self.table.reset(identifier)
+
+    # the table is in memory and its locks are held for microseconds,
+    # so the async api runs on the event loop directly
+
+    async def aremaining(self, identifiers):
+        return self.remaining(identifiers)
+
+    async def ahit(self, identifiers, limits=None):
+        return self.hit(identifiers, limits)
+
+    async def areset(self, identifiers):
+        self.reset(identifiers)
@@ -0,0 +1,97 @@
+"""
+Database tuning and read routing
+
+sqlite connections are tuned as they are opened (`connection_created`):
+write ahead logging so readers never block the writer nor the other way round,
+`synchronous=NORMAL`, which is safe with wal, a busy timeout so a writer waits
+for the lock instead of failing with "database is locked", and a memory mapped
+read path. the pragmas are `SQLITE_PRAGMAS`, overridden per pragma with
+`USERS_SQLITE_PRAGMAS`.
+
+`ReplicaRouter` sends the reads made inside `read_from_replica()` to the
+`USERS_READ_REPLICA` alias, when it is configured: the lookups deciding between
+login and register and the user lookup of `authenticate`. every other read and
+all writes, session saves and user inserts included, stay on the primary.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    # milliseconds
+    "busy_timeout": 5000,
+    # bytes
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+_replica_reads = ContextVar("replica_reads", default=False)
+
+
+def get_sqlite_pragmas():
+    return {**SQLITE_PRAGMAS, **getattr(settings, "USERS_SQLITE_PRAGMAS", {})}
+
+
+def is_read_only(connection):
+    name = str(connection.settings_dict["NAME"])
+    return bool(connection.settings_dict["OPTIONS"].get("uri")) and "mode=ro" in name
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Apply the pragmas to every new sqlite connection
+    """
+    if connection.vendor != "sqlite":
+        return
+    pragmas = get_sqlite_pragmas()
+    if is_read_only(connection) or connection.is_in_memory_db():
+        # the journal mode is a property of the file, set by the primary
+        pragmas.pop("journal_mode", None)
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+@contextmanager
+def read_from_replica():
+    """
+    Route the reads of the block to the read replica, for lookups that can
+    live with its lag
+    """
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def get_replica_alias():
+    alias = getattr(settings, "USERS_READ_REPLICA", None)
+    return alias if alias in connections.settings else None
+
+
+class ReplicaRouter:
+    """
+    Reads inside `read_from_replica()` go to the replica, everything else to
+    the primary, only the primary is migrated
+    """
+
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get():
+            return get_replica_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        # objects read from the replica are written back to the primary
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the same data on both aliases
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS or db != get_replica_alias()
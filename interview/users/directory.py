@@ -0,0 +1,289 @@
+"""
+Read through cache of the users the login flow looks up
+
+the phonenumber check and then `authenticate()` load the same user within
+seconds, and every login retry loads it again. the directory keeps what the
+flow needs of a user, keyed by the canonical phonenumber, in its own cache
+alias (`USERS_DIRECTORY["CACHE"]`, bounded by the alias' `MAX_ENTRIES`) for
+`TTL` seconds:
+
+    (id, password hash, is_active, last_login)
+
+so checking the phonenumber loads the user once and the login that follows
+reads it from the cache. only usernames that are phonenumbers in their E.164
+form are cached, any other (a staff username, or one typed by hand) is queried
+every time and never builds a key. `user()` rebuilds a user instance from an entry, its
+other fields deferred and only loaded if something reads them.
+
+a saved or deleted user is dropped from the directory (`post_save`,
+`post_delete`), a password change included, and the `last_login` update of a
+login refreshes the entry instead. the cache is per process, so dropping an
+entry also bumps the user's stamp in `StampTable`, a memory mapped file shared
+by the workers of the host, once on save and again on commit. an entry is
+stored with the stamp read before its query and only served while the stamp is
+unchanged, so another worker's change reaches every worker of the host at once.
+
+the staleness window: a user changed on another host, or through
+`QuerySet.update()` which sends no signal, is served from the directory for up
+to `TTL` seconds. bulk writes call `discard_many` themselves, like
+`users.importing` does after `bulk_create`.
+
+lookups are counted in `users_directory_lookups_total`, per hit or miss.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .database import read_from_replica
+from .metrics import DIRECTORY_LOOKUPS, count, metered_cache
+from .runtime import private_tempdir
+from .validators import normalize_phonenumber
+
+DEFAULTS = {
+    "ENABLED": True,
+    "CACHE": "directory",
+    # seconds an entry is kept, the staleness window across hosts
+    "TTL": 30,
+    "KEY_PREFIX": "user",
+    # the stamps shared by the workers, in the private temp directory by default
+    "STAMPS_PATH": None,
+    "STAMPS": 1 << 16,
+}
+FIELDS = ("id", "password", "is_active", "last_login")
+STAMP = struct.Struct("<Q")
+
+
+def get_directory_settings():
+    return {**DEFAULTS, **getattr(settings, "USERS_DIRECTORY", {})}
+
+
+def default_stamps_path():
+    name = hashlib.blake2b(str(settings.BASE_DIR).encode(), digest_size=6).hexdigest()
+    return os.path.join(private_tempdir(), f"ubaar-directory-{name}")
+
+
+class StampTable:
+    """
+    A change counter per username hash in a memory mapped file shared by the
+    processes opening `path`, two usernames of one slot only cost extra misses
+    """
+
+    def __init__(self, path, slots=DEFAULTS["STAMPS"]):
+        self.path = path
+        self.slots = slots
+        self._buffer = None
+        self._open_lock = threading.Lock()
+
+    def _open(self):
+        # a shared mapping stays shared in a forked worker, once is enough
+        if self._buffer is not None:
+            return self._buffer
+        with self._open_lock:
+            if self._buffer is None:
+                size = self.slots * STAMP.size
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    if os.fstat(fd).st_size != size:
+                        os.ftruncate(fd, size)
+                    self._buffer = mmap.mmap(fd, size)
+                finally:
+                    os.close(fd)
+        return self._buffer
+
+    def _offset(self, username):
+        digest = hashlib.blake2b(username.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % self.slots * STAMP.size
+
+    def stamp(self, username):
+        return STAMP.unpack_from(self._open(), self._offset(username))[0]
+
+    def bump(self, username):
+        # racing bumps may write the same value, never an older one
+        buffer, offset = self._open(), self._offset(username)
+        STAMP.pack_into(buffer, offset, STAMP.unpack_from(buffer, offset)[0] + 1)
+
+
+class UserDirectory:
+    """
+    The directory entries in the cache `alias`, under `prefix`
+    """
+
+    def __init__(self, alias="directory", ttl=30, prefix="user", stamps=None):
+        self.alias = alias
+        self.ttl = ttl
+        self.prefix = prefix
+        self.stamps = stamps or StampTable(default_stamps_path())
+
+    @property
+    def cache(self):
+        return metered_cache(self.alias)
+
+    def key(self, username):
+        """
+        The cache key of `username`, None unless it is a phonenumber in its
+        E.164 form, the only usernames cached
+        """
+        if normalize_phonenumber(username) != username:
+            return None
+        return f"{self.prefix}:{username}"
+
+    def entry(self, username):
+        """
+        The entry of `username`, loaded on a miss, None if not registered
+        """
+        key = self.key(username)
+        if key is None:
+            return self._load(username)
+        stamp = self.stamps.stamp(username)
+        entry = self._current(self.cache.get(key), stamp)
+        if entry is None:
+            entry = self._load(username)
+            if entry is not None:
+                self.cache.set(key, (stamp, entry), timeout=self.ttl)
+        return entry
+
+    async def aentry(self, username):
+        key = self.key(username)
+        if key is None:
+            return await self._aload(username)
+        stamp = self.stamps.stamp(username)
+        entry = self._current(await self.cache.aget(key), stamp)
+        if entry is None:
+            entry = await self._aload(username)
+            if entry is not None:
+                await self.cache.aset(key, (stamp, entry), timeout=self.ttl)
+        return entry
+
+    @staticmethod
+    def _current(stored, stamp):
+        """
+        The stored entry if the user didn't change since it was loaded
+        """
+        entry = stored[1] if stored is not None and stored[0] == stamp else None
+        count(DIRECTORY_LOOKUPS, "miss" if entry is None else "hit")
+        return entry
+
+    @staticmethod
+    def _query(username):
+        return (
+            get_user_model()
+            ._default_manager.filter(**{get_user_model().USERNAME_FIELD: username})
+            .values_list(*FIELDS)
+        )
+
+    def _load(self, username):
+        with read_from_replica():
+            return self._query(username).first()
+
+    async def _aload(self, username):
+        with read_from_replica():
+            return await self._query(username).afirst()
+
+    def user(self, username):
+        return self.build(username, self.entry(username))
+
+    async def auser(self, username):
+        return self.build(username, await self.aentry(username))
+
+    @staticmethod
+    def build(username, entry):
+        if entry is None:
+            return None
+        user_model = get_user_model()
+        values = {**dict(zip(FIELDS, entry)), user_model.USERNAME_FIELD: username}
+        # in the order of the model's fields, the others deferred
+        names = [
+            field.attname
+            for field in user_model._meta.concrete_fields
+            if field.attname in values
+        ]
+        return user_model.from_db(
+            DEFAULT_DB_ALIAS, names, [values[name] for name in names]
+        )
+
+    def refresh(self, user):
+        """
+        Store the entry of a user that was just saved
+        """
+        username = user.get_username()
+        key = self.key(username)
+        if key is None:
+            return
+        entry = tuple(getattr(user, field) for field in FIELDS)
+        self.cache.set(key, (self.stamps.stamp(username), entry), timeout=self.ttl)
+
+    def discard(self, username):
+        """
+        Drop the entry of `username` from every worker of the host, again once
+        the change is committed, in case a worker loaded it in between
+        """
+        key = self.key(username)
+        if key is None:
+            return
+        self.cache.delete(key)
+        self.stamps.bump(username)
+        transaction.on_commit(lambda: self.stamps.bump(username))
+
+    def discard_many(self, usernames):
+        """
+        `discard` the users of a bulk write, which sends no signal
+        """
+        keys = {username: self.key(username) for username in usernames}
+        usernames = [username for username, key in keys.items() if key is not None]
+        if not usernames:
+            return
+        self.cache.delete_many([keys[username] for username in usernames])
+
+        def bump():
+            for username in usernames:
+                self.stamps.bump(username)
+
+        bump()
+        transaction.on_commit(bump)
+
+
+_directory = None
+
+
+def get_user_directory():
+    """
+    The directory, None when disabled
+    """
+    global _directory
+    if _directory is None:
+        options = get_directory_settings()
+        if not options["ENABLED"]:
+            return None
+        stamps = StampTable(
+            options["STAMPS_PATH"] or default_stamps_path(), options["STAMPS"]
+        )
+        _directory = UserDirectory(
+            options["CACHE"], options["TTL"], options["KEY_PREFIX"], stamps
+        )
+    return _directory
+
+
+def reset_user_directory(**kwargs):
+    global _directory
+    _directory = None
+
+
+def update_directory(sender, instance, update_fields=None, **kwargs):
+    """
+    `post_save` and `post_delete` receiver
+    """
+    directory = get_user_directory()
+    if directory is None:
+        return
+    if update_fields is not None and set(update_fields) == {"last_login"}:
+        # the login that just read the entry, keep it
+        directory.refresh(instance)
+    else:
+        directory.discard(instance.get_username())
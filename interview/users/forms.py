@@ -4,13 +4,26 @@ from django.contrib.auth.forms import (AuthenticationForm,
 from django.core.validators import MinLengthValidator
 from django.forms import CharField, Form, ModelForm, SlugField, TextInput
 
-from .validators import phonenumber_validator
+from .validators import normalize_phonenumber, phonenumber_validator
 
 user = get_user_model()
 
-phonenumber_field = CharField(
+
+class PhonenumberField(CharField):
+    """
+    Cleans to the E.164 form of the phonenumber, see `users.validators`
+    """
+
+    def to_python(self, value):
+        value = super().to_python(value)
+        # invalid input is left as is for the validator to reject
+        return normalize_phonenumber(value) or value
+
+
+phonenumber_field = PhonenumberField(
     label="phonenumber",
-    max_length=12,
+    # the typed form, with a country code and separators
+    max_length=20,
     validators=[phonenumber_validator],
     widget=TextInput(attrs={"type": "tel"}),
 )
@@ -37,6 +50,14 @@ class RegisterForm(UserCreationForm):
 
 class LoginForm(AuthenticationForm):
     username = phonenumber_field
+    # the async views turn this off and check the credentials with `aauthenticate`,
+    # so validating the form never hashes on the event loop
+    check_credentials = True
+
+    def clean(self):
+        if self.check_credentials:
+            return super().clean()
+        return self.cleaned_data
 
     class Meta:
         model = user
@@ -65,6 +86,11 @@ class RegisterInfoForm(ModelForm):
 class RegisterPasswordForm(BaseUserCreationForm):
     password2 = None
 
+    def _post_clean(self):
+        super()._post_clean()
+        # the base form validates the confirmation field, which this form drops
+        self.validate_password_for_user(self.instance, password_field_name="password1")
+
     class Meta:  # type: ignore
         model = user
         fields = ("password1",)
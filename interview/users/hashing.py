@@ -0,0 +1,274 @@
+"""
+Password hashing off the request thread
+
+`PooledPBKDF2PasswordHasher` is a drop-in for django's default hasher (same
+`pbkdf2_sha256` algorithm and format, so stored hashes keep verifying) that runs
+the key derivation in a process pool, so `authenticate()` and `form.save()` in
+the views stay unchanged but no longer hold a worker thread's cpu.
+
+the pool admits at most `WORKERS + QUEUE` hashes at a time, anything above that
+fails fast with `HashingOverloaded` instead of piling up, and a hash that isn't
+done within the deadline raises `HashingTimeout`. `HashingUnavailableMiddleware`
+turns both into a 503.
+
+configured with `USERS_HASHING = {"WORKERS": ..., "QUEUE": ..., "TIMEOUT": ...}`,
+`WORKERS = 0` hashes inline like the stock hasher. the pool is shut down at
+exit, and a forked child, which inherits the pool but none of its processes,
+starts a pool of its own.
+"""
+
+import asyncio
+import atexit
+import base64
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import (PBKDF2PasswordHasher, get_hasher,
+                                         identify_hasher, is_password_usable,
+                                         make_password)
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes
+
+from .metrics import observe_hash
+
+# per request override of the configured deadline, see `hashing_deadline`
+_deadline = ContextVar("hashing_deadline", default=None)
+
+
+class HashingUnavailable(Exception):
+    """
+    A password couldn't be hashed in time, the caller should retry later
+    """
+
+
+class HashingOverloaded(HashingUnavailable):
+    pass
+
+
+class HashingTimeout(HashingUnavailable):
+    pass
+
+
+def _pbkdf2(digest_name, password, salt, iterations):
+    # runs in the pool processes, keep it free of django
+    return hashlib.pbkdf2_hmac(digest_name, password, salt, iterations)
+
+
+def _encode(hasher_path, password, salt):
+    # runs in the processes of `manage.py import_users`, which don't set django up,
+    # so only hashers that don't read settings work here
+    from django.utils.module_loading import import_string
+
+    return import_string(hasher_path)().encode(password, salt)
+
+
+def pool_hasher_path(hasher):
+    """
+    Import path of a hasher producing the same hashes as `hasher` without a
+    hashing pool of its own, for `_encode`
+    """
+    if isinstance(hasher, PooledPBKDF2PasswordHasher):
+        hasher = PBKDF2PasswordHasher()
+    return f"{type(hasher).__module__}.{type(hasher).__qualname__}"
+
+
+class HashingService:
+    """
+    Bounded process pool running pbkdf2
+    """
+
+    def __init__(self, workers=None, queue=None, timeout=5.0):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.queue = self.workers * 2 if queue is None else queue
+        self.timeout = timeout
+        self._pid = None
+        self._check_pid()
+
+    def _check_pid(self):
+        """
+        Start over in a forked child, the parent's pool processes, slots and
+        lock are of no use there
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._slots = threading.BoundedSemaphore(max(self.workers + self.queue, 1))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        self._check_pid()
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # imported with the first pool, not at url loading
+                    import multiprocessing
+                    from concurrent.futures import ProcessPoolExecutor
+
+                    # spawn, forking a threaded server process isn't safe
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                    # before the interpreter tears down what the pool needs
+                    atexit.register(self.shutdown)
+        return self._executor
+
+    def pbkdf2(self, password, salt, iterations, digest_name):
+        args = (digest_name, force_bytes(password), force_bytes(salt), iterations)
+        if not self.workers:
+            return _pbkdf2(*args)
+        future = self._submit(args)
+        try:
+            return future.result(timeout=self._timeout())
+        except FutureTimeoutError:
+            future.cancel()
+            raise HashingTimeout("password hashing missed its deadline")
+
+    async def apbkdf2(self, password, salt, iterations, digest_name):
+        """
+        Same as `pbkdf2`, awaiting the pool instead of blocking the event loop
+        """
+        args = (digest_name, force_bytes(password), force_bytes(salt), iterations)
+        if not self.workers:
+            return await sync_to_async(_pbkdf2, thread_sensitive=False)(*args)
+        future = asyncio.wrap_future(self._submit(args))
+        try:
+            return await asyncio.wait_for(future, self._timeout())
+        except asyncio.TimeoutError:
+            raise HashingTimeout("password hashing missed its deadline")
+
+    def _submit(self, args):
+        self._check_pid()
+        # admission control, don't wait for a slot
+        if not self._slots.acquire(blocking=False):
+            raise HashingOverloaded("too many passwords waiting to be hashed")
+        try:
+            future = self.executor.submit(_pbkdf2, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # the slot is held until the hash is really done, even after a timeout
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _timeout(self):
+        timeout = _deadline.get()
+        return self.timeout if timeout is None else timeout
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        atexit.unregister(self.shutdown)
+
+
+_service = None
+
+
+def get_hashing_service():
+    global _service
+    if _service is None:
+        options = getattr(settings, "USERS_HASHING", {})
+        _service = HashingService(
+            workers=options.get("WORKERS"),
+            queue=options.get("QUEUE"),
+            timeout=options.get("TIMEOUT", 5.0),
+        )
+    return _service
+
+
+def reset_hashing_service(**kwargs):
+    global _service
+    if _service is not None:
+        _service.shutdown()
+    _service = None
+
+
+@contextmanager
+def hashing_deadline(seconds):
+    """
+    Override the hashing deadline for the code in the block, e.g. a tighter one
+    for interactive logins
+    """
+    token = _deadline.set(seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+class PooledPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    `PBKDF2PasswordHasher` with the key derivation running in `HashingService`
+    """
+
+    def encode(self, password, salt, iterations=None):
+        self._check_encode_args(password, salt)
+        iterations = iterations or self.iterations
+        start = time.perf_counter()
+        hash = get_hashing_service().pbkdf2(
+            password, salt, iterations, self.digest().name
+        )
+        observe_hash(time.perf_counter() - start)
+        hash = base64.b64encode(hash).decode("ascii").strip()
+        return "%s$%d$%s$%s" % (self.algorithm, iterations, salt, hash)
+
+    async def aencode(self, password, salt, iterations=None):
+        self._check_encode_args(password, salt)
+        iterations = iterations or self.iterations
+        start = time.perf_counter()
+        hash = await get_hashing_service().apbkdf2(
+            password, salt, iterations, self.digest().name
+        )
+        observe_hash(time.perf_counter() - start)
+        hash = base64.b64encode(hash).decode("ascii").strip()
+        return "%s$%d$%s$%s" % (self.algorithm, iterations, salt, hash)
+
+    async def averify(self, password, encoded):
+        decoded = self.decode(encoded)
+        encoded_2 = await self.aencode(password, decoded["salt"], decoded["iterations"])
+        return constant_time_compare(encoded, encoded_2)
+
+
+async def amake_password(password):
+    """
+    `make_password` for async code, the hash never runs on the event loop
+    """
+    hasher = get_hasher()
+    if isinstance(hasher, PooledPBKDF2PasswordHasher):
+        return await hasher.aencode(password, hasher.salt())
+    return await sync_to_async(make_password, thread_sensitive=False)(password)
+
+
+async def acheck_password(password, encoded, setter=None):
+    """
+    `check_password` for async code, the hash never runs on the event loop
+    unlike django's `acheck_password`, which verifies inline
+    """
+    if password is None or not is_password_usable(encoded):
+        return False
+    try:
+        hasher = identify_hasher(encoded)
+    except ValueError:
+        return False
+    if isinstance(hasher, PooledPBKDF2PasswordHasher):
+        is_correct = await hasher.averify(password, encoded)
+    else:
+        verify = sync_to_async(hasher.verify, thread_sensitive=False)
+        is_correct = await verify(password, encoded)
+    preferred = get_hasher()
+    must_update = hasher.algorithm != preferred.algorithm or preferred.must_update(
+        encoded
+    )
+    if setter and is_correct and must_update:
+        await setter(password)
+    return is_correct
@@ -0,0 +1,263 @@
+"""
+Bulk user import, see `manage.py import_users`
+
+the input streams through a pipeline of generators, so memory only holds a
+couple of chunks whatever the size of the file:
+
+    read_rows        csv or jsonl rows, skipping the ones a checkpoint says are done
+    clean_rows       normalizes and validates the phonenumber, drops bad rows
+    chunks           groups the rows in `chunk_size` lists
+    UserImporter     drops usernames already taken, hashes the passwords of a
+                     chunk in a process pool while the previous one is inserted,
+                     inserts each chunk with `bulk_create` in a transaction and
+                     then writes the checkpoint, a username registered since
+                     its lookup is skipped and counted in `conflicts`, and the
+                     username index and user directory are updated, as no
+                     signal is sent
+
+a row has a `phonenumber` and optionally `password`, `first_name`,
+`last_name` and `email`. rows without a password get an unusable one.
+"""
+
+import csv
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import get_hasher, make_password
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .directory import get_user_directory
+from .hashing import _encode, pool_hasher_path
+from .membership import get_username_index
+from .validators import normalize_phonenumber, phonenumber_validator
+
+FIELDS = ("first_name", "last_name", "email")
+
+
+def read_rows(path, format=None, skip=0):
+    """
+    Yield the rows of a csv (with a header) or jsonl file as dicts, after the
+    first `skip`
+    """
+    format = format or ("jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv")
+    with open(path, newline="", encoding="utf-8") as f:
+        if format == "csv":
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        yield from islice(rows, skip, None)
+
+
+def clean_rows(rows, stats):
+    """
+    Yield `(username, row)` for the rows with a valid phonenumber, the username
+    being its E.164 form
+    """
+    for row in rows:
+        stats.read += 1
+        raw = (row.get("phonenumber") or "").strip()
+        try:
+            phonenumber_validator(raw)
+        except ValidationError:
+            stats.invalid += 1
+            yield None
+            continue
+        yield normalize_phonenumber(raw), row
+
+
+def chunks(items, size):
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class ImportStats:
+    def __init__(self, read=0, invalid=0, duplicate=0, imported=0, conflicts=0):
+        self.read = read
+        self.invalid = invalid
+        self.duplicate = duplicate
+        self.imported = imported
+        # usernames registered between their lookup and their insert
+        self.conflicts = conflicts
+        self.started = time.monotonic()
+        self._start_read = read
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return (self.read - self._start_read) / elapsed if elapsed else 0
+
+    def as_dict(self):
+        return {
+            "read": self.read,
+            "invalid": self.invalid,
+            "duplicate": self.duplicate,
+            "imported": self.imported,
+            "conflicts": self.conflicts,
+        }
+
+
+class Checkpoint:
+    """
+    Progress of an import in a small json file, written after every committed
+    chunk, so an interrupted import resumes after the last one
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        if state.get("source") != self.source:
+            return None
+        return state["stats"]
+
+    def save(self, stats):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"source": self.source, "stats": stats}, f)
+        # the checkpoint is always either the old or the new one
+        os.replace(tmp, self.path)
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class UserImporter:
+    """
+    Insert cleaned rows in chunks, see the module docstring
+    """
+
+    def __init__(self, chunk_size=1000, workers=None, checkpoint=None, report=None):
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count() or 1
+        self.checkpoint = checkpoint
+        self.report = report
+        self.user_model = get_user_model()
+        self.hasher = get_hasher()
+
+    def run(self, rows, stats):
+        """
+        Import the `(username, row)` items of `rows`, None items are rows that
+        were dropped and only count for the checkpoint
+        """
+        with ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            pending = None
+            for chunk in chunks(rows, self.chunk_size):
+                # the previous chunk isn't in the database yet
+                inserting = {u.get_username() for u, _ in pending[0]} if pending else ()
+                users = self.new_users(chunk, stats, inserting)
+                # the progress up to the end of this chunk, saved once it's committed
+                progress = stats.as_dict()
+                # hash this chunk while the previous one is inserted
+                hashing = self.hash(executor, users)
+                if pending:
+                    self.insert(*pending, stats)
+                pending = (users, hashing, progress)
+            if pending:
+                self.insert(*pending, stats)
+        return stats
+
+    def new_users(self, chunk, stats, pending):
+        """
+        Unsaved users for the rows of `chunk` whose username isn't taken, nor
+        in the `pending` usernames
+        """
+        rows = {}
+        for item in chunk:
+            if item is None:
+                continue
+            username, row = item
+            if username in rows or username in pending:
+                stats.duplicate += 1
+                continue
+            rows[username] = row
+        # only the usernames the index can't rule out are looked up
+        index = get_username_index()
+        candidates = [username for username in rows if index.might_contain(username)]
+        taken = set()
+        for batch in chunks(candidates, 500):
+            taken.update(
+                self.user_model._default_manager.filter(
+                    username__in=batch
+                ).values_list("username", flat=True)
+            )
+        stats.duplicate += len(taken)
+        return [
+            (
+                self.user_model(
+                    username=username,
+                    **{field: row.get(field) or "" for field in FIELDS},
+                ),
+                row.get("password") or None,
+            )
+            for username, row in rows.items()
+            if username not in taken
+        ]
+
+    def hash(self, executor, users):
+        """
+        Start hashing the passwords of `users`, returns an iterator over the
+        hashes in order
+        """
+        path = pool_hasher_path(self.hasher)
+        passwords = [password for _, password in users if password]
+        hashes = executor.map(
+            _encode,
+            [path] * len(passwords),
+            passwords,
+            [self.hasher.salt() for _ in passwords],
+            chunksize=max(len(passwords) // (self.workers * 4), 1),
+        )
+        return hashes
+
+    def count(self, usernames):
+        return sum(
+            self.user_model._default_manager.filter(username__in=batch).count()
+            for batch in chunks(usernames, 500)
+        )
+
+    def insert(self, users, hashes, progress, stats):
+        for user, password in users:
+            # rows without a password can't log in until they reset it
+            user.password = next(hashes) if password else make_password(None)
+        usernames = [user.get_username() for user, _ in users]
+        with transaction.atomic():
+            before = self.count(usernames)
+            # a user registered since the lookup is skipped, not an error
+            self.user_model._default_manager.bulk_create(
+                [user for user, _ in users],
+                batch_size=self.chunk_size,
+                ignore_conflicts=True,
+            )
+            # the skipped rows aren't reported, count the ones that went in
+            inserted = self.count(usernames) - before
+            # bulk_create sends no post_save, so the index and the directory
+            # are updated here
+            get_username_index().add(*usernames)
+            directory = get_user_directory()
+            if directory is not None:
+                directory.discard_many(usernames)
+        stats.imported += inserted
+        stats.conflicts += len(users) - inserted
+        if self.checkpoint:
+            self.checkpoint.save(
+                {**progress, "imported": stats.imported, "conflicts": stats.conflicts}
+            )
+        if self.report:
+            self.report(stats)
@@ -0,0 +1,153 @@
+"""
+Operation counting
+
+`count_operations()` counts what the code run inside it costs in round trips:
+database queries (and the writes among them), cache calls by method, ban table
+calls and password hashes, e.g.
+
+    with count_operations() as counts:
+        client.post("/login/", ...)
+    counts["queries"], counts["cache.get"], counts["hashes"]
+
+the counts follow the context (contextvars), not the thread, so a request
+served by async views is counted whole although its orm calls hop to another
+thread, and concurrent requests are counted apart. only the outermost call is
+counted, `get_many` built out of `get`s is one cache call.
+
+counting wraps the methods of the database cursor, of the configured cache
+backends, of the ban table and of the configured password hashers while
+`install()`ed, `count_operations` installs it on first use. it patches
+framework classes process wide, so it is for the tests and the benchmarks
+only: the metrics of a running server are counted by `users.metrics` itself.
+"""
+
+import functools
+import inspect
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.auth.hashers import get_hashers
+from django.core.cache import caches
+from django.db.backends.utils import CursorWrapper
+
+from .bantable import SharedBanTable
+from .metrics import CACHE_METHODS
+
+BAN_TABLE_METHODS = ("ban_until", "hit", "reset")
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+_counts = ContextVar("operation_counts", default=None)
+# the kinds of operation being counted right now, nested calls aren't counted
+_inside = ContextVar("operation_inside", default=frozenset())
+
+_lock = threading.Lock()
+_patched = []
+
+
+def _record(counts, kind, name, args):
+    if kind == "queries":
+        counts["queries"] += 1
+        sql = args[0] if args else ""
+        if isinstance(sql, str) and sql.lstrip()[:7].upper().startswith(
+            WRITE_STATEMENTS
+        ):
+            counts["writes"] += 1
+    elif kind == "cache":
+        counts["cache"] += 1
+        counts[f"cache.{name}"] += 1
+    elif kind == "ban_table":
+        counts["ban_table"] += 1
+        counts[f"ban_table.{name}"] += 1
+    else:
+        counts[kind] += 1
+
+
+def _counted(kind, name, method):
+    if inspect.iscoroutinefunction(method):
+
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            inside = _inside.get()
+            counts = _counts.get()
+            if kind in inside or counts is None:
+                return await method(*args, **kwargs)
+            _record(counts, kind, name, args[1:])
+            token = _inside.set(inside | {kind})
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                _inside.reset(token)
+
+    else:
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            inside = _inside.get()
+            counts = _counts.get()
+            if kind in inside or counts is None:
+                return method(*args, **kwargs)
+            _record(counts, kind, name, args[1:])
+            token = _inside.set(inside | {kind})
+            try:
+                return method(*args, **kwargs)
+            finally:
+                _inside.reset(token)
+
+    wrapper.__counted__ = True
+    return wrapper
+
+
+def _patch(cls, name, kind):
+    method = cls.__dict__.get(name) or getattr(cls, name, None)
+    if method is None or getattr(method, "__counted__", False):
+        return
+    _patched.append((cls, name, cls.__dict__.get(name)))
+    setattr(cls, name, _counted(kind, name, method))
+
+
+def install():
+    """
+    Wrap the counted methods, the ones already wrapped are left alone
+    """
+    with _lock:
+        for name in ("execute", "executemany"):
+            _patch(CursorWrapper, name, "queries")
+        for cls in {type(caches[alias]) for alias in settings.CACHES}:
+            for name in CACHE_METHODS:
+                _patch(cls, name, "cache")
+        for name in BAN_TABLE_METHODS:
+            _patch(SharedBanTable, name, "ban_table")
+        for cls in {type(hasher) for hasher in get_hashers()}:
+            _patch(cls, "encode", "hashes")
+            if hasattr(cls, "aencode"):
+                _patch(cls, "aencode", "hashes")
+
+
+def uninstall():
+    """
+    Unwrap the methods
+    """
+    with _lock:
+        for cls, name, original in reversed(_patched):
+            if original is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, original)
+        _patched.clear()
+
+
+@contextmanager
+def count_operations():
+    """
+    Count the operations of the block, yields a `Counter`
+    """
+    install()
+    counts = Counter()
+    token = _counts.set(counts)
+    try:
+        yield counts
+    finally:
+        _counts.reset(token)
@@ -0,0 +1,559 @@
+"""
+Load test of the login and sign up funnel, see `manage.py bench_funnel`
+
+a journey is a generator yielding the requests of one visitor, `Step`s, and
+getting the responses back, so the same journeys are driven by a thread per
+visitor (`ClientTarget`, `HTTPTarget`) or a task per visitor (`AsyncTarget`):
+
+    register_journey   check, otp, info and password, then logout
+    login_journey      check, `bad_logins` wrong passwords, the right one, logout
+    attacker_journey   wrong passwords for someone else's phonenumber until
+                       banned, then a few more while banned
+    api_register_journey, api_login_journey
+                       the same sign up and login through the json api of
+                       `users.api`, see `manage.py bench_api`
+
+every request is timed and, with the in-process targets, its database queries,
+cache calls, ban table calls and password hashes are counted
+(`users.instrumentation`), the pragmas of a connection the request opens
+included. `Recorder.summary()` aggregates them per step.
+"""
+
+import asyncio
+import json
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+from typing import NamedTuple
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urljoin
+from urllib.request import (HTTPCookieProcessor, HTTPRedirectHandler, Request,
+                            build_opener)
+
+from asgiref.sync import sync_to_async
+from django.shortcuts import reverse
+from django.test import AsyncClient, Client
+
+from .instrumentation import count_operations
+from .models import OutboundMessage
+
+PERCENTILES = (50, 95, 99)
+# always reported, even when none happened
+OPERATIONS = ("queries", "writes", "cache", "ban_table", "hashes")
+# requests a banned attacker keeps sending
+BANNED_ATTEMPTS = 3
+
+JSON = "application/json"
+
+OTP_RE = re.compile(r"(\d{6})\s*$")
+OTP_CACHE_KEY_RE = re.compile(r'name="otp_cache_key" value="([^"]+)"')
+
+
+class Step(NamedTuple):
+    name: str
+    method: str
+    path: str
+    data: dict | None = None
+    # the status the journey expects, any other one fails it
+    expect: int | None = 200
+    # of the body, form encoded by default
+    content_type: str | None = None
+
+
+class Response(NamedTuple):
+    status: int
+    location: str
+    body: str
+
+
+class OTPLookup(NamedTuple):
+    """
+    Yielded by a journey for the otp texted to `phonenumber`
+    """
+
+    phonenumber: str
+
+
+class UnexpectedResponse(Exception):
+    pass
+
+
+def expect(step, response):
+    if response.status != step.expect:
+        raise UnexpectedResponse(f"{step.name}: {response.status} != {step.expect}")
+    return response
+
+
+def register_journey(phonenumber, password):
+    yield Step("check_get", "GET", reverse("users:check"))
+    response = yield Step(
+        "check_new", "POST", reverse("users:check"), {"phonenumber": phonenumber}, 302
+    )
+    register = response.location
+    response = yield Step("register_otp_get", "GET", register)
+    otp_cache_key = OTP_CACHE_KEY_RE.search(response.body).group(1)
+    otp = yield OTPLookup(phonenumber)
+    yield Step(
+        "register_otp_post",
+        "POST",
+        register,
+        {"otp": otp, "otp_cache_key": otp_cache_key},
+        302,
+    )
+    yield Step(
+        "register_info",
+        "POST",
+        reverse("users:register_info"),
+        {"first_name": "load", "last_name": "test", "email": "load@example.com"},
+        302,
+    )
+    yield Step(
+        "register_password",
+        "POST",
+        reverse("users:register_password"),
+        {"password1": password, "password2": password},
+    )
+    yield Step("logout", "POST", reverse("users:logout_user"), expect=302)
+
+
+def login_journey(phonenumber, password, bad_logins=1):
+    yield Step("check_get", "GET", reverse("users:check"))
+    yield Step(
+        "check_existing", "POST", reverse("users:check"), {"phonenumber": phonenumber}
+    )
+    for _ in range(bad_logins):
+        yield Step(
+            "login_bad",
+            "POST",
+            reverse("users:login_user"),
+            {"username": phonenumber, "password": f"not-{password}"},
+        )
+    yield Step(
+        "login_good",
+        "POST",
+        reverse("users:login_user"),
+        {"username": phonenumber, "password": password},
+    )
+    yield Step("logout", "POST", reverse("users:logout_user"), expect=302)
+
+
+def user_journey(phonenumber, password, bad_logins=1):
+    """
+    A new visitor, signs up and comes back to log in
+    """
+    yield from register_journey(phonenumber, password)
+    yield from login_journey(phonenumber, password, bad_logins)
+
+
+def attacker_journey(phonenumber):
+    yield Step("check_get", "GET", reverse("users:check"))
+    banned = False
+    attempts = 0
+    while not banned:
+        # the failure that bans redirects back to the phonenumber form
+        response = yield Step(
+            "login_attack",
+            "POST",
+            reverse("users:login_user"),
+            {"username": phonenumber, "password": f"guess-{attempts}"},
+            expect=None,
+        )
+        banned = response.status == 302
+        attempts += 1
+    for attempt in range(BANNED_ATTEMPTS):
+        # turned away by BanCheckMiddleware before reaching the view
+        yield Step(
+            "login_banned",
+            "POST",
+            reverse("users:login_user"),
+            {"username": phonenumber, "password": f"guess-{attempts + attempt}"},
+            429,
+        )
+
+
+def api_register_journey(phonenumber, password):
+    response = yield Step(
+        "api_start_new",
+        "POST",
+        reverse("users:api_start"),
+        {"phonenumber": phonenumber},
+        content_type=JSON,
+    )
+    token = json.loads(response.body)["token"]
+    otp = yield OTPLookup(phonenumber)
+    response = yield Step(
+        "api_verify",
+        "POST",
+        reverse("users:api_verify"),
+        {"phonenumber": phonenumber, "token": token, "otp": otp},
+        content_type=JSON,
+    )
+    yield Step(
+        "api_register",
+        "POST",
+        reverse("users:api_register"),
+        {
+            "ticket": json.loads(response.body)["ticket"],
+            "first_name": "load",
+            "last_name": "test",
+            "email": "load@example.com",
+            "password1": password,
+        },
+        201,
+        content_type=JSON,
+    )
+
+
+def api_login_journey(phonenumber, password):
+    yield Step(
+        "api_start_existing",
+        "POST",
+        reverse("users:api_start"),
+        {"phonenumber": phonenumber},
+        content_type=JSON,
+    )
+    yield Step(
+        "api_login",
+        "POST",
+        reverse("users:api_login"),
+        {"username": phonenumber, "password": password},
+        content_type=JSON,
+    )
+
+
+def lookup_otp(phonenumber):
+    """
+    The last otp queued for `phonenumber`, from the sms queue
+    """
+    body = (
+        OutboundMessage.objects.filter(phonenumber=phonenumber)
+        .order_by("-id")
+        .values_list("body", flat=True)
+        .first()
+    )
+    return OTP_RE.search(body or "").group(1)
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def latency_summary(latencies):
+    ordered = sorted(latencies)
+    summary = {f"p{p}": percentile(ordered, p) for p in PERCENTILES}
+    summary["mean"] = sum(ordered) / len(ordered) if ordered else None
+    summary["max"] = ordered[-1] if ordered else None
+    # milliseconds
+    return {
+        name: round(value * 1000, 3) if value is not None else None
+        for name, value in summary.items()
+    }
+
+
+class Recorder:
+    """
+    Collects the timing, status and operation counts of every request
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.errors = Counter()
+        self.operations = defaultdict(Counter)
+        self.counted = Counter()
+        self.journeys = Counter()
+        self._lock = threading.Lock()
+        self.started = self.finished = None
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    def record(self, step, response, elapsed, counts):
+        with self._lock:
+            self.latencies[step.name].append(elapsed)
+            self.statuses[step.name][response.status] += 1
+            if step.expect is not None and response.status != step.expect:
+                self.errors[step.name] += 1
+            if counts is not None:
+                self.operations[step.name].update(counts)
+                self.counted[step.name] += 1
+
+    def journey_done(self, kind, ok):
+        with self._lock:
+            self.journeys[f"{kind}_{'completed' if ok else 'failed'}"] += 1
+
+    def _step_summary(self, names):
+        latencies = [elapsed for name in names for elapsed in self.latencies[name]]
+        counted = sum(self.counted[name] for name in names)
+        operations = Counter(dict.fromkeys(OPERATIONS, 0))
+        for name in names:
+            operations.update(self.operations[name])
+        statuses = Counter()
+        for name in names:
+            statuses.update(self.statuses[name])
+        return {
+            "requests": len(latencies),
+            "errors": sum(self.errors[name] for name in names),
+            "statuses": {str(status): n for status, n in sorted(statuses.items())},
+            "latency_ms": latency_summary(latencies),
+            # averages per request, unknown for servers out of process
+            "operations": (
+                {
+                    name: round(total / counted, 3)
+                    for name, total in sorted(operations.items())
+                }
+                if counted
+                else None
+            ),
+        }
+
+    def summary(self):
+        elapsed = self.finished - self.started
+        overall = self._step_summary(list(self.latencies))
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "throughput_rps": round(overall["requests"] / elapsed, 3),
+            "journeys": dict(sorted(self.journeys.items())),
+            "overall": overall,
+            "steps": {name: self._step_summary([name]) for name in self.latencies},
+        }
+
+
+def client_options(step):
+    # the test clients encode a json body themselves
+    return {"content_type": step.content_type} if step.content_type else {}
+
+
+class ClientTarget:
+    """
+    The wsgi handler in process, through the test client, a client address
+    per visitor so bans don't spill over
+    """
+
+    counts = True
+
+    def session(self, address):
+        return Client(REMOTE_ADDR=address)
+
+    def send(self, session, step):
+        if step.method == "POST":
+            return session.post(step.path, step.data or {}, **client_options(step))
+        return session.get(step.path, step.data or {})
+
+    def request(self, session, step):
+        response = self.send(session, step)
+        return Response(
+            response.status_code,
+            response.get("Location", ""),
+            response.content.decode(),
+        )
+
+    def run(self, journeys, concurrency, recorder):
+        run_threads(self, journeys, concurrency, recorder)
+
+
+class HTTPTarget:
+    """
+    A server started separately (runserver, gunicorn, uvicorn...) at
+    `base_url`, every visitor comes from this host's address
+    """
+
+    counts = False
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def session(self, address):
+        cookies = CookieJar()
+        opener = build_opener(HTTPCookieProcessor(cookies), _NoRedirect)
+        return opener, cookies
+
+    def request(self, session, step):
+        opener, cookies = session
+        data = None
+        headers = {}
+        if step.content_type == JSON:
+            data = json.dumps(step.data or {})
+            headers["Content-Type"] = JSON
+        elif step.method == "POST":
+            # the csrf cookie is set by the first page of every journey
+            token = next((c.value for c in cookies if c.name == "csrftoken"), "")
+            data = urlencode({**(step.data or {}), "csrfmiddlewaretoken": token})
+        request = Request(
+            urljoin(self.base_url, step.path), data and data.encode(), headers
+        )
+        try:
+            with opener.open(request) as response:
+                return Response(response.status, "", response.read().decode())
+        except HTTPError as error:
+            # redirects and client errors
+            return Response(
+                error.code, error.headers.get("Location", ""), error.read().decode()
+            )
+
+    def run(self, journeys, concurrency, recorder):
+        run_threads(self, journeys, concurrency, recorder)
+
+
+class _NoRedirect(HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class _AddressedAsyncClient(AsyncClient):
+    """
+    The async test client from a given address, the scope's `client`
+    """
+
+    def __init__(self, address, **kwargs):
+        super().__init__(**kwargs)
+        self.address = address
+
+    def _base_scope(self, **request):
+        return {**super()._base_scope(**request), "client": [self.address, 0]}
+
+
+class AsyncTarget:
+    """
+    The asgi handler in process, through the async test client, a task per
+    visitor
+    """
+
+    counts = True
+
+    def session(self, address):
+        return _AddressedAsyncClient(address)
+
+    async def request(self, session, step):
+        if step.method == "POST":
+            response = await session.post(
+                step.path, step.data or {}, **client_options(step)
+            )
+        else:
+            response = await session.get(step.path, step.data or {})
+        return Response(
+            response.status_code,
+            response.get("Location", ""),
+            response.content.decode(),
+        )
+
+    def run(self, journeys, concurrency, recorder):
+        asyncio.run(self._run(journeys, concurrency, recorder))
+
+    async def _run(self, journeys, concurrency, recorder):
+        journeys = iter(journeys)
+
+        async def worker():
+            for kind, address, journey in journeys:
+                ok = await self.drive(self.session(address), journey, recorder)
+                recorder.journey_done(kind, ok)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    async def drive(self, session, journey, recorder):
+        alookup_otp = sync_to_async(lookup_otp)
+        response = None
+        try:
+            while True:
+                action = journey.send(response)
+                if isinstance(action, OTPLookup):
+                    response = await alookup_otp(action.phonenumber)
+                    continue
+                with count_operations() as counts:
+                    start = time.perf_counter()
+                    response = await self.request(session, action)
+                    elapsed = time.perf_counter() - start
+                recorder.record(action, response, elapsed, counts)
+                if action.expect:
+                    expect(action, response)
+        except StopIteration:
+            return True
+        except UnexpectedResponse:
+            journey.close()
+            return False
+
+
+def drive(target, session, journey, recorder):
+    """
+    Send the requests of `journey`, False when a response isn't the expected one
+    """
+    response = None
+    try:
+        while True:
+            action = journey.send(response)
+            if isinstance(action, OTPLookup):
+                response = lookup_otp(action.phonenumber)
+                continue
+            if target.counts:
+                with count_operations() as counts:
+                    start = time.perf_counter()
+                    response = target.request(session, action)
+                    elapsed = time.perf_counter() - start
+            else:
+                counts = None
+                start = time.perf_counter()
+                response = target.request(session, action)
+                elapsed = time.perf_counter() - start
+            recorder.record(action, response, elapsed, counts)
+            if action.expect:
+                expect(action, response)
+    except StopIteration:
+        return True
+    except UnexpectedResponse:
+        journey.close()
+        return False
+
+
+def run_threads(target, journeys, concurrency, recorder):
+    lock = threading.Lock()
+    journeys = iter(journeys)
+
+    def worker():
+        while True:
+            with lock:
+                item = next(journeys, None)
+            if item is None:
+                return
+            kind, address, journey = item
+            ok = drive(target, target.session(address), journey, recorder)
+            recorder.journey_done(kind, ok)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+
+
+def client_address(i):
+    # a /24 per visitor, the subnet limits of `users.banindex` don't join them
+    return f"10.{i >> 8 & 255}.{i & 255}.1"
+
+
+def build_journeys(phonenumbers, password, bad_logins=1, targets=()):
+    """
+    `(kind, client address, journey)` for a user journey per phonenumber and
+    an attacker journey per phonenumber of `targets`, interleaved
+    """
+    users = [
+        ("user", client_address(i), user_journey(phonenumber, password, bad_logins))
+        for i, phonenumber in enumerate(phonenumbers)
+    ]
+    attacks = [
+        ("attacker", client_address(len(users) + i), attacker_journey(phonenumber))
+        for i, phonenumber in enumerate(targets)
+    ]
+    every = max(len(users) // max(len(attacks), 1), 1)
+    journeys = []
+    for i, user in enumerate(users):
+        journeys.append(user)
+        if attacks and i % every == every - 1:
+            journeys.append(attacks.pop())
+    return journeys + attacks
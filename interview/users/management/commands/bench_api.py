@@ -0,0 +1,198 @@
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+from collections import defaultdict
+from functools import partial
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users.instrumentation import uninstall
+from users.loadtest import (ClientTarget, Recorder, api_login_journey,
+                            api_register_journey, client_address,
+                            login_journey, register_journey, run_threads)
+
+from .bench_funnel import PASSWORD, git_commit, isolated
+
+# the html flow logs out at the end of a journey, the api has nothing to
+# compare it with
+SKIPPED_STEPS = {"logout"}
+
+
+class CostTarget(ClientTarget):
+    """
+    `ClientTarget` keeping the cpu time and the bytes of every response
+    """
+
+    def __init__(self):
+        self.cpu = defaultdict(list)
+        self.body_bytes = defaultdict(list)
+        self.header_bytes = defaultdict(list)
+
+    def send(self, session, step):
+        start = time.process_time()
+        response = super().send(session, step)
+        self.cpu[step.name].append(time.process_time() - start)
+        self.body_bytes[step.name].append(len(response.content))
+        self.header_bytes[step.name].append(header_size(response))
+        return response
+
+
+def header_size(response):
+    """
+    The bytes of the status line and headers, cookies included
+    """
+    lines = [f"HTTP/1.1 {response.status_code} {response.reason_phrase}"]
+    lines.extend(f"{name}: {value}" for name, value in response.items())
+    lines.extend(
+        f"Set-Cookie: {cookie.output(header='').strip()}"
+        for cookie in response.cookies.values()
+    )
+    return sum(len(line) + 2 for line in lines) + 2
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the cpu time and the bytes sent per sign up and login of the "
+        "json api with the html flow, in process, and store them as json"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20, help="users per flow")
+        parser.add_argument(
+            "--fast-hashing",
+            action="store_true",
+            help=(
+                "hash with md5 in the request thread, otherwise the hashes run in "
+                "the hashing pool processes, outside of the measured cpu time"
+            ),
+        )
+        parser.add_argument(
+            "--output",
+            help="json file, benchmarks/api-<commit>-<time>.json by default",
+        )
+
+    def handle(self, *args, users, fast_hashing, **options):
+        first = random.randrange(10**7 - 2 * users)
+        phonenumbers = [f"+98912{n:07d}" for n in range(first, first + 2 * users)]
+        flows = {
+            "html": (
+                phonenumbers[:users],
+                register_journey,
+                partial(login_journey, bad_logins=0),
+            ),
+            "api": (phonenumbers[users:], api_register_journey, api_login_journey),
+        }
+        result = {"meta": self.meta(users, fast_hashing), "flows": {}}
+        with tempfile.TemporaryDirectory() as directory:
+            with isolated(directory, fast_hashing):
+                for flow, (numbers, register, login) in flows.items():
+                    result["flows"][flow] = {
+                        "signup": self.measure(
+                            [register(number, PASSWORD) for number in numbers]
+                        ),
+                        "login": self.measure(
+                            [login(number, PASSWORD) for number in numbers]
+                        ),
+                    }
+        self.print_summary(result)
+        path = options["output"] or self.default_output(result["meta"])
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        self.stdout.write(f"results written to {path}")
+
+    def measure(self, journeys):
+        """
+        The costs of `journeys`, one at a time so the cpu time is theirs alone
+        """
+        target = CostTarget()
+        recorder = Recorder()
+        recorder.start()
+        try:
+            run_threads(
+                target,
+                [("user", client_address(i), j) for i, j in enumerate(journeys)],
+                1,
+                recorder,
+            )
+        finally:
+            recorder.stop()
+            uninstall()
+        summary = recorder.summary()
+        steps = {}
+        for name, step in summary["steps"].items():
+            if name in SKIPPED_STEPS:
+                continue
+            n = len(target.cpu[name])
+            steps[name] = {
+                "requests": n,
+                "errors": step["errors"],
+                "cpu_ms": round(sum(target.cpu[name]) / n * 1000, 3),
+                "body_bytes": round(sum(target.body_bytes[name]) / n),
+                "header_bytes": round(sum(target.header_bytes[name]) / n),
+                "latency_ms": step["latency_ms"],
+                "operations": step["operations"],
+            }
+        completed = len(journeys)
+        # per journey, the sum of its steps
+        return {
+            "journeys": summary["journeys"],
+            "requests": round(sum(s["requests"] for s in steps.values()) / completed),
+            "cpu_ms": round(
+                sum(s["cpu_ms"] * s["requests"] for s in steps.values()) / completed, 3
+            ),
+            "bytes": round(
+                sum(
+                    (s["body_bytes"] + s["header_bytes"]) * s["requests"]
+                    for s in steps.values()
+                )
+                / completed
+            ),
+            "steps": steps,
+        }
+
+    def meta(self, users, fast_hashing):
+        return {
+            "commit": git_commit(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "async_views": settings.USERS_ASYNC_VIEWS,
+            "users": users,
+            "fast_hashing": fast_hashing,
+            "python": platform.python_version(),
+            "django": django.get_version(),
+        }
+
+    def default_output(self, meta):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(
+            settings.BASE_DIR, "benchmarks", f"api-{meta['commit']}-{stamp}.json"
+        )
+
+    def print_summary(self, result):
+        self.stdout.write(
+            f"{'flow':<6} {'journey':<8} {'requests':>8} {'cpu ms':>8} {'bytes':>7}"
+        )
+        for flow, journeys in result["flows"].items():
+            for name, journey in journeys.items():
+                self.stdout.write(
+                    f"{flow:<6} {name:<8} {journey['requests']:>8} "
+                    f"{journey['cpu_ms']:>8.2f} {journey['bytes']:>7}"
+                )
+        self.stdout.write(
+            f"\n{'step':<22} {'n':>4} {'err':>4} {'cpu ms':>8} {'body':>6} "
+            f"{'headers':>7} {'queries':>8}"
+        )
+        for journeys in result["flows"].values():
+            for journey in journeys.values():
+                for name, step in journey["steps"].items():
+                    ops = step["operations"] or {}
+                    self.stdout.write(
+                        f"{name:<22} {step['requests']:>4} {step['errors']:>4} "
+                        f"{step['cpu_ms']:>8.2f} {step['body_bytes']:>6} "
+                        f"{step['header_bytes']:>7} {ops.get('queries', '-'):>8}"
+                    )
@@ -0,0 +1,228 @@
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import (override_settings, setup_databases,
+                               teardown_databases)
+
+from users.attempts import MAX_ATTEMPS
+from users.instrumentation import uninstall
+from users.loadtest import (AsyncTarget, ClientTarget, HTTPTarget, Recorder,
+                            build_journeys)
+from users.membership import get_username_index
+
+FAST_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+PASSWORD = "Unguessable-4821"
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the check, otp, register and login funnel with concurrent "
+        "visitors and store latency percentiles, throughput and per request "
+        "queries and cache calls as json"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--target",
+            choices=["client", "asgi", "http"],
+            default="client",
+            help=(
+                "client: the wsgi handler in process, asgi: the asgi handler in "
+                "process (with the async views when USERS_ASYNC_VIEWS=1), http: a "
+                "server started separately at --url"
+            ),
+        )
+        parser.add_argument(
+            "--url",
+            default="http://127.0.0.1:8000/",
+            help="the server for --target http, using this project's database",
+        )
+        parser.add_argument("--users", type=int, default=20, help="user journeys")
+        parser.add_argument(
+            "--attackers", type=int, default=5, help="attacker journeys"
+        )
+        parser.add_argument(
+            "--bad-logins",
+            type=int,
+            default=1,
+            help="wrong passwords before the right one, per user journey",
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=4, help="visitors at a time"
+        )
+        parser.add_argument(
+            "--fast-hashing",
+            action="store_true",
+            help="hash with md5 to measure everything but the hashing, in process",
+        )
+        parser.add_argument(
+            "--output",
+            help="json file, benchmarks/funnel-<commit>-<time>.json by default",
+        )
+        parser.add_argument(
+            "--compare", help="a previous json result to compare the steps with"
+        )
+
+    def handle(self, *args, target, users, attackers, bad_logins, **options):
+        if bad_logins >= MAX_ATTEMPS:
+            raise CommandError(
+                f"--bad-logins must stay under {MAX_ATTEMPS}, the user would be banned"
+            )
+        if target == "http" and (attackers or bad_logins):
+            # every visitor has this host's address, the first ban would stop all
+            self.stderr.write(
+                "a separate server sees a single client address, "
+                "running without wrong passwords nor attackers"
+            )
+            attackers = bad_logins = 0
+        # phonenumbers of this run, a random block so runs against a kept
+        # database don't collide
+        first = random.randrange(10**7 - users - attackers)
+        phonenumbers = [
+            f"+98912{n:07d}" for n in range(first, first + users + attackers)
+        ]
+        journeys = build_journeys(
+            phonenumbers[:users], PASSWORD, bad_logins, phonenumbers[users:]
+        )
+        recorder = Recorder()
+        if target == "http":
+            self.run(HTTPTarget(options["url"]), journeys, options, recorder)
+        else:
+            run_target = AsyncTarget() if target == "asgi" else ClientTarget()
+            with tempfile.TemporaryDirectory() as directory:
+                with isolated(directory, options["fast_hashing"]):
+                    self.run(run_target, journeys, options, recorder)
+        result = {
+            "meta": self.meta(target, users, attackers, bad_logins, options),
+            **recorder.summary(),
+        }
+        self.print_summary(result)
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                self.print_comparison(json.load(f), result)
+        path = options["output"] or self.default_output(result["meta"])
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        self.stdout.write(f"results written to {path}")
+
+    def run(self, target, journeys, options, recorder):
+        recorder.start()
+        try:
+            target.run(journeys, options["concurrency"], recorder)
+        finally:
+            recorder.stop()
+            uninstall()
+
+    def meta(self, target, users, attackers, bad_logins, options):
+        return {
+            "commit": git_commit(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "target": target,
+            "url": options["url"] if target == "http" else None,
+            "async_views": settings.USERS_ASYNC_VIEWS,
+            "users": users,
+            "attackers": attackers,
+            "bad_logins": bad_logins,
+            "concurrency": options["concurrency"],
+            "fast_hashing": options["fast_hashing"],
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "cpus": os.cpu_count(),
+        }
+
+    def default_output(self, meta):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(
+            settings.BASE_DIR, "benchmarks", f"funnel-{meta['commit']}-{stamp}.json"
+        )
+
+    def print_summary(self, result):
+        self.stdout.write(
+            f"{result['overall']['requests']} requests in {result['elapsed_s']}s, "
+            f"{result['throughput_rps']} requests/s, journeys {result['journeys']}"
+        )
+        self.stdout.write(
+            f"{'step':<20} {'n':>5} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} "
+            f"{'p99 ms':>8} {'queries':>8} {'cache':>6} {'bans':>5} {'hashes':>6}"
+        )
+        for name, step in [*result["steps"].items(), ("overall", result["overall"])]:
+            latency = step["latency_ms"]
+            ops = step["operations"] or {}
+            self.stdout.write(
+                f"{name:<20} {step['requests']:>5} {step['errors']:>4} "
+                f"{latency['p50']:>8.1f} {latency['p95']:>8.1f} "
+                f"{latency['p99']:>8.1f} {ops.get('queries', '-'):>8} "
+                f"{ops.get('cache', '-'):>6} {ops.get('ban_table', '-'):>5} "
+                f"{ops.get('hashes', '-'):>6}"
+            )
+
+    def print_comparison(self, before, after):
+        self.stdout.write(
+            f"compared with {before['meta']['commit']} ({before['meta']['date']})"
+        )
+        self.stdout.write(f"{'step':<20} {'p95 ms':>17} {'queries':>13} {'cache':>13}")
+        for name, step in after["steps"].items():
+            old = before["steps"].get(name)
+            if not old:
+                continue
+            old_ops = old["operations"] or {}
+            ops = step["operations"] or {}
+            self.stdout.write(
+                f"{name:<20} "
+                f"{old['latency_ms']['p95']:>8.1f}->{step['latency_ms']['p95']:<8.1f}"
+                f"{old_ops.get('queries', '-')!s:>6}->{ops.get('queries', '-')!s:<6}"
+                f"{old_ops.get('cache', '-')!s:>6}->{ops.get('cache', '-')!s:<6}"
+            )
+
+
+@contextmanager
+def isolated(directory, fast_hashing):
+    """
+    A test database on disk, so threads can share it, and a username index,
+    ban table and metrics of their own for the in process targets
+    """
+    overrides = {
+        "USERS_USERNAME_INDEX": {"PATH": f"{directory}/usernames"},
+        "USERS_BAN_TABLE": {"PATH": f"{directory}/bans"},
+        "USERS_METRICS": {"DIR": f"{directory}/metrics"},
+    }
+    if fast_hashing:
+        overrides["PASSWORD_HASHERS"] = FAST_HASHERS
+    with override_settings(**overrides):
+        test_settings = connections["default"].settings_dict["TEST"]
+        # put back once done, the directory is deleted
+        test_name = test_settings["NAME"]
+        test_settings["NAME"] = f"{directory}/db.sqlite3"
+        try:
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                get_username_index().rebuild([])
+                yield
+            finally:
+                teardown_databases(old_config, verbosity=0)
+        finally:
+            test_settings["NAME"] = test_name
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
@@ -0,0 +1,66 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from users.hashing import HashingService, PooledPBKDF2PasswordHasher
+
+
+class Command(BaseCommand):
+    help = "Measure password hashing throughput per number of hashing pool workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hashes", type=int, help="hashes per run, 4 per core by default"
+        )
+        parser.add_argument(
+            "--iterations",
+            type=int,
+            default=PooledPBKDF2PasswordHasher.iterations,
+            help="pbkdf2 iterations per hash",
+        )
+        parser.add_argument(
+            "--max-workers", type=int, default=os.cpu_count() or 1, help="largest pool"
+        )
+
+    def handle(self, *args, hashes, iterations, max_workers, **options):
+        hashes = hashes or 4 * max_workers
+        # 0 is the stock inline hasher, then doubling pool sizes up to max_workers
+        sizes = [0] + sorted(
+            {min(2**i, max_workers) for i in range(max_workers.bit_length() + 1)}
+        )
+        self.stdout.write(f"{hashes} hashes of {iterations} iterations per run")
+        self.stdout.write(
+            f"{'workers':>8} {'seconds':>8} {'hashes/s':>10} {'speedup':>8}"
+        )
+        baseline = None
+        for workers in sizes:
+            service = HashingService(workers=workers, queue=hashes, timeout=None)
+            # start the pool processes outside of the measurement
+            service.pbkdf2("warmup", "salt", 1, "sha256")
+            elapsed = self.run(service, hashes, iterations)
+            service.shutdown()
+            rate = hashes / elapsed
+            baseline = baseline or rate
+            self.stdout.write(
+                f"{workers or 'inline':>8} {elapsed:>8.2f} {rate:>10.1f} "
+                f"{rate / baseline:>7.2f}x"
+            )
+
+    def run(self, service, hashes, iterations):
+        """
+        Hash `hashes` passwords, inline from a single thread like one sync worker,
+        or from one caller thread per hash like concurrent requests
+        """
+        callers = hashes if service.workers else 1
+        passwords = [f"password{i}" for i in range(hashes)]
+        with ThreadPoolExecutor(max_workers=callers) as executor:
+            start = time.perf_counter()
+            futures = [
+                executor.submit(service.pbkdf2, password, "salt", iterations, "sha256")
+                for password in passwords
+            ]
+            for future in futures:
+                future.result()
+            return time.perf_counter() - start
@@ -0,0 +1,69 @@
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.shortcuts import render
+from django.test import RequestFactory
+from django.utils.text import compress_string
+
+from users.forms import (LoginForm, OTPForm, PhonenumberForm, RegisterInfoForm,
+                         RegisterPasswordForm)
+from users.rendering import render_page
+
+# the GET pages of the flow, with the context their views pass
+PAGES = {
+    "check": ("users/phonenumber.html", lambda: {"form": PhonenumberForm}),
+    "login": (
+        "users/login.html",
+        lambda: {"form": LoginForm(initial={"username": "+989121234567"})},
+    ),
+    "register": (
+        "users/register.html",
+        lambda: {"form": OTPForm(initial={"otp_cache_key": "67a1b2c3Xk9sQw2LmZpT"})},
+    ),
+    "register_info": ("users/register_info.html", lambda: {"form": RegisterInfoForm}),
+    "register_password": (
+        "users/register_password.html",
+        lambda: {"form": RegisterPasswordForm},
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the render time and the bytes of the form pages through "
+        "`render` and through the page cache of `users.rendering`"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--renders", type=int, default=1000, help="renders per page and path"
+        )
+
+    def handle(self, *args, renders, **options):
+        factory = RequestFactory()
+        self.stdout.write(
+            f"{'page':<18} {'render ms':>10} {'cached ms':>10} {'speedup':>8} "
+            f"{'bytes':>6} {'gzip':>6}"
+        )
+        for name, (template_name, context) in PAGES.items():
+            timings = []
+            for path in (render, render_page):
+                # compiles the template, or the page, outside of the measurement
+                path(self.request(factory), template_name, context())
+                start = time.perf_counter()
+                for _ in range(renders):
+                    response = path(self.request(factory), template_name, context())
+                timings.append((time.perf_counter() - start) / renders * 1000)
+            self.stdout.write(
+                f"{name:<18} {timings[0]:>10.3f} {timings[1]:>10.3f} "
+                f"{timings[0] / timings[1]:>7.1f}x {len(response.content):>6} "
+                f"{len(compress_string(response.content)):>6}"
+            )
+        self.stdout.write("a revalidated GET of an unchanged page is a 304, 0 bytes")
+
+    @staticmethod
+    def request(factory):
+        request = factory.get("/", REMOTE_ADDR="203.0.113.7")
+        request.user = AnonymousUser()
+        return request
@@ -0,0 +1,61 @@
+import secrets
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from users.membership import get_username_index, registered_usernames
+
+
+class Command(BaseCommand):
+    help = (
+        "Check the registered username index against the user table: every "
+        "username must be in it, and measure its false positive rate"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repair", action="store_true", help="add the missing usernames"
+        )
+        parser.add_argument(
+            "--probes",
+            type=int,
+            default=10000,
+            help="unregistered usernames looked up to measure false positives",
+        )
+
+    def handle(self, *args, repair, probes, **options):
+        index = get_username_index()
+        stats = index.stats()
+        if not stats["ready"]:
+            raise CommandError(
+                "the index isn't built, every lookup goes to the database, "
+                "run manage.py rebuild_username_index"
+            )
+        missing = [u for u in registered_usernames() if not index.might_contain(u)]
+        probed = [secrets.token_hex(8) for _ in range(probes)]
+        registered = set(
+            get_user_model().objects.filter(username__in=probed).values_list(
+                "username", flat=True
+            )
+        )
+        false_positives = sum(
+            index.might_contain(u) for u in probed if u not in registered
+        )
+        for name, value in stats.items():
+            self.stdout.write(f"{name:>20} {value}")
+        self.stdout.write(
+            f"{'measured fp rate':>20} {false_positives / max(probes, 1):.4f}"
+        )
+        self.stdout.write(f"{'missing':>20} {len(missing)}")
+        if stats["added"] > stats["capacity"]:
+            self.stderr.write("over capacity, raise CAPACITY and rebuild")
+        if stats["deleted"] > stats["added"] // 10:
+            self.stderr.write("over 10% deleted usernames, rebuild to drop them")
+        if missing:
+            if not repair:
+                raise CommandError(
+                    f"{len(missing)} registered usernames are missing, these users "
+                    "are sent to registration, rebuild or run with --repair"
+                )
+            index.add(*missing)
+            self.stdout.write(f"added {len(missing)} missing usernames")
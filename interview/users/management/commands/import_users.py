@@ -0,0 +1,70 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.importing import (Checkpoint, ImportStats, UserImporter, clean_rows,
+                             read_rows)
+
+
+class Command(BaseCommand):
+    help = (
+        "Import users from a csv or jsonl file of phonenumbers, with optional "
+        "password, first_name, last_name and email, resuming an interrupted import"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="csv file with a header, or jsonl")
+        parser.add_argument(
+            "--format", choices=["csv", "jsonl"], help="by the file extension"
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=1000, help="users per transaction"
+        )
+        parser.add_argument(
+            "--workers", type=int, help="password hashing processes, one per core"
+        )
+        parser.add_argument(
+            "--checkpoint", help="progress file, <path>.checkpoint by default"
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="ignore the checkpoint and import from the first row",
+        )
+
+    def handle(self, *args, path, format, chunk_size, workers, restart, **options):
+        if not os.path.isfile(path):
+            raise CommandError(f"no such file: {path}")
+        checkpoint = Checkpoint(options["checkpoint"] or f"{path}.checkpoint", path)
+        progress = None if restart else checkpoint.load()
+        stats = ImportStats(**(progress or {}))
+        if progress:
+            self.stdout.write(f"resuming after row {stats.read}")
+        importer = UserImporter(
+            chunk_size=chunk_size,
+            workers=workers,
+            checkpoint=checkpoint,
+            report=self.report,
+        )
+        rows = clean_rows(read_rows(path, format, skip=stats.read), stats)
+        try:
+            importer.run(rows, stats)
+        except KeyboardInterrupt:
+            progress = checkpoint.load()
+            raise CommandError(
+                f"interrupted, run again to resume after row {progress['read']}"
+                if progress
+                else "interrupted before the first chunk was committed"
+            )
+        checkpoint.delete()
+        self.stdout.write(
+            json.dumps({**stats.as_dict(), "rows_per_second": stats.rate()})
+        )
+
+    def report(self, stats):
+        self.stdout.write(
+            f"{stats.read} rows, {stats.imported} imported, "
+            f"{stats.duplicate + stats.conflicts} duplicate, {stats.invalid} invalid, "
+            f"{stats.rate():.0f} rows/s"
+        )
@@ -0,0 +1,95 @@
+import io
+import pstats
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.profiling import EXTENSIONS, get_profile_dir, profile_token, profile_view
+
+
+class Command(BaseCommand):
+    help = (
+        "Aggregate the request profiles of ProfilingMiddleware into the top "
+        "functions per view"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dir", help="the profiles, USERS_PROFILING's DIR by default"
+        )
+        parser.add_argument(
+            "--view",
+            action="append",
+            dest="views",
+            help="only these views, e.g. login_user",
+        )
+        parser.add_argument("--limit", type=int, default=20, help="functions per view")
+        parser.add_argument(
+            "--sort",
+            choices=["cumulative", "tottime"],
+            default="cumulative",
+            help="time in and under a function, or in the function itself",
+        )
+        parser.add_argument(
+            "--token",
+            action="store_true",
+            help="print a header value that gets a request profiled, for an hour",
+        )
+
+    def handle(self, *args, views, limit, sort, token, **options):
+        if token:
+            self.stdout.write(profile_token())
+            return
+        directory = options["dir"] or get_profile_dir()
+        profiles = defaultdict(lambda: defaultdict(list))
+        for extension in EXTENSIONS.values():
+            for path in sorted(Path(directory).glob(f"*{extension}")):
+                view = profile_view(path)
+                if not views or view in views:
+                    profiles[view][extension].append(path)
+        if not profiles:
+            raise CommandError(f"no profiles in {directory}")
+        for view, files in sorted(profiles.items()):
+            if files[EXTENSIONS["cprofile"]]:
+                self.report_cprofile(view, files[EXTENSIONS["cprofile"]], sort, limit)
+            if files[EXTENSIONS["sample"]]:
+                self.report_samples(view, files[EXTENSIONS["sample"]], sort, limit)
+
+    def report_cprofile(self, view, paths, sort, limit):
+        self.stdout.write(self.style.MIGRATE_HEADING(f"{view}, {len(paths)} profiles"))
+        stream = io.StringIO()
+        stats = pstats.Stats(*map(str, paths), stream=stream)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        self.stdout.write(stream.getvalue())
+
+    def report_samples(self, view, paths, sort, limit):
+        """
+        Samples a function was on top of the stack (tottime) or anywhere in
+        it (cumulative)
+        """
+        own = Counter()
+        anywhere = Counter()
+        total = 0
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    stack, _, samples = line.rstrip("\n").rpartition(" ")
+                    samples = int(samples)
+                    frames = stack.split(";")
+                    total += samples
+                    own[frames[-1]] += samples
+                    for frame in set(frames):
+                        anywhere[frame] += samples
+        self.stdout.write(
+            self.style.MIGRATE_HEADING(
+                f"{view}, {len(paths)} sampled profiles, {total} samples"
+            )
+        )
+        self.stdout.write(f"{'own':>7} {'anywhere':>9}  function")
+        ranked = own if sort == "tottime" else anywhere
+        for frame, _ in ranked.most_common(limit):
+            self.stdout.write(
+                f"{own[frame] / total:>7.1%} {anywhere[frame] / total:>9.1%}  {frame}"
+            )
+        self.stdout.write("")
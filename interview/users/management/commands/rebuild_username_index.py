@@ -0,0 +1,21 @@
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from users.membership import get_username_index, registered_usernames
+
+
+class Command(BaseCommand):
+    help = "Rebuild the registered username index from the user table"
+
+    def handle(self, *args, **options):
+        index = get_username_index()
+        start = time.perf_counter()
+        added = index.rebuild(registered_usernames())
+        self.stdout.write(
+            f"indexed {added} usernames in {time.perf_counter() - start:.2f}s "
+            f"({index.path})"
+        )
+        # users committed while the table was being read are caught up here
+        call_command("check_username_index", repair=True, stdout=self.stdout)
@@ -0,0 +1,58 @@
+import json
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from users.sms import SMSDispatcher
+
+
+class Command(BaseCommand):
+    help = "Send the queued text messages through the configured sms gateway"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, help="concurrent gateway calls")
+        parser.add_argument("--batch-size", type=int, help="messages per gateway call")
+        parser.add_argument(
+            "--once", action="store_true", help="exit once nothing is due"
+        )
+        parser.add_argument(
+            "--stats-interval",
+            type=float,
+            default=60,
+            help="seconds between stats reports, 0 disables them",
+        )
+
+    def handle(self, *args, workers, batch_size, once, stats_interval, **options):
+        overrides = {}
+        if workers:
+            overrides["WORKERS"] = workers
+        if batch_size:
+            overrides["BATCH_SIZE"] = batch_size
+        dispatcher = SMSDispatcher(**overrides)
+
+        if once:
+            dispatcher.run_once()
+            self.report(dispatcher)
+            return
+
+        signal.signal(signal.SIGTERM, lambda *_: dispatcher.stop())
+        if stats_interval:
+            reporter = threading.Thread(
+                target=self.report_every,
+                args=(dispatcher, stats_interval),
+                daemon=True,
+            )
+            reporter.start()
+        try:
+            dispatcher.run_forever()
+        except KeyboardInterrupt:
+            dispatcher.stop()
+        self.report(dispatcher)
+
+    def report_every(self, dispatcher, interval):
+        while not dispatcher._stop.wait(interval):
+            self.report(dispatcher)
+
+    def report(self, dispatcher):
+        self.stdout.write(json.dumps(dispatcher.stats.summary()))
@@ -0,0 +1,100 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# run in a fresh interpreter, boots the wsgi application like a new worker and
+# times its first requests
+FIRST_REQUESTS = """
+import json, sys, time
+start = time.perf_counter()
+from interview.wsgi import application
+boot = time.perf_counter() - start
+from django.test import RequestFactory
+timings = []
+for _ in range(int(sys.argv[2])):
+    environ = RequestFactory().get(sys.argv[1], HTTP_HOST="localhost").environ
+    start = time.perf_counter()
+    response = application(environ, lambda status, headers: None)
+    b"".join(response)
+    response.close()
+    timings.append(time.perf_counter() - start)
+print(json.dumps({"boot": boot, "requests": timings}))
+"""
+
+# the import of the application and its urlconf, as a first request does it
+IMPORTS = """
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Report per module import time and the latency of the first requests of "
+        "a fresh worker, cold and warmed up (USERS_WARM_UP)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", default="/check/", help="path requested")
+        parser.add_argument(
+            "--requests", type=int, default=3, help="requests per fresh worker"
+        )
+        parser.add_argument(
+            "--modules", type=int, default=15, help="slowest modules to list"
+        )
+
+    def handle(self, *args, path, requests, modules, **options):
+        self.report_imports(modules)
+        self.stdout.write("")
+        self.stdout.write(f"first {requests} requests to {path} of a fresh worker")
+        header = [f"{'boot':>9}"] + [f"{f'#{i + 1}':>9}" for i in range(requests)]
+        self.stdout.write(f"{'':>6} " + " ".join(header))
+        for label, warm_up in [("cold", "0"), ("warm", "1")]:
+            result = json.loads(
+                self.run_child(
+                    ["-c", FIRST_REQUESTS, path, str(requests)],
+                    USERS_WARM_UP=warm_up,
+                ).stdout
+            )
+            self.stdout.write(
+                f"{label:>6} {result['boot'] * 1000:>7.1f}ms "
+                + " ".join(f"{t * 1000:>7.1f}ms" for t in result["requests"])
+            )
+
+    def report_imports(self, limit):
+        """
+        The slowest modules of the urlconf import, from `python -X importtime`
+        """
+        stderr = self.run_child(["-X", "importtime", "-c", IMPORTS]).stderr
+        rows = []
+        for line in stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            own, cumulative, name = line[len("import time:") :].split("|")
+            if not own.strip().isdigit():
+                # the header
+                continue
+            rows.append((int(own), int(cumulative), name.strip()))
+        total = sum(own for own, _, _ in rows)
+        self.stdout.write(f"{len(rows)} modules imported in {total / 1000:.1f}ms")
+        self.stdout.write(f"{'self':>9} {'cumulative':>11}  module")
+        for own, cumulative, name in sorted(rows, reverse=True)[:limit]:
+            self.stdout.write(
+                f"{own / 1000:>7.1f}ms {cumulative / 1000:>9.1f}ms  {name}"
+            )
+
+    def run_child(self, args, **env):
+        return subprocess.run(
+            [sys.executable, *args],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, **env},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
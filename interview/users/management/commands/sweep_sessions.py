@@ -0,0 +1,57 @@
+import json
+import signal
+
+from django.core.management.base import BaseCommand
+
+from users.sweeper import SessionSweeper
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the expired sessions in small batches, and the expired otp, ban "
+        "and wizard records of the caches"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="sessions per transaction")
+        parser.add_argument("--pause", type=float, help="seconds between batches")
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="scan from the oldest session instead of the saved progress",
+        )
+        parser.add_argument(
+            "--no-caches", action="store_true", help="leave the caches alone"
+        )
+        parser.add_argument(
+            "--forever",
+            action="store_true",
+            help="sweep again every USERS_SWEEPER['INTERVAL'] seconds",
+        )
+
+    def handle(self, *args, batch_size, pause, restart, no_caches, forever, **options):
+        overrides = {}
+        if batch_size:
+            overrides["BATCH_SIZE"] = batch_size
+        if pause is not None:
+            overrides["PAUSE"] = pause
+        if no_caches:
+            overrides["PURGE_CACHES"] = False
+        sweeper = SessionSweeper(**overrides)
+
+        if not forever:
+            self.report(sweeper.sweep(restart=restart))
+            return
+
+        # stops after the batch running, the next run resumes there
+        signal.signal(signal.SIGTERM, lambda *_: sweeper.stop())
+        try:
+            sweeper.run_forever(report=self.report)
+        except KeyboardInterrupt:
+            sweeper.stop()
+
+    def report(self, stats):
+        if stats is None:
+            self.stderr.write("another process is sweeping")
+            return
+        self.stdout.write(json.dumps(stats))
@@ -0,0 +1,377 @@
+"""
+Registered username index
+
+`check_phonenumber` only has to tell registered phonenumbers from new ones,
+and in sign up campaigns most of them are new. `UsernameIndex` is a bloom
+filter over the registered usernames in a memory mapped file shared by every
+worker on the host, like the ban table: a miss means the username is
+definitely not registered and the database isn't queried at all, a hit is
+confirmed with an `exists()` query.
+
+new usernames are added by the `post_save` signal of the user model before
+the row is committed, so the index never misses a registered user created
+through the orm. deleted users stay in the filter and only cost a query.
+
+the index is not ready until it has been built from the database
+(`manage.py rebuild_username_index`, or `warm_up`), until then every lookup
+goes to the database. the file holds two filters: lookups read the active one
+while a rebuild fills the other from the database, and the rebuild makes it
+the active one when it is done. usernames added during the rebuild go to both,
+so one added before its row was committed, and missed by the rebuild's query,
+is never lost.
+
+users written without signals, by another host with its own index, a
+`QuerySet.update()` or a migration, are missed until a rebuild (`manage.py
+check_username_index` tells when one is due, `invalidate` sends every lookup
+to the database until then). so a miss only skips the query of the login
+lookup: the sign up steps confirm it with `username_exists(...,
+confirm_miss=True)` before they text an otp, and `provision_user` adds a
+username it finds taken, a registered user is always sent to log in.
+
+configured with `USERS_USERNAME_INDEX = {"PATH": ..., "CAPACITY": ...,
+"ERROR_RATE": ...}`.
+"""
+
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+
+from .database import read_from_replica
+from .directory import get_user_directory
+from .runtime import private_tempdir
+
+MAGIC = b"UBAARBLM"
+VERSION = 2
+# magic, version, hashes per key, bits
+HEADER = struct.Struct("<8sIIQ")
+# ready, added, deleted, the active filter, whether a rebuild fills the other
+STATE = struct.Struct("<IQQII")
+# the bits start on their own cache line
+DATA = 64
+
+DEFAULT_CAPACITY = 1_000_000
+DEFAULT_ERROR_RATE = 0.01
+REBUILD_BATCH = 1000
+
+
+def bloom_size(capacity, error_rate):
+    """
+    Bits and hashes per key of a bloom filter holding `capacity` keys with a
+    false positive rate of `error_rate`
+    """
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(round(bits / capacity * math.log(2)), 1)
+    return bits, hashes
+
+
+class UsernameIndex:
+    """
+    Bloom filter of usernames in a memory mapped file shared by all the processes
+    opening `path`
+    """
+
+    def __init__(
+        self, path, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE
+    ):
+        self.path = path
+        self.capacity = capacity
+        self.bits, self.hashes = bloom_size(capacity, error_rate)
+        self.filter_size = -(-self.bits // 8)
+        self.size = DATA + 2 * self.filter_size
+        self._pid = None
+        self._open_lock = threading.Lock()
+
+    def _open(self):
+        """
+        Map the file, once per process
+        """
+        if self._pid == os.getpid():
+            return
+        with self._open_lock:
+            if self._pid != os.getpid():
+                self._map()
+
+    def _map(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+            buffer = mmap.mmap(fd, self.size)
+            if HEADER.unpack_from(buffer) != (
+                MAGIC,
+                VERSION,
+                self.hashes,
+                self.bits,
+            ):
+                # new or differently sized index, not ready until rebuilt
+                buffer[:] = bytes(self.size)
+                HEADER.pack_into(buffer, 0, MAGIC, VERSION, self.hashes, self.bits)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._buffer = buffer
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _positions(self, key):
+        # double hashing, `hashes` positions out of two 64 bit hashes
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _locked(self):
+        # writes to the bits and the state
+        return _FileLock(self, self._lock, 0)
+
+    def _rebuilding(self):
+        # held for a whole rebuild, so rebuilds don't interleave
+        return _FileLock(self, self._rebuild_lock, 1)
+
+    def _state(self):
+        return STATE.unpack_from(self._buffer, HEADER.size)
+
+    def _set_state(self, ready, added, deleted, active, rebuilding):
+        STATE.pack_into(
+            self._buffer, HEADER.size, ready, added, deleted, active, rebuilding
+        )
+
+    def _start(self, which):
+        # where filter 0 or 1 starts in the file
+        return DATA + which * self.filter_size
+
+    def _set_bits(self, keys, which):
+        buffer, start = self._buffer, self._start(which)
+        for key in keys:
+            for position in self._positions(key):
+                buffer[start + (position >> 3)] |= 1 << (position & 7)
+
+    @property
+    def ready(self):
+        self._open()
+        return bool(self._state()[0])
+
+    def might_contain(self, key):
+        """
+        False if `key` was definitely never added, True if it may have been
+        or the index isn't built yet
+        """
+        self._open()
+        buffer = self._buffer
+        ready, _, _, active, _ = self._state()
+        if not ready:
+            return True
+        # a rebuild switching filters meanwhile leaves this one as is
+        start = self._start(active)
+        for position in self._positions(key):
+            if not buffer[start + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, *keys):
+        """
+        Add `keys`, a bit is only ever set so concurrent lookups stay correct
+        """
+        self._open()
+        with self._locked():
+            ready, added, deleted, active, rebuilding = self._state()
+            self._set_bits(keys, active)
+            if rebuilding:
+                # the rebuild's query may not see them yet
+                self._set_bits(keys, 1 - active)
+            self._set_state(ready, added + len(keys), deleted, active, rebuilding)
+
+    def discard(self, *keys):
+        """
+        Bits of a bloom filter can't be cleared, only count the stale keys so
+        `stats` tells when a rebuild is due
+        """
+        self._open()
+        with self._locked():
+            ready, added, deleted, active, rebuilding = self._state()
+            self._set_state(ready, added, deleted + len(keys), active, rebuilding)
+
+    def invalidate(self):
+        """
+        Not ready until rebuilt, after usernames were written without signals
+        """
+        self._open()
+        with self._locked():
+            _, added, deleted, active, rebuilding = self._state()
+            self._set_state(0, added, deleted, active, rebuilding)
+
+    def rebuild(self, keys, force=True):
+        """
+        Rebuild the index from `keys`, an iterable of every registered username,
+        into the inactive filter, lookups use the active one meanwhile and keys
+        added meanwhile go to both
+        without `force` an index another process has built meanwhile is kept
+        """
+        self._open()
+        with self._rebuilding():
+            if not force and self.ready:
+                return self._state()[1]
+            with self._locked():
+                ready, added_before, deleted_before, active, _ = self._state()
+                building = 1 - active
+                start = self._start(building)
+                self._buffer[start : start + self.filter_size] = bytes(
+                    self.filter_size
+                )
+                self._set_state(ready, added_before, deleted_before, active, 1)
+            rebuilt = 0
+            for batch in _batches(keys, REBUILD_BATCH):
+                with self._locked():
+                    self._set_bits(batch, building)
+                rebuilt += len(batch)
+            with self._locked():
+                ready, added, deleted, active, _ = self._state()
+                # what was added and deleted during the rebuild still counts
+                added = rebuilt + added - added_before
+                self._set_state(1, added, deleted - deleted_before, building, 0)
+            return added
+
+    def stats(self):
+        """
+        Occupancy of the filter and its expected false positive rate
+        """
+        self._open()
+        ready, added, deleted, active, _ = self._state()
+        start = self._start(active)
+        set_bits = int.from_bytes(
+            self._buffer[start : start + self.filter_size], "little"
+        ).bit_count()
+        return {
+            "ready": bool(ready),
+            "bytes": self.size,
+            "bits": self.bits,
+            "hashes": self.hashes,
+            "capacity": self.capacity,
+            "added": added,
+            "deleted": deleted,
+            "fill_ratio": set_bits / self.bits,
+            "false_positive_rate": (set_bits / self.bits) ** self.hashes,
+        }
+
+
+def _batches(keys, size):
+    batch = []
+    for key in keys:
+        batch.append(key)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _FileLock:
+    """
+    Lock one byte of the index file for this thread and this process
+    """
+
+    def __init__(self, index, lock, byte):
+        self.index = index
+        self.lock = lock
+        self.byte = byte
+
+    def __enter__(self):
+        self.lock.acquire()
+        fcntl.lockf(self.index._fd, fcntl.LOCK_EX, 1, self.byte)
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self.index._fd, fcntl.LOCK_UN, 1, self.byte)
+        self.lock.release()
+
+
+def default_index_path():
+    # one index per database, the test database gets its own
+    database = connection.settings_dict["NAME"]
+    name = hashlib.blake2b(
+        f"{settings.BASE_DIR}:{database}".encode(), digest_size=6
+    ).hexdigest()
+    return os.path.join(private_tempdir(), f"ubaar-usernames-{name}")
+
+
+_index = None
+
+
+def get_username_index():
+    global _index
+    options = getattr(settings, "USERS_USERNAME_INDEX", {})
+    path = options.get("PATH") or default_index_path()
+    if _index is None or _index.path != path:
+        _index = UsernameIndex(
+            path,
+            capacity=options.get("CAPACITY", DEFAULT_CAPACITY),
+            error_rate=options.get("ERROR_RATE", DEFAULT_ERROR_RATE),
+        )
+    return _index
+
+
+def reset_username_index(**kwargs):
+    global _index
+    _index = None
+
+
+def registered_usernames():
+    return (
+        get_user_model()
+        .objects.order_by()
+        .values_list("username", flat=True)
+        .iterator(chunk_size=REBUILD_BATCH)
+    )
+
+
+def username_exists(username, confirm_miss=False):
+    """
+    Whether a user is registered with `username`, without a query when the
+    index knows it isn't, the user directory loads what the login that usually
+    follows needs in the same query
+    with `confirm_miss` a miss is queried too, on the primary since a replica
+    may lag, and a user found is added to the index
+    """
+    if not get_username_index().might_contain(username):
+        if not confirm_miss:
+            return False
+        return _learn(username, _registered(username).exists())
+    directory = get_user_directory()
+    if directory is not None:
+        return directory.entry(username) is not None
+    with read_from_replica():
+        return _registered(username).exists()
+
+
+async def ausername_exists(username, confirm_miss=False):
+    # the index is in memory, only the confirming query is awaited
+    if not get_username_index().might_contain(username):
+        if not confirm_miss:
+            return False
+        return _learn(username, await _registered(username).aexists())
+    directory = get_user_directory()
+    if directory is not None:
+        return await directory.aentry(username) is not None
+    with read_from_replica():
+        return await _registered(username).aexists()
+
+
+def _registered(username):
+    return get_user_model().objects.filter(username=username)
+
+
+def _learn(username, exists):
+    if exists:
+        # written without the signal, e.g. on another host
+        get_username_index().add(username)
+    return exists
@@ -0,0 +1,515 @@
+"""
+Metrics of the auth flows, in the prometheus text format at `/metrics`
+
+every process adds to its own memory mapped file of float64 slots in
+`USERS_METRICS["DIR"]`, without any lock shared with the other processes, and
+the `/metrics` view sums the files of every process. the file of a process
+that is gone is folded into `retired.metrics` and removed by the next
+collection, so counters never go back when a worker is recycled and the
+directory doesn't grow with every one. the workers of a host share a directory,
+a pid is only checked on this host. clear the directory when deploying, a file
+of another layout is skipped anyway.
+
+the metrics and their label values are fixed below, so every file has the
+same layout:
+
+    users_view_duration_seconds         histogram per view, `MetricsMiddleware`
+    users_password_hash_seconds         histogram of the pooled pbkdf2 hashes
+    users_db_queries_total              counter
+    users_cache_operations_total        counter per cache method
+    users_ban_checks_total              counter per result, hit (banned) or miss
+    users_bans_issued_total             counter per scope, identifier or prefix
+    users_otps_issued_total             counter
+    users_otp_verifications_total       counter per `OTPResult`
+    users_directory_lookups_total       counter per result, hit or miss
+    users_swept_records_total           counter per kind, `users.sweeper`
+    users_admission_decisions_total     counter per decision, `users.admission`
+    users_admission_shed_total          counter per view, turned away with a 503
+    users_admission_queue_seconds       histogram per view of the queueing delay
+
+queries are counted by an execute wrapper added to every database connection
+(`count_queries`), the cache calls of the stores of the auth flows by the
+cache they look up with `metered_cache`. nothing else is wrapped, the method
+patching of `users.instrumentation` is for the tests and benchmarks only.
+an update is a dict lookup and a `pack_into` under a thread lock, cheap enough
+to leave on, `USERS_METRICS = {"ENABLED": False}` turns every update into a no-op.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .runtime import private_tempdir
+
+MAGIC = b"UBAARMTR"
+VERSION = 1
+# magic, version, slots, layout digest
+HEADER = struct.Struct("<8sIIQ")
+DATA = 64
+SLOT = struct.Struct("<d")
+# the counts of the processes that are gone
+RETIRED = "retired.metrics"
+
+DEFAULTS = {
+    "ENABLED": True,
+    # a directory per project checkout in the private temp directory by default
+    "DIR": None,
+}
+
+VIEWS = (
+    "check",
+    "login_user",
+    "logout_user",
+    "register",
+    "register_info",
+    "register_password",
+    "api_start",
+    "api_verify",
+    "api_register",
+    "api_login",
+    "other",
+)
+CACHE_METHODS = (
+    "get",
+    "set",
+    "add",
+    "delete",
+    "get_many",
+    "set_many",
+    "delete_many",
+    "get_or_set",
+    "incr",
+    "decr",
+    "touch",
+    "has_key",
+    "clear",
+)
+OTP_RESULTS = ("verified", "mismatch", "exhausted", "expired", "missing")
+ADMISSION_RESULTS = ("admitted", "queued", "full", "timeout", "shed")
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+HASH_BUCKETS = (0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2)
+QUEUE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0)
+
+
+def get_metrics_settings():
+    return {**DEFAULTS, **getattr(settings, "USERS_METRICS", {})}
+
+
+def default_metrics_dir():
+    name = hashlib.blake2b(str(settings.BASE_DIR).encode(), digest_size=6).hexdigest()
+    return os.path.join(private_tempdir(), f"ubaar-metrics-{name}")
+
+
+class Metric:
+    """
+    A metric with one sample, or one per value of its single label
+    """
+
+    type = None
+    width = 1
+
+    def __init__(self, name, help, label=None, values=(None,)):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = values
+        self.index = {value: i * self.width for i, value in enumerate(values)}
+        self.offset = 0
+
+    @property
+    def slots(self):
+        return self.width * len(self.values)
+
+    def _labels(self, value, extra=""):
+        labels = [f'{self.label}="{value}"'] if self.label else []
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class CounterMetric(Metric):
+    type = "counter"
+
+    def render(self, values):
+        for value, i in self.index.items():
+            yield f"{self.name}{self._labels(value)} {values[self.offset + i]:g}"
+
+
+class HistogramMetric(Metric):
+    """
+    A slot per bucket, one for +Inf and one for the sum
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets, **kwargs):
+        self.buckets = buckets
+        self.width = len(buckets) + 2
+        super().__init__(name, help, **kwargs)
+
+    def slot(self, seconds, value=None):
+        return self.offset + self.index[value] + bisect_left(self.buckets, seconds)
+
+    def sum_slot(self, value=None):
+        return self.offset + self.index[value] + self.width - 1
+
+    def render(self, values):
+        for value, i in self.index.items():
+            base = self.offset + i
+            count = 0
+            for bound, n in zip(
+                (*self.buckets, "+Inf"), values[base : base + self.width - 1]
+            ):
+                count += n
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{self._labels(value, le)} {count:g}"
+            total = values[base + self.width - 1]
+            yield f"{self.name}_sum{self._labels(value)} {total}"
+            yield f"{self.name}_count{self._labels(value)} {count:g}"
+
+
+VIEW_DURATION = HistogramMetric(
+    "users_view_duration_seconds",
+    "Time to respond, per view",
+    LATENCY_BUCKETS,
+    label="view",
+    values=VIEWS,
+)
+HASH_DURATION = HistogramMetric(
+    "users_password_hash_seconds", "Time spent hashing a password", HASH_BUCKETS
+)
+DB_QUERIES = CounterMetric("users_db_queries_total", "Database queries")
+CACHE_OPERATIONS = CounterMetric(
+    "users_cache_operations_total",
+    "Cache calls, per method",
+    label="operation",
+    values=CACHE_METHODS,
+)
+BAN_CHECKS = CounterMetric(
+    "users_ban_checks_total",
+    "Ban lookups, hit when the identifier is banned",
+    label="result",
+    values=("hit", "miss"),
+)
+BANS_ISSUED = CounterMetric(
+    "users_bans_issued_total",
+    "Bans issued, of an identifier or of a subnet or number range",
+    label="scope",
+    values=("identifier", "prefix"),
+)
+OTPS_ISSUED = CounterMetric("users_otps_issued_total", "Otps issued")
+DIRECTORY_LOOKUPS = CounterMetric(
+    "users_directory_lookups_total",
+    "User directory lookups, hit when served from the cache",
+    label="result",
+    values=("hit", "miss"),
+)
+SWEPT_RECORDS = CounterMetric(
+    "users_swept_records_total",
+    "Expired records deleted by the sweeper, per kind",
+    label="kind",
+    values=("session", "otp", "ban", "wizard"),
+)
+ADMISSION_DECISIONS = CounterMetric(
+    "users_admission_decisions_total",
+    "Admission decisions, queued counts the requests that waited for a turn",
+    label="decision",
+    values=ADMISSION_RESULTS,
+)
+ADMISSION_SHED = CounterMetric(
+    "users_admission_shed_total",
+    "Requests turned away with a 503, per view",
+    label="view",
+    values=VIEWS,
+)
+QUEUE_DURATION = HistogramMetric(
+    "users_admission_queue_seconds",
+    "Time waited for a turn, per view",
+    QUEUE_BUCKETS,
+    label="view",
+    values=VIEWS,
+)
+OTP_VERIFICATIONS = CounterMetric(
+    "users_otp_verifications_total",
+    "Otp verifications, per result",
+    label="result",
+    values=OTP_RESULTS,
+)
+
+METRICS = (
+    VIEW_DURATION,
+    HASH_DURATION,
+    DB_QUERIES,
+    CACHE_OPERATIONS,
+    BAN_CHECKS,
+    BANS_ISSUED,
+    OTPS_ISSUED,
+    OTP_VERIFICATIONS,
+    DIRECTORY_LOOKUPS,
+    SWEPT_RECORDS,
+    ADMISSION_DECISIONS,
+    ADMISSION_SHED,
+    QUEUE_DURATION,
+)
+
+
+def _layout():
+    offset = 0
+    description = []
+    for metric in METRICS:
+        metric.offset = offset
+        offset += metric.slots
+        description.append(
+            f"{metric.name}:{metric.label}:{metric.values}:"
+            f"{getattr(metric, 'buckets', ())}"
+        )
+    digest = hashlib.blake2b("|".join(description).encode(), digest_size=8).digest()
+    return offset, int.from_bytes(digest, "little")
+
+
+SLOTS, LAYOUT = _layout()
+
+
+class MetricsStore:
+    """
+    The metrics file of this process in `directory`, and the sum of all of them
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.size = DATA + SLOTS * SLOT.size
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        # between opening a file and retiring it, a new process may reuse a pid
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _open(self):
+        """
+        Map this process' file, once per process so a forked worker gets its own
+        """
+        path = self.directory / f"{os.getpid()}.metrics"
+        with self._locked():
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                os.ftruncate(fd, self.size)
+                self._map = mmap.mmap(fd, self.size)
+            finally:
+                os.close(fd)
+        magic, version, slots, layout = HEADER.unpack_from(self._map)
+        if (magic, version, slots, layout) == (MAGIC, VERSION, SLOTS, LAYOUT):
+            # a process with the same pid left its counts, carry on from them
+            self._values = list(struct.unpack_from(f"<{SLOTS}d", self._map, DATA))
+        else:
+            self._values = [0.0] * SLOTS
+            struct.pack_into(f"<{SLOTS}d", self._map, DATA, *self._values)
+            HEADER.pack_into(self._map, 0, MAGIC, VERSION, SLOTS, LAYOUT)
+        self._pid = os.getpid()
+
+    def add(self, slot, amount=1):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            value = self._values[slot] + amount
+            self._values[slot] = value
+            SLOT.pack_into(self._map, DATA + slot * SLOT.size, value)
+
+    def observe(self, histogram, seconds, value=None):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            for slot, amount in (
+                (histogram.slot(seconds, value), 1),
+                (histogram.sum_slot(value), seconds),
+            ):
+                self._values[slot] += amount
+                SLOT.pack_into(self._map, DATA + slot * SLOT.size, self._values[slot])
+
+    def _read(self, path):
+        """
+        The values of a metrics file, None if it is gone or of another layout
+        """
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        if len(data) < self.size or HEADER.unpack_from(data) != (
+            MAGIC,
+            VERSION,
+            SLOTS,
+            LAYOUT,
+        ):
+            return None
+        return struct.unpack_from(f"<{SLOTS}d", data, DATA)
+
+    def retire(self):
+        """
+        Fold the files of the processes that are gone into `RETIRED` and
+        remove them, returns how many
+        """
+        dead = [
+            path
+            for path in self.directory.glob("*.metrics")
+            if path.stem.isdigit() and not _alive(int(path.stem))
+        ]
+        if not dead:
+            return 0
+        with self._locked():
+            retired = self.directory / RETIRED
+            totals = list(self._read(retired) or [0.0] * SLOTS)
+            dead = [path for path in dead if not _alive(int(path.stem))]
+            for path in dead:
+                for i, value in enumerate(self._read(path) or ()):
+                    totals[i] += value
+            data = bytearray(self.size)
+            HEADER.pack_into(data, 0, MAGIC, VERSION, SLOTS, LAYOUT)
+            struct.pack_into(f"<{SLOTS}d", data, DATA, *totals)
+            temporary = self.directory / f"{RETIRED}.tmp"
+            temporary.write_bytes(data)
+            # the sums are in place before the files go
+            os.replace(temporary, retired)
+            for path in dead:
+                path.unlink(missing_ok=True)
+        return len(dead)
+
+    def collect(self):
+        """
+        The sums of the files of every process
+        """
+        self.retire()
+        totals = [0.0] * SLOTS
+        for path in self.directory.glob("*.metrics"):
+            for i, value in enumerate(self._read(path) or ()):
+                totals[i] += value
+        return totals
+
+    def render(self):
+        """
+        The text exposition format
+        """
+        values = self.collect()
+        lines = []
+        for metric in METRICS:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render(values))
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # someone else's process
+        return True
+    return True
+
+
+_store = None
+_enabled = None
+
+
+def get_metrics_store():
+    """
+    The store, None when metrics are disabled
+    """
+    global _store, _enabled
+    if _enabled is None:
+        options = get_metrics_settings()
+        _enabled = options["ENABLED"]
+        if _enabled:
+            _store = MetricsStore(options["DIR"] or default_metrics_dir())
+    return _store
+
+
+def reset_metrics_store(**kwargs):
+    global _store, _enabled
+    _store = _enabled = None
+
+
+# the updates of the hot paths
+
+
+def observe_view(view, seconds):
+    store = get_metrics_store()
+    if store:
+        store.observe(VIEW_DURATION, seconds, view if view in VIEWS else "other")
+
+
+def observe_queue(view, seconds):
+    store = get_metrics_store()
+    if store:
+        store.observe(QUEUE_DURATION, seconds, view if view in VIEWS else "other")
+
+
+def observe_hash(seconds):
+    store = get_metrics_store()
+    if store:
+        store.observe(HASH_DURATION, seconds)
+
+
+def count(counter, value=None, amount=1):
+    store = get_metrics_store()
+    if store and amount:
+        store.add(counter.offset + counter.index[value], amount)
+
+
+def count_query(execute, sql, params, many, context):
+    count(DB_QUERIES)
+    return execute(sql, params, many, context)
+
+
+def count_queries(sender, connection, **kwargs):
+    """
+    Add `count_query` to a new connection, first so the wrappers of an
+    `execute_wrapper()` block running meanwhile are still popped off the end
+    """
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, count_query)
+
+
+class MeteredCache:
+    """
+    A cache whose calls are counted, by method, the async ones as their sync
+    counterparts, the calls it makes itself aren't
+    """
+
+    # a name no backend uses, the rest is the backend's, `_cache` included
+    __slots__ = ("_metered",)
+
+    def __init__(self, cache):
+        self._metered = cache
+
+    def __getattr__(self, name):
+        method = name[1:] if name[:1] == "a" and name[1:] in CACHE_METHODS else name
+        if method in CACHE_METHODS:
+            count(CACHE_OPERATIONS, method)
+        return getattr(self._metered, name)
+
+
+def metered_cache(alias):
+    """
+    The cache of `alias`, its calls counted while metrics are enabled
+    """
+    cache = caches[alias]
+    return MeteredCache(cache) if get_metrics_store() else cache
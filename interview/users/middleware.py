@@ -0,0 +1,264 @@
+import time
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+
+from .admission import get_admission_controller, get_admission_settings
+from .hashing import HashingUnavailable
+from .metrics import observe_view
+from .profiling import Profiler, get_profiling_settings
+from .tokens import get_token_authority, get_token_settings
+from .utils import aget_ban_remaining_seconds, get_ban_remaining_seconds
+from .wizard import WizardState, get_wizard_store
+
+# the bodies never change, so build them once
+BANNED_BODY = b"too many attempts, try again later\n"
+BUSY_BODY = b"server busy, try again\n"
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """
+    Profile the sampled requests and the ones carrying a profile token, see
+    `users.profiling`, left out of the stack while profiling is disabled
+    """
+
+    def __init__(self, get_response):
+        options = get_profiling_settings()
+        if not options["ENABLED"]:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.profiler = Profiler(options)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        capture = self.profiler.start() if self.profiler.wanted(request) else None
+        if capture is None:
+            return self.get_response(request)
+        try:
+            return self.get_response(request)
+        finally:
+            self.profiler.finish(capture, request)
+
+    async def __acall__(self, request):
+        capture = self.profiler.start() if self.profiler.wanted(request) else None
+        if capture is None:
+            return await self.get_response(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            self.profiler.finish(capture, request)
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    Time every response per view for `users.metrics`, placed first so the
+    time of the other middleware and of banned requests counts too
+    """
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        observe_view(view_name(request), time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        observe_view(view_name(request), time.perf_counter() - start)
+        return response
+
+
+def view_name(request):
+    # unresolved when a middleware answered, e.g. a banned client
+    match = getattr(request, "resolver_match", None)
+    return match.url_name if match else "other"
+
+
+class BanCheckMiddleware(MiddlewareMixin):
+    """
+    Reject requests from banned ips before anything else runs
+    placed first in `MIDDLEWARE`, so a banned client never costs a session load,
+    a user lookup or a template render
+    works natively in both sync and async stacks, no thread hop under asgi
+    """
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        remaining = get_ban_remaining_seconds(request.META.get("REMOTE_ADDR"))
+        if remaining:
+            return banned_response(remaining)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        remaining = await aget_ban_remaining_seconds(request.META.get("REMOTE_ADDR"))
+        if remaining:
+            return banned_response(remaining)
+        return await self.get_response(request)
+
+
+class AdmissionControlMiddleware(MiddlewareMixin):
+    """
+    Let a request of a gated view in when its gate has room, see
+    `users.admission`, and turn it away with a 503 otherwise, placed before
+    the session and auth middleware so a shed request costs nothing
+    left out of the stack while admission control is disabled
+    """
+
+    def __init__(self, get_response):
+        if not get_admission_settings()["ENABLED"]:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        controller = get_admission_controller()
+        view = controller.view(request)
+        if view is None:
+            return self.get_response(request)
+        arrived = controller.admit(view)
+        if arrived is None:
+            return busy_response(controller.retry_after)
+        try:
+            return self.get_response(request)
+        finally:
+            controller.leave(view, arrived)
+
+    async def __acall__(self, request):
+        controller = get_admission_controller()
+        view = controller.view(request)
+        if view is None:
+            return await self.get_response(request)
+        arrived = await controller.aadmit(view)
+        if arrived is None:
+            return busy_response(controller.retry_after)
+        try:
+            return await self.get_response(request)
+        finally:
+            controller.leave(view, arrived)
+
+
+class HashingUnavailableMiddleware(MiddlewareMixin):
+    """
+    Answer with a 503 when the password hashing pool is saturated or too slow,
+    instead of a 500 from inside `authenticate()` or `form.save()`
+    """
+
+    retry_after = 1
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, HashingUnavailable):
+            return busy_response(self.retry_after)
+        return None
+
+
+class WizardMiddleware(MiddlewareMixin):
+    """
+    Set `request.wizard`, see `users.wizard`, and store its changes with the
+    response, natively in both sync and async stacks
+    """
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        request.wizard = WizardState(get_wizard_store(), request)
+        response = self.get_response(request)
+        request.wizard.save(response)
+        return response
+
+    async def __acall__(self, request):
+        request.wizard = WizardState(get_wizard_store(), request)
+        response = await self.get_response(request)
+        await request.wizard.asave(response)
+        return response
+
+
+class TokenAuthenticationMiddleware(MiddlewareMixin):
+    """
+    Authenticate the requests carrying a valid auth token without loading the
+    session or querying the user, see `users.tokens`, placed after
+    `AuthenticationMiddleware` whose lazy user it replaces
+    issues a token on login, revokes it on logout, left out of the stack while
+    tokens are disabled
+    """
+
+    def __init__(self, get_response):
+        if not get_token_settings()["ENABLED"]:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        authority = get_token_authority()
+        claims = self.claims(authority, request)
+        if claims:
+            user = authority.user(*claims[:2])
+            if user is not None:
+                self.authenticated(request, user)
+        response = self.get_response(request)
+        return self.process_token(authority, request, response, claims)
+
+    async def __acall__(self, request):
+        authority = get_token_authority()
+        claims = self.claims(authority, request)
+        if claims:
+            user = await authority.auser(*claims[:2])
+            if user is not None:
+                self.authenticated(request, user)
+        response = await self.get_response(request)
+        return self.process_token(authority, request, response, claims)
+
+    @staticmethod
+    def claims(authority, request):
+        request.auth_token = authority.token(request)
+        return authority.claims(request.auth_token) if request.auth_token else None
+
+    @staticmethod
+    def authenticated(request, user):
+        request.user = user
+
+        async def auser():
+            return user
+
+        request.auser = auser
+
+    @staticmethod
+    def process_token(authority, request, response, claims):
+        if getattr(request, "_token_logout", False):
+            if request.auth_token:
+                authority.revoke(request.auth_token)
+            response.delete_cookie(authority.cookie_name)
+        elif getattr(request, "_token_login", None) is not None:
+            authority.set_cookie(response, request._token_login)
+        elif claims and authority.stale(claims[2]) and request.user.is_authenticated:
+            # half way through its life, replaced by a fresh one
+            authority.set_cookie(response, request.user)
+        return response
+
+
+def banned_response(remaining):
+    """
+    Tiny 429 response telling the client when it may try again, in seconds
+    """
+    response = HttpResponse(BANNED_BODY, status=429, content_type="text/plain")
+    response["Retry-After"] = str(remaining)
+    # don't log a warning for every rejected request during an attack
+    response._has_been_logged = True
+    return response
+
+
+def busy_response(retry_after):
+    """
+    Tiny 503 response telling the client when to try again, in seconds
+    """
+    response = HttpResponse(BUSY_BODY, status=503, content_type="text/plain")
+    response["Retry-After"] = str(retry_after)
+    # shedding load, don't log every request turned away
+    response._has_been_logged = True
+    return response
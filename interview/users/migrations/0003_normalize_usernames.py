@@ -0,0 +1,54 @@
+# Generated by Django 5.2 on 2026-10-18 11:40
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import migrations
+
+
+def normalize_usernames(apps, schema_editor):
+    from users.membership import get_username_index
+    from users.validators import normalize_phonenumber
+
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split("."))
+    owners = defaultdict(list)
+    for username in User.objects.values_list("username", flat=True):
+        # usernames that aren't phonenumbers are left alone
+        owners[normalize_phonenumber(username) or username].append(username)
+    collisions = {
+        normalized: usernames
+        for normalized, usernames in owners.items()
+        if len(usernames) > 1
+    }
+    if collisions:
+        # the migration is atomic, nothing was renamed
+        raise RuntimeError(
+            "several users share a phonenumber, merge or rename them and migrate "
+            "again: "
+            + "; ".join(
+                f"{normalized}: {', '.join(sorted(usernames))}"
+                for normalized, usernames in sorted(collisions.items())
+            )
+        )
+    renamed = 0
+    for normalized, (username,) in owners.items():
+        if normalized != username:
+            renamed += User.objects.filter(username=username).update(
+                username=normalized
+            )
+    if renamed:
+        # renamed without post_save, lookups go to the database until the
+        # username index is rebuilt
+        get_username_index().invalidate()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_outboundmessage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_usernames, migrations.RunPython.noop),
+    ]
@@ -20,3 +20,40 @@ from django.db import models
 # def create_ubaaruser_profile(sender, instance, created, **kawrgs):
 #     if created:
 #         UbaarUserProfile.objects.create(user=instance)
+
+
+class OutboundMessage(models.Model):
+    """
+    Persistent queue of text messages waiting for the sms gateway
+    rows are enqueued by the views and drained by `users.sms.SMSDispatcher`
+    """
+
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "pending"),
+        (SENDING, "sending"),
+        (SENT, "sent"),
+        (FAILED, "failed"),
+    ]
+
+    phonenumber = models.CharField(max_length=16)
+    # blanked once sent or failed, it usually holds an otp
+    body = models.CharField(max_length=160)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # not picked up before this time, pushed back after every failed attempt
+    next_attempt_at = models.DateTimeField()
+    # when a worker claimed the message, stale claims are taken over after a restart
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt_at"])]
+
+    def __str__(self):
+        return f"{self.phonenumber} ({self.status})"
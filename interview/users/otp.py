@@ -1,11 +1,273 @@
-def send_sms(phonenumber):
-    print(f"send message to {phonenumber}")
+"""
+One time passwords of the registration flow
+
+`OTPStore` keeps every issued otp in its own cache alias (`USERS_OTP_CACHE`),
+so abandoned registrations can never cull ban records, with an explicit short
+ttl and a compact string record:
+
+    "<attempts>:<code>:<phonenumber>"
+
+the token handed to the client is the hex expiry followed by random characters,
+so a missing record can be told apart: expired, or gone before its time
+(evicted, or already used).
+
+verifying consumes the record with a single atomic get-and-delete, compares in
+constant time and only puts it back, with one attempt less, on a mismatch, so
+a token allows `OTP_MAX_ATTEMPTS` guesses no matter how many requests race.
+
+every text costs money and can be aimed at anyone's phone, so a phonenumber is
+texted at most `OTP_SENDS_PER_PHONENUMBER` otps in a ban period, and a client
+ip asks for at most `OTP_SENDS_PER_IP` (`users.utils.throttle_otp`), and a
+reload of the otp page shows the `pending` otp instead of texting a new one.
+"""
+
+import threading
+import time
+from enum import Enum
+from math import ceil
+from secrets import choice, token_urlsafe
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+
+from .metrics import OTP_VERIFICATIONS, OTPS_ISSUED, count, metered_cache
+
+OTP_TTL_SECONDS = 120
+OTP_MAX_ATTEMPTS = 3
+OTP_KEY_PREFIX = "otp"
+TOKEN_LENGTH = 20
+OTP_SENDS_PER_PHONENUMBER = 5
+OTP_SENDS_PER_IP = 30
+# a pending otp is shown again only with this long left to type it in
+OTP_REUSE_SECONDS = 30
+
+
+def send_sms(phonenumber, body):
+    """
+    Queue a text message, it is sent by the sms workers (`manage.py sms_worker`)
+    """
+    from .sms import enqueue_sms
+
+    return enqueue_sms(phonenumber, body)
+
+
+async def asend_sms(phonenumber, body):
+    from .sms import aenqueue_sms
+
+    return await aenqueue_sms(phonenumber, body)
+
+
+def otp_message(otp):
+    return f"your verification code is {otp}"
 
 
 def generate_random_otp():
     """
     Generate a random 6-digit OTP as string
     """
-    from random import randint
+    return "".join(choice("0123456789") for _ in range(6))
+
+
+class OTPResult(Enum):
+    VERIFIED = "verified"
+    MISMATCH = "mismatch"
+    # no guesses left for the token
+    EXHAUSTED = "exhausted"
+    EXPIRED = "expired"
+    # gone before expiring, evicted or already used
+    MISSING = "missing"
+
+
+# what the user is told for every failed verification
+OTP_ERRORS = {
+    OTPResult.MISMATCH: "otp doesn't match",
+    OTPResult.EXHAUSTED: "too many wrong otps, request a new one",
+    OTPResult.EXPIRED: "otp expired, request a new one",
+    OTPResult.MISSING: "otp expired, request a new one",
+}
+
+
+def otp_throttled_error(remaining):
+    return f"too many otps texted, try again in {ceil(remaining / 60)} minutes"
+
+
+class OTPStore:
+    """
+    Issue and verify otps, see the module docstring
+    """
+
+    def __init__(
+        self, alias="otp", ttl=OTP_TTL_SECONDS, max_attempts=OTP_MAX_ATTEMPTS
+    ):
+        self.alias = alias
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.counters = dict.fromkeys(["issued", *(r.value for r in OTPResult)], 0)
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return metered_cache(self.alias)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+        # and for every process, at /metrics
+        if name == "issued":
+            count(OTPS_ISSUED)
+        else:
+            count(OTP_VERIFICATIONS, name)
+
+    def _new(self, phonenumber):
+        expiry = int(time.time()) + self.ttl
+        prefix = f"{expiry:x}"
+        token = prefix + token_urlsafe(TOKEN_LENGTH)[: TOKEN_LENGTH - len(prefix)]
+        code = generate_random_otp()
+        self._count("issued")
+        return token, code, f"0:{code}:{phonenumber}"
+
+    @staticmethod
+    def key(token):
+        return f"{OTP_KEY_PREFIX}:{token}"
+
+    def issue(self, phonenumber):
+        """
+        Store a new otp for `phonenumber`, returns the token and the code
+        """
+        token, code, record = self._new(phonenumber)
+        self.cache.set(self.key(token), record, timeout=self.ttl)
+        return token, code
+
+    async def aissue(self, phonenumber):
+        token, code, record = self._new(phonenumber)
+        await self.cache.aset(self.key(token), record, timeout=self.ttl)
+        return token, code
+
+    def pending(self, token, phonenumber):
+        """
+        Whether the otp issued for `phonenumber` under `token` is still unused,
+        with guesses and `OTP_REUSE_SECONDS` left
+        """
+        if not token or self._ttl_left(token) < OTP_REUSE_SECONDS:
+            return False
+        return self._bound(self.cache.get(self.key(token)), phonenumber)
+
+    async def apending(self, token, phonenumber):
+        if not token or self._ttl_left(token) < OTP_REUSE_SECONDS:
+            return False
+        return self._bound(await self.cache.aget(self.key(token)), phonenumber)
+
+    @staticmethod
+    def _bound(record, phonenumber):
+        # an exhausted record is deleted, one that is left has guesses left
+        return record is not None and record.split(":", 2)[2] == phonenumber
+
+    def verify(self, token, phonenumber, code):
+        """
+        Check `code` against the otp issued for `phonenumber` under `token`
+        """
+        record = self._pop(self.key(token))
+        result, retry = self._check(token, record, phonenumber, code)
+        if retry:
+            self.cache.add(self.key(token), retry, timeout=self._ttl_left(token))
+        self._count(result.value)
+        return result
+
+    async def averify(self, token, phonenumber, code):
+        record = await self._apop(self.key(token))
+        result, retry = self._check(token, record, phonenumber, code)
+        if retry:
+            await self.cache.aadd(self.key(token), retry, timeout=self._ttl_left(token))
+        self._count(result.value)
+        return result
+
+    def _pop(self, key):
+        """
+        Atomic get-and-delete, with a plain get and delete only the caller whose
+        delete removed the record gets it
+        """
+        cache = self.cache
+        client = getattr(getattr(cache, "_cache", None), "get_client", None)
+        if client is not None:
+            # redis, GETDEL in one round trip
+            value = client(write=True).getdel(cache.make_and_validate_key(key))
+            return None if value is None else cache._cache._serializer.loads(value)
+        record = cache.get(key)
+        if record is None or not cache.delete(key):
+            return None
+        return record
+
+    async def _apop(self, key):
+        cache = self.cache
+        if hasattr(getattr(cache, "_cache", None), "get_client"):
+            return await sync_to_async(self._pop, thread_sensitive=False)(key)
+        record = await cache.aget(key)
+        if record is None or not await cache.adelete(key):
+            return None
+        return record
+
+    def _check(self, token, record, phonenumber, code):
+        """
+        Returns the result and the record to put back, if any
+        """
+        if record is None:
+            if self._ttl_left(token) <= 0:
+                return OTPResult.EXPIRED, None
+            return OTPResult.MISSING, None
+        attempts, expected_code, expected_phonenumber = record.split(":", 2)
+        matches = constant_time_compare(expected_code, code or "")
+        # bound to the phonenumber it was issued for
+        matches &= constant_time_compare(expected_phonenumber, phonenumber or "")
+        if matches:
+            return OTPResult.VERIFIED, None
+        attempts = int(attempts) + 1
+        if attempts >= self.max_attempts or self._ttl_left(token) <= 0:
+            return OTPResult.EXHAUSTED, None
+        return OTPResult.MISMATCH, f"{attempts}:{expected_code}:{expected_phonenumber}"
+
+    @staticmethod
+    def _ttl_left(token):
+        try:
+            expiry = int(token[:8], 16)
+        except (TypeError, ValueError):
+            return 0
+        return expiry - int(time.time())
+
+    def stats(self):
+        """
+        Counters of this process, and the size of the otp cache when the backend
+        can tell (LocMemCache)
+        """
+        with self._lock:
+            stats = dict(self.counters)
+        stats["evicted_or_reused"] = stats.pop(OTPResult.MISSING.value)
+        cache = self.cache
+        entries = getattr(cache, "_cache", None)
+        if isinstance(entries, dict):
+            with cache._lock:
+                stats["entries"] = len(entries)
+                stats["bytes"] = sum(len(value) for value in entries.values())
+            stats["max_entries"] = cache._max_entries
+        return stats
+
+
+_store = None
+
+
+def get_otp_store():
+    global _store
+    if _store is None:
+        _store = OTPStore(
+            alias=getattr(settings, "USERS_OTP_CACHE", "otp"),
+            ttl=getattr(settings, "USERS_OTP_TTL", OTP_TTL_SECONDS),
+            max_attempts=getattr(
+                settings, "USERS_OTP_MAX_ATTEMPTS", OTP_MAX_ATTEMPTS
+            ),
+        )
+    return _store
+
 
-    return "".join([str(randint(0, 9)) for _ in range(6)])
+def reset_otp_store(**kwargs):
+    global _store
+    _store = None
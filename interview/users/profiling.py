@@ -0,0 +1,238 @@
+"""
+On demand request profiles, see `manage.py profile_report`
+
+`ProfilingMiddleware` profiles 1 in `SAMPLE` requests, and the requests carrying
+a token signed with the secret key in the `HEADER` header (`profile_token()`,
+`manage.py profile_report --token`). a profile is written to `DIR`, named
+after the view, and the oldest ones are deleted past `KEEP` files:
+
+    "cprofile"   a `cProfile` profile of the request thread, `.prof` (pstats)
+    "sample"     the request thread's stack sampled every `INTERVAL` seconds
+                 from a separate thread, `.stacks` in the collapsed format of
+                 flame graphs, lighter on slow requests
+
+under asgi the event loop thread is profiled, with the other requests it runs
+meanwhile, and not the threads of `sync_to_async`. one request of a process
+at a time is profiled with cProfile, which on python 3.12+ refuses a second
+profile from another thread, the others run unprofiled.
+
+disabled (`USERS_PROFILING["ENABLED"]`, the default) the middleware removes
+itself from the stack when the server starts, so it costs nothing.
+"""
+
+import cProfile
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from itertools import count
+from pathlib import Path
+
+from django.conf import settings
+from django.core import signing
+
+from .runtime import private_tempdir
+
+DEFAULTS = {
+    "ENABLED": False,
+    # profile 1 in SAMPLE requests, 0 for none
+    "SAMPLE": 0,
+    "HEADER": "X-Users-Profile",
+    "MODE": "cprofile",
+    # seconds between stack samples, "sample" mode
+    "INTERVAL": 0.001,
+    # a directory per project checkout in the private temp directory by default
+    "DIR": None,
+    # profiles kept
+    "KEEP": 500,
+}
+SIGNING_SALT = "users.profiling"
+# seconds a token is accepted for
+TOKEN_MAX_AGE = 3600
+EXTENSIONS = {"cprofile": ".prof", "sample": ".stacks"}
+EXTENSION_SET = set(EXTENSIONS.values())
+
+_sequence = count()
+_active = threading.local()
+# held while a cProfile profile runs, in any thread
+_cprofile_lock = threading.Lock()
+
+
+def get_profiling_settings():
+    return {**DEFAULTS, **getattr(settings, "USERS_PROFILING", {})}
+
+
+def default_profile_dir():
+    name = hashlib.blake2b(str(settings.BASE_DIR).encode(), digest_size=6).hexdigest()
+    return os.path.join(private_tempdir(), f"ubaar-profiles-{name}")
+
+
+def get_profile_dir():
+    return Path(get_profiling_settings()["DIR"] or default_profile_dir())
+
+
+def profile_token():
+    """
+    A header value that gets a request profiled for `TOKEN_MAX_AGE` seconds
+    """
+    return signing.dumps("profile", salt=SIGNING_SALT)
+
+
+def has_profile_token(request, header):
+    token = request.headers.get(header)
+    if not token:
+        return False
+    try:
+        signing.loads(token, salt=SIGNING_SALT, max_age=TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+class CProfileCapture:
+    extension = EXTENSIONS["cprofile"]
+
+    def __init__(self, options):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        """
+        Whether it started, not while another thread is profiled
+        """
+        if not _cprofile_lock.acquire(blocking=False):
+            return False
+        try:
+            self.profile.enable()
+        except ValueError:
+            # another profiling tool, e.g. a debugger
+            _cprofile_lock.release()
+            return False
+        return True
+
+    def stop(self):
+        try:
+            self.profile.disable()
+        finally:
+            _cprofile_lock.release()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+
+class StackSampler:
+    """
+    Samples the stack of the thread that started it from a daemon thread
+    """
+
+    extension = EXTENSIONS["sample"]
+
+    def __init__(self, options):
+        self.interval = options["INTERVAL"]
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        target = threading.get_ident()
+        self._thread = threading.Thread(
+            target=self._sample, args=(target,), name="users-profiler", daemon=True
+        )
+        self._thread.start()
+        return True
+
+    def _sample(self, target):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+                )
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+
+
+CAPTURES = {"cprofile": CProfileCapture, "sample": StackSampler}
+
+
+class Profiler:
+    """
+    Decides which requests are profiled and writes their profiles
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.sample = options["SAMPLE"]
+        self.header = options["HEADER"]
+        self.capture_class = CAPTURES[options["MODE"]]
+        self.directory = Path(options["DIR"] or default_profile_dir())
+        self.keep = options["KEEP"]
+
+    def wanted(self, request):
+        if getattr(_active, "profiling", False):
+            # a profile already runs on this thread, e.g. on the event loop
+            return False
+        if self.sample and random.random() * self.sample < 1:
+            return True
+        return has_profile_token(request, self.header)
+
+    def start(self):
+        """
+        The running capture, None when it can't start
+        """
+        capture = self.capture_class(self.options)
+        if not capture.start():
+            return None
+        _active.profiling = True
+        return capture
+
+    def finish(self, capture, request):
+        try:
+            capture.stop()
+        finally:
+            _active.profiling = False
+        match = getattr(request, "resolver_match", None)
+        view = (match.url_name or match.func.__name__) if match else "other"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = (
+            f"{view}.{time.strftime('%Y%m%dT%H%M%S')}.{os.getpid()}."
+            f"{next(_sequence)}{capture.extension}"
+        )
+        capture.write(self.directory / name)
+        self.rotate()
+
+    def rotate(self):
+        profiles = []
+        for path in self.directory.iterdir():
+            if path.suffix not in EXTENSION_SET:
+                continue
+            try:
+                profiles.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                # rotated away by another process
+                continue
+        profiles.sort()
+        for _, path in profiles[: max(len(profiles) - self.keep, 0)]:
+            path.unlink(missing_ok=True)
+
+
+def profile_view(path):
+    """
+    The view a profile file was taken for, from its name
+    """
+    return Path(path).name.split(".", 1)[0]
@@ -0,0 +1,45 @@
+"""
+User creation for the last step of the sign up flow
+
+`RegisterForm` checks the username with a SELECT before `save()` INSERTs it.
+here the unique constraint of the username is the only duplicate check: the
+password is validated first without any query, then hashed, then the user is
+written with a single INSERT and a duplicate surfaces as `UsernameTaken`.
+"""
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+
+from .hashing import amake_password
+from .membership import get_username_index
+
+
+class UsernameTaken(Exception):
+    """
+    A user with the username was created in the meantime
+    """
+
+
+def _insert(user):
+    try:
+        with transaction.atomic():
+            user.save(force_insert=True)
+    except IntegrityError:
+        # the index missed it, it was written without the signal
+        get_username_index().add(user.get_username())
+        raise UsernameTaken(user.get_username())
+    return user
+
+
+def provision_user(user, password):
+    """
+    Hash `password` and insert the unsaved `user`, validate the password (e.g.
+    with `RegisterPasswordForm`) before, hashing is the expensive part
+    """
+    user.set_password(password)
+    return _insert(user)
+
+
+async def aprovision_user(user, password):
+    user.password = await amake_password(password)
+    return await sync_to_async(_insert)(user)
@@ -0,0 +1,207 @@
+"""
+Fast path for rendering the form pages
+
+the pages of the flow differ between requests in a few values only: the csrf
+token, the user and the ip in the header and the initial values of the form,
+next to an error message out of a handful. `render_page` renders a page once
+per process with markers in place of those values:
+
+    <input type="hidden" name="csrfmiddlewaretoken" value="@@splice:csrf_token@@">
+
+and keeps it split at the markers. every later response joins the pieces with
+the escaped values of the request, no template, form or widget is rendered.
+pages are kept per template, authentication state and the rest of the context,
+so that rest has to be hashable and come from a small set, forms classes,
+unbound forms and fixed messages, in an lru of `PAGES` pages. a context that
+can't be cached, a bound form with its errors for one, goes through `render`.
+a cached page can only read `request.user` and `request.META.REMOTE_ADDR` of
+the request.
+
+the response to a GET of a cached page carries an ETag of the page, its values
+and the csrf secret, and `Cache-Control: private, no-cache`, so a browser
+revalidating a page gets a 304 as long as none of them changed. the otp page
+never matches, its token is new on every GET. the bodies are compressed by
+`GZipMiddleware`, which pads them against BREACH.
+
+`manage.py bench_render` compares both paths.
+"""
+
+import hashlib
+import re
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import NamedTuple
+
+from django.conf import settings
+from django.forms import BaseForm
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.shortcuts import render
+from django.template import Context
+from django.template.loader import get_template
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                quote_etag)
+from django.utils.html import conditional_escape
+
+DEFAULTS = {
+    "ENABLED": True,
+    # pages kept per process
+    "PAGES": 256,
+}
+MARKER = "@@splice:{}@@"
+MARKER_RE = re.compile(r"@@splice:([\w.]+)@@")
+# the values of every page
+CSRF_TOKEN, USER, IP = "csrf_token", "user", "ip"
+
+
+def get_rendering_settings():
+    return {**DEFAULTS, **getattr(settings, "USERS_RENDERING", {})}
+
+
+class FormInitial(NamedTuple):
+    """
+    An unbound form in a page key, its initial values are spliced
+    """
+
+    form_class: type
+    fields: tuple
+
+
+class Page(NamedTuple):
+    # literal html and the names of the values between them, alternating
+    parts: list
+    names: frozenset
+    digest: str
+
+
+class StandInUser:
+    """
+    `request.user` while a page is rendered
+    """
+
+    def __init__(self, is_authenticated):
+        self.is_authenticated = is_authenticated
+
+    def __str__(self):
+        return MARKER.format(USER)
+
+
+def page_key(context):
+    """
+    The hashable part of `context` and the initial values of its forms,
+    None if it can't be cached
+    """
+    baked = []
+    spliced = {}
+    for name, value in sorted(context.items()):
+        if isinstance(value, BaseForm):
+            if value.is_bound:
+                return None
+            initial = value.initial
+            value = FormInitial(type(value), tuple(initial))
+            for field in value.fields:
+                spliced[f"{name}.{field}"] = initial[field]
+        elif isinstance(value, list):
+            value = tuple(value)
+        try:
+            hash(value)
+        except TypeError:
+            return None
+        baked.append((name, value))
+    return tuple(baked), spliced
+
+
+class PageCache:
+    """
+    The pages rendered with markers, least recently used out first
+    """
+
+    def __init__(self, size):
+        self.page = lru_cache(maxsize=size)(self._page)
+
+    @staticmethod
+    def _page(template_name, is_authenticated, baked):
+        """
+        The `Page` of the template, None if a form value went missing
+        """
+        context = {}
+        expected = set()
+        for name, value in baked:
+            if isinstance(value, FormInitial):
+                names = {field: f"{name}.{field}" for field in value.fields}
+                expected.update(names.values())
+                initial = {field: MARKER.format(n) for field, n in names.items()}
+                value = value.form_class(initial=initial)
+            context[name] = value
+        request = SimpleNamespace(
+            user=StandInUser(is_authenticated), META={"REMOTE_ADDR": MARKER.format(IP)}
+        )
+        context.update(request=request, csrf_token=MARKER.format(CSRF_TOKEN))
+        html = get_template(template_name).template.render(Context(context))
+        parts = MARKER_RE.split(html)
+        names = frozenset(parts[1::2])
+        if not expected <= names:
+            # a widget changed the value, it can't be spliced
+            return None
+        digest = hashlib.blake2b(html.encode(), digest_size=8).hexdigest()
+        return Page(parts, names, digest)
+
+
+_cache = None
+
+
+def get_page_cache():
+    """
+    The page cache, None when disabled
+    """
+    global _cache
+    if _cache is None:
+        options = get_rendering_settings()
+        if not options["ENABLED"]:
+            return None
+        _cache = PageCache(options["PAGES"])
+    return _cache
+
+
+def reset_page_cache(**kwargs):
+    global _cache
+    _cache = None
+
+
+def render_page(request, template_name, context=None):
+    """
+    `render`, from the page cache when the context allows it
+    """
+    cache = get_page_cache()
+    key = None if cache is None else page_key(context or {})
+    page = None
+    if key is not None:
+        page = cache.page(template_name, request.user.is_authenticated, key[0])
+    if page is None:
+        return render(request, template_name, context)
+    values = {
+        USER: request.user if USER in page.names else "",
+        IP: request.META.get("REMOTE_ADDR", ""),
+        **key[1],
+    }
+    values = {name: conditional_escape(value) for name, value in values.items()}
+    # only a page with a form needs the csrf cookie
+    if CSRF_TOKEN in page.names:
+        values[CSRF_TOKEN] = get_token(request)
+    response = HttpResponse(
+        "".join(values[part] if i % 2 else part for i, part in enumerate(page.parts))
+    )
+    if request.method not in ("GET", "HEAD"):
+        return response
+    # the masked csrf token changes every time, the secret it masks doesn't
+    etag = hashlib.blake2b(digest_size=16)
+    for value in (page.digest, request.META.get("CSRF_COOKIE", "")):
+        etag.update(value.encode())
+    for name, value in sorted(values.items()):
+        if name != CSRF_TOKEN and name in page.names:
+            etag.update(f"\x00{name}\x00{value}".encode())
+    response.headers["ETag"] = quote_etag(etag.hexdigest())
+    patch_cache_control(response, private=True, no_cache=True)
+    return get_conditional_response(
+        request, etag=response.headers["ETag"], response=response
+    )
@@ -0,0 +1,41 @@
+"""
+Where the files the workers of a host share live by default
+
+the ban table, the username index, the metrics... are memory mapped or written
+by every worker, a predictable path in the world writable temp directory could
+be created, read or swapped by another local user first. so they live in a
+directory only the user running the workers can access: `$XDG_RUNTIME_DIR`
+when set, otherwise `ubaar-<uid>` in the temp directory, created with mode
+0700 and refused if anyone else owns it or can access it.
+"""
+
+import os
+import stat
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+def private_tempdir():
+    """
+    The private directory of this user, created if missing
+    """
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    path = runtime or os.path.join(tempfile.gettempdir(), f"ubaar-{os.getuid()}")
+    if not runtime:
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+    # not followed, a symlink planted in its place is refused too
+    info = os.lstat(path)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & 0o077
+    ):
+        raise ImproperlyConfigured(
+            f"{path} must be a directory only its owner {os.getuid()} can access, "
+            "or set the PATH or DIR of the setting"
+        )
+    return path
@@ -0,0 +1,13 @@
+from .membership import get_username_index
+
+
+def index_username(sender, instance, **kwargs):
+    """
+    Add the username of a saved user to the username index, before the row is
+    committed so no other request can see the user but miss it in the index
+    """
+    get_username_index().add(instance.get_username())
+
+
+def unindex_username(sender, instance, **kwargs):
+    get_username_index().discard(instance.get_username())
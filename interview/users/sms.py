@@ -0,0 +1,284 @@
+"""
+Outbound sms pipeline
+
+the views only `enqueue_sms`, a single insert into the `OutboundMessage` table,
+so their latency doesn't depend on the sms provider. `SMSDispatcher` drains the
+table in batches with a bounded number of concurrent gateway calls, retries
+failed messages with exponential backoff and keeps per batch stats.
+
+messages live in the database until they are sent, a worker that dies while
+sending leaves its claim behind and the claim is taken over after `LEASE`. the
+body of a message, an otp more often than not, is blanked once the message is
+sent or given up on, only the row stays for the stats.
+
+run the workers with `manage.py sms_worker`, configured with `USERS_SMS`.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import OutboundMessage
+
+DEFAULTS = {
+    "GATEWAY": "users.sms.ConsoleSMSGateway",
+    # messages per gateway call
+    "BATCH_SIZE": 50,
+    # concurrent gateway calls
+    "WORKERS": 4,
+    "MAX_ATTEMPTS": 5,
+    # seconds, doubled after every failed attempt
+    "BACKOFF": 2.0,
+    # seconds a claimed message may stay unsent before another worker takes it over
+    "LEASE": 60,
+    # seconds to sleep when the queue is empty
+    "POLL_INTERVAL": 0.5,
+}
+
+
+# batch latencies kept for the percentiles, the most recent ones
+LATENCY_SAMPLES = 1024
+
+
+def get_sms_settings():
+    return {**DEFAULTS, **getattr(settings, "USERS_SMS", {})}
+
+
+def enqueue_sms(phonenumber, body):
+    """
+    Queue a message for the sms workers and return immediately
+    """
+    return OutboundMessage.objects.create(
+        phonenumber=phonenumber, body=body, next_attempt_at=timezone.now()
+    )
+
+
+async def aenqueue_sms(phonenumber, body):
+    return await OutboundMessage.objects.acreate(
+        phonenumber=phonenumber, body=body, next_attempt_at=timezone.now()
+    )
+
+
+class SMSGatewayError(Exception):
+    pass
+
+
+class BaseSMSGateway:
+    """
+    A provider that can send several messages per call
+    `send_batch` returns the ids of the messages that were accepted, raising
+    `SMSGatewayError` fails the whole batch
+    """
+
+    def send_batch(self, messages):
+        raise NotImplementedError
+
+
+class ConsoleSMSGateway(BaseSMSGateway):
+    """
+    Print the messages, for development
+    """
+
+    def send_batch(self, messages):
+        for message in messages:
+            print(f"send message to {message.phonenumber}: {message.body}")
+        return [message.id for message in messages]
+
+
+class FakeSMSGateway(BaseSMSGateway):
+    """
+    Local stand-in for a provider, keeps the sent messages in `outbox`
+    `latency` seconds per call and a `failure_rate` share of failed calls
+    """
+
+    def __init__(self, latency=0, failure_rate=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.outbox = []
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def send_batch(self, messages):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise SMSGatewayError("fake gateway failure")
+        with self._lock:
+            self.outbox.extend((m.phonenumber, m.body) for m in messages)
+        return [message.id for message in messages]
+
+
+class DispatchStats:
+    """
+    Counters and the latencies of the last `samples` batches of a dispatcher
+    """
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.started = time.monotonic()
+        self.batches = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=samples)
+        self._lock = threading.Lock()
+
+    def record(self, latency, sent, retried, failed):
+        with self._lock:
+            self.batches += 1
+            self.sent += sent
+            self.retried += retried
+            self.failed += failed
+            self.latencies.append(latency)
+
+    def summary(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            elapsed = time.monotonic() - self.started
+
+            def percentile(p):
+                if not latencies:
+                    return 0
+                return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+            return {
+                "batches": self.batches,
+                "sent": self.sent,
+                "retried": self.retried,
+                "failed": self.failed,
+                "messages_per_second": self.sent / elapsed if elapsed else 0,
+                "batch_latency_p50": percentile(0.5),
+                "batch_latency_p95": percentile(0.95),
+                "batch_latency_max": latencies[-1] if latencies else 0,
+            }
+
+
+class SMSDispatcher:
+    """
+    Drain the `OutboundMessage` queue through a gateway
+    """
+
+    def __init__(self, gateway=None, **options):
+        self.options = {**get_sms_settings(), **options}
+        if gateway is None:
+            gateway = import_string(self.options["GATEWAY"])()
+        self.gateway = gateway
+        self.stats = DispatchStats()
+        self._stop = threading.Event()
+
+    def claim(self):
+        """
+        Mark a batch of due messages as being sent by this worker and return it
+        """
+        now = timezone.now()
+        stale = now - timedelta(seconds=self.options["LEASE"])
+        with transaction.atomic():
+            # pending messages that are due, or sending ones whose worker is gone
+            due = OutboundMessage.objects.filter(
+                status=OutboundMessage.PENDING, next_attempt_at__lte=now
+            ) | OutboundMessage.objects.filter(
+                status=OutboundMessage.SENDING, claimed_at__lt=stale
+            )
+            ids = list(
+                due.order_by("next_attempt_at").values_list("id", flat=True)[
+                    : self.options["BATCH_SIZE"]
+                ]
+            )
+            if not ids:
+                return []
+            OutboundMessage.objects.filter(id__in=ids).update(
+                status=OutboundMessage.SENDING, claimed_at=now
+            )
+            return list(OutboundMessage.objects.filter(id__in=ids))
+
+    def send(self, messages):
+        """
+        Send one claimed batch through the gateway, safe to call from any thread
+        returns the accepted message ids, the error for the rest and the latency
+        """
+        start = time.monotonic()
+        try:
+            accepted = set(self.gateway.send_batch(messages))
+            error = "rejected by the gateway"
+        except SMSGatewayError as e:
+            accepted, error = set(), str(e)
+        return accepted, error, time.monotonic() - start
+
+    def record(self, messages, accepted, error, latency):
+        """
+        Store the outcome of a sent batch, failed messages are rescheduled with
+        exponential backoff until `MAX_ATTEMPTS`
+        """
+        now = timezone.now()
+        sent = [m.id for m in messages if m.id in accepted]
+        retried = failed = 0
+        with transaction.atomic():
+            if sent:
+                OutboundMessage.objects.filter(id__in=sent).update(
+                    status=OutboundMessage.SENT, sent_at=now, claimed_at=None, body=""
+                )
+            for message in messages:
+                if message.id in accepted:
+                    continue
+                message.attempts += 1
+                message.claimed_at = None
+                message.last_error = error[:255]
+                if message.attempts >= self.options["MAX_ATTEMPTS"]:
+                    message.status = OutboundMessage.FAILED
+                    message.body = ""
+                    failed += 1
+                else:
+                    backoff = self.options["BACKOFF"] * 2 ** (message.attempts - 1)
+                    message.status = OutboundMessage.PENDING
+                    message.next_attempt_at = now + timedelta(seconds=backoff)
+                    retried += 1
+                message.save(
+                    update_fields=[
+                        "attempts",
+                        "claimed_at",
+                        "last_error",
+                        "status",
+                        "next_attempt_at",
+                        "body",
+                    ]
+                )
+        self.stats.record(latency, len(sent), retried, failed)
+        return len(sent)
+
+    def run_once(self):
+        """
+        Claim and send batches with up to `WORKERS` concurrent gateway calls,
+        until the queue has nothing due, returns the number of sent messages
+        only the gateway calls run in the pool, the database is used from this
+        thread alone
+        """
+        sent = 0
+        with ThreadPoolExecutor(max_workers=self.options["WORKERS"]) as executor:
+            while True:
+                batches = []
+                for _ in range(self.options["WORKERS"]):
+                    batch = self.claim()
+                    if not batch:
+                        break
+                    batches.append(batch)
+                if not batches:
+                    return sent
+                for batch, outcome in zip(batches, executor.map(self.send, batches)):
+                    sent += self.record(batch, *outcome)
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            if not self.run_once():
+                self._stop.wait(self.options["POLL_INTERVAL"])
+
+    def stop(self):
+        self._stop.set()
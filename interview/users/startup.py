@@ -0,0 +1,127 @@
+"""
+Worker warm up
+
+a fresh worker compiles templates, renders its first forms, populates the url
+resolver, sets the password hashers up, imports phonenumbers and maps the
+username index on its first requests, so after a restart or a scale up the
+first requests are hundreds of milliseconds slower.
+`warm_up` does all of it before the worker accepts traffic, it is called from
+interview/wsgi.py and interview/asgi.py when `USERS_WARM_UP` is on.
+
+`manage.py startup_report` measures the difference.
+"""
+
+import time
+from pathlib import Path
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.hashers import get_hasher, get_hashers
+from django.template.loader import get_template
+from django.urls import get_resolver
+
+from . import forms
+from .hashing import PooledPBKDF2PasswordHasher, _pbkdf2, get_hashing_service
+from .membership import get_username_index, registered_usernames
+from .validators import get_phonenumber_regions, normalize_phonenumber
+
+
+def warm_templates():
+    """
+    Compile every template of the users app into the cached template loader
+    """
+    root = Path(apps.get_app_config("users").path) / "templates"
+    names = sorted(p.relative_to(root).as_posix() for p in root.rglob("*.html"))
+    for name in names:
+        get_template(name)
+    return len(names)
+
+
+def warm_forms():
+    """
+    Render every form of the users app once, the form renderer compiles django's
+    own widget templates on first use
+    """
+    classes = [forms.PhonenumberForm, forms.LoginForm, forms.OTPForm]
+    classes += [forms.RegisterInfoForm, forms.RegisterPasswordForm]
+    for form_class in classes:
+        form_class().as_p()
+    return len(classes)
+
+
+def warm_urls():
+    """
+    Import the urlconf and populate the resolver, which reverse() and resolve()
+    otherwise do on first use
+    """
+    resolver = get_resolver()
+    resolver.reverse_dict
+    return len(resolver.url_patterns)
+
+
+def warm_hashers():
+    """
+    Instantiate the configured hashers and start the hashing pool processes
+    """
+    get_hashers()
+    hasher = get_hasher()
+    service = get_hashing_service()
+    if isinstance(hasher, PooledPBKDF2PasswordHasher) and service.workers:
+        # one tiny hash per worker at once, so every pool process is started
+        futures = [
+            service.executor.submit(_pbkdf2, "sha256", b"warm up", b"salt", 1)
+            for _ in range(service.workers)
+        ]
+        for future in futures:
+            future.result()
+    return len(settings.PASSWORD_HASHERS)
+
+
+def warm_phonenumbers():
+    """
+    Import phonenumbers and load the metadata of the configured regions
+    """
+    import phonenumbers
+
+    regions = get_phonenumber_regions()
+    for region in regions:
+        example = phonenumbers.example_number_for_type(
+            region, phonenumbers.PhoneNumberType.MOBILE
+        )
+        normalize_phonenumber(
+            phonenumbers.format_number(example, phonenumbers.PhoneNumberFormat.E164)
+        )
+    return len(regions)
+
+
+def warm_username_index():
+    """
+    Map the username index, and build it if no worker has yet
+    """
+    index = get_username_index()
+    if not index.ready:
+        # workers booting together build it once
+        index.rebuild(registered_usernames(), force=False)
+    return index.stats()["added"]
+
+
+WARM_UPS = {
+    "templates": warm_templates,
+    "forms": warm_forms,
+    "urls": warm_urls,
+    "hashers": warm_hashers,
+    "phonenumbers": warm_phonenumbers,
+    "username_index": warm_username_index,
+}
+
+
+def warm_up():
+    """
+    Run every warm up, returns the seconds each of them took
+    """
+    timings = {}
+    for name, warm in WARM_UPS.items():
+        start = time.perf_counter()
+        warm()
+        timings[name] = time.perf_counter() - start
+    return timings
@@ -0,0 +1,241 @@
+"""
+Incremental sweeper of expired sessions and cache records
+
+`clearsessions` deletes every expired session in one statement, a single long
+write transaction that holds sqlite's only write lock and turns the logins
+waiting for it into "database is locked" errors. `SessionSweeper` deletes them
+in batches instead, oldest first along the `expire_date` index:
+
+    select the `BATCH_SIZE` oldest expired keys, delete them by primary key,
+    wait `PAUSE` seconds so the writers queued behind get the lock, repeat
+
+each batch is its own short transaction. the progress, the `expire_date` the
+last batch reached, is kept in a small json file (`STATE_PATH`), so a sweep
+interrupted half way resumes where it stopped. a session may expire before
+one saved earlier, a shorter `set_expiry()`, so a sweep that reaches the end
+clears the cursor and the next one scans from the start again, anything the
+resumed sweep skipped included. one process sweeps at a time, the others skip
+their turn.
+
+with `PURGE_CACHES` a sweep also drops the expired records of the stores that
+only expire them when they are read, the otps of abandoned registrations, the
+attempt counters and bans, and the `CacheWizardStore` state: the keys of a
+locmem cache, the files of a file based cache and the slots of the shared
+memory ban table. redis and memcached expire keys themselves and are left alone.
+a locmem cache lives in a single process, only the background thread of that
+process can purge it.
+
+run it with `manage.py sweep_sessions`, or in a background thread of every
+worker with `USERS_SWEEPER["THREAD"]`, see `start_sweeper`. the records swept
+are counted in `users_swept_records_total`.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from importlib import import_module
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import close_old_connections
+
+from .attempts import get_attempt_counter
+from .metrics import SWEPT_RECORDS, count
+from .otp import get_otp_store
+from .runtime import private_tempdir
+from .wizard import CacheWizardStore, get_wizard_store
+
+DEFAULTS = {
+    # sessions deleted per transaction
+    "BATCH_SIZE": 500,
+    # seconds between two batches
+    "PAUSE": 0.05,
+    # seconds between two sweeps of the background thread
+    "INTERVAL": 600,
+    "THREAD": False,
+    "PURGE_CACHES": True,
+    # the progress file, in the private temp directory by default
+    "STATE_PATH": None,
+}
+
+
+def get_sweeper_settings():
+    return {**DEFAULTS, **getattr(settings, "USERS_SWEEPER", {})}
+
+
+def default_state_path():
+    name = hashlib.blake2b(str(settings.BASE_DIR).encode(), digest_size=6).hexdigest()
+    return os.path.join(private_tempdir(), f"ubaar-sweeper-{name}.json")
+
+
+def session_model():
+    """
+    The model of the configured session engine, None if it keeps no table
+    """
+    engine = import_module(settings.SESSION_ENGINE)
+    get_model_class = getattr(engine.SessionStore, "get_model_class", None)
+    return get_model_class() if get_model_class else None
+
+
+def purge_expired(cache):
+    """
+    Delete the expired entries of a cache whose backend keeps them until they
+    are read, returns how many
+    """
+    if isinstance(cache, LocMemCache):
+        with cache._lock:
+            expired = [key for key in cache._cache if cache._has_expired(key)]
+            for key in expired:
+                cache._delete(key)
+        return len(expired)
+    if isinstance(cache, FileBasedCache):
+        purged = 0
+        for name in cache._list_cache_files():
+            try:
+                with open(name, "rb") as f:
+                    # deletes the file if it expired
+                    purged += cache._is_expired(f)
+            except FileNotFoundError:
+                pass
+        return purged
+    return 0
+
+
+def purge_caches():
+    """
+    Drop the expired otp, attempt, ban and wizard records, returns how many of
+    each kind, an alias shared by several kinds is purged once
+    """
+    aliases = {get_otp_store().alias: "otp"}
+    purged = {"otp": 0, "ban": 0, "wizard": 0}
+    counter = get_attempt_counter()
+    table = getattr(counter, "table", None)
+    if table is not None:
+        purged["ban"] += table.purge()
+    else:
+        aliases.setdefault(counter.alias, "ban")
+    store = get_wizard_store()
+    if isinstance(store, CacheWizardStore):
+        aliases.setdefault(store.alias, "wizard")
+    for alias, kind in aliases.items():
+        purged[kind] += purge_expired(caches[alias])
+    for kind, amount in purged.items():
+        count(SWEPT_RECORDS, kind, amount)
+    return purged
+
+
+class SessionSweeper:
+    """
+    Deletes the expired sessions in batches, see the module docstring
+    """
+
+    def __init__(self, **options):
+        self.options = {**get_sweeper_settings(), **options}
+        self.state_path = self.options["STATE_PATH"] or default_state_path()
+        self._stop = threading.Event()
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_state(self, state):
+        # replaced at once, a crash never leaves half a file
+        temporary = f"{self.state_path}.{os.getpid()}"
+        with open(temporary, "w") as f:
+            json.dump(state, f)
+        os.replace(temporary, self.state_path)
+
+    def sweep(self, restart=False):
+        """
+        Delete every session expired by now, batch by batch
+        returns the stats of the sweep, None if another process is sweeping
+        """
+        with open(f"{self.state_path}.lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                stats = self._sweep({} if restart else self.load_state())
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        if self.options["PURGE_CACHES"]:
+            stats["purged"] = purge_caches()
+        return stats
+
+    def _sweep(self, state):
+        model = session_model()
+        cursor = state.get("cursor")
+        stats = {"deleted": 0, "batches": 0, "resumed": bool(state.get("running"))}
+        stats["from"] = cursor
+        if model is None:
+            return stats
+        now = datetime.now(timezone.utc)
+        expired = model.objects.filter(expire_date__lt=now).order_by("expire_date")
+        if cursor is not None:
+            expired = expired.filter(expire_date__gte=datetime.fromisoformat(cursor))
+        batch_size = self.options["BATCH_SIZE"]
+        start = time.perf_counter()
+        longest = 0
+        while not self._stop.is_set():
+            batch_start = time.perf_counter()
+            rows = list(expired.values_list("session_key", "expire_date")[:batch_size])
+            if not rows:
+                break
+            model.objects.filter(pk__in=[key for key, _ in rows]).delete()
+            longest = max(longest, time.perf_counter() - batch_start)
+            stats["deleted"] += len(rows)
+            stats["batches"] += 1
+            count(SWEPT_RECORDS, "session", len(rows))
+            cursor = rows[-1][1].isoformat()
+            self.save_state({"cursor": cursor, "running": True})
+            self._stop.wait(self.options["PAUSE"])
+        seconds = time.perf_counter() - start
+        stopped = self._stop.is_set()
+        # a finished pass starts the next one from the oldest session again
+        self.save_state({"cursor": cursor if stopped else None, "running": stopped})
+        stats["seconds"] = round(seconds, 3)
+        stats["rows_per_second"] = round(stats["deleted"] / seconds) if seconds else 0
+        stats["longest_batch_ms"] = round(longest * 1000, 1)
+        return stats
+
+    def run_forever(self, report=None):
+        """
+        Sweep every `INTERVAL` seconds until stopped, `report` gets the stats
+        """
+        while not self._stop.is_set():
+            # this thread's connection may have been closed by the database
+            close_old_connections()
+            stats = self.sweep()
+            if report is not None and stats is not None:
+                report(stats)
+            self._stop.wait(self.options["INTERVAL"])
+
+    def stop(self):
+        self._stop.set()
+
+
+_sweeper = None
+
+
+def start_sweeper():
+    """
+    Sweep in a daemon thread of this process, when `USERS_SWEEPER["THREAD"]`
+    is on, called from interview/wsgi.py and interview/asgi.py
+    """
+    global _sweeper
+    if _sweeper is None and get_sweeper_settings()["THREAD"]:
+        _sweeper = SessionSweeper()
+        threading.Thread(
+            target=_sweeper.run_forever, name="users-sweeper", daemon=True
+        ).start()
+    return _sweeper
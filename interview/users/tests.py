@@ -1,3 +1,2157 @@
-from django.test import TestCase
+import importlib
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.apps import apps as django_apps
+from django.conf import settings as django_settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache.backends.base import CacheKeyWarning
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from django.http import HttpResponse
+from django.shortcuts import render
+from django.test import (Client, RequestFactory, SimpleTestCase, TestCase,
+                         TransactionTestCase, override_settings)
+from django.urls import include, path, reverse
+from django.utils import timezone
+
+from . import async_api, async_views
+from .admission import Gate, get_admission_controller
+from .api import START_LIMIT
+from .attempts import (MAX_ATTEMPS, CacheAttemptCounter, FileCacheAttemptCounter,
+                       RedisAttemptCounter)
+from .bantable import SharedBanTable, default_table_path, key_hash
+from .database import ReplicaRouter, read_from_replica
+from .directory import UserDirectory, get_user_directory
+from .forms import LoginForm, PhonenumberForm
+from .hashing import (HashingOverloaded, HashingTimeout, get_hashing_service,
+                      hashing_deadline)
+from .importing import ImportStats, UserImporter
+from .instrumentation import count_operations, uninstall
+from .loadtest import (Recorder, Response, Step, build_journeys, latency_summary,
+                       percentile)
+from .management.commands.bench_funnel import isolated
+from .membership import (UsernameIndex, get_username_index,
+                         registered_usernames)
+from .metrics import OTPS_ISSUED, RETIRED, count
+from .models import OutboundMessage
+from .otp import (OTP_SENDS_PER_IP, OTP_SENDS_PER_PHONENUMBER, OTPResult,
+                  OTPStore, get_otp_store)
+from .profiling import _cprofile_lock
+from .provisioning import UsernameTaken, provision_user
+from .rendering import render_page
+from .sms import FakeSMSGateway, SMSDispatcher, enqueue_sms
+from .sweeper import SessionSweeper, purge_caches
+from .urls import flow_urlpatterns
+from .utils import (ban_user_if_necessary, check_is_user_banned,
+                    reset_user_attempts)
+from .validators import normalize_phonenumber
+from .wizard import CacheWizardStore, SignedCookieWizardStore, WizardState
+
+normalize_usernames = importlib.import_module(
+    "users.migrations.0003_normalize_usernames"
+).normalize_usernames
 
 # Create your tests here.
+
+BUDGETS_PATH = Path(__file__).with_name("perf_budgets.json")
+# a redis server for the tests of the redis backends, skipped without one
+REDIS_URL = os.environ.get("USERS_TEST_REDIS_URL")
+
+
+def index_and_bans_in(directory):
+    """
+    Settings keeping the username index, the ban table, the metrics and the user
+    directory of a test apart from the ones of the development server and of
+    the other tests
+    """
+    return override_settings(
+        USERS_USERNAME_INDEX={"PATH": f"{directory}/usernames"},
+        USERS_BAN_TABLE={"PATH": f"{directory}/bans"},
+        USERS_METRICS={"DIR": f"{directory}/metrics"},
+        USERS_DIRECTORY={
+            "KEY_PREFIX": f"user:{directory}",
+            "STAMPS_PATH": f"{directory}/stamps",
+        },
+        # fast hashing, the hasher's speed isn't under test
+        PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    )
+
+
+class RegistrationQueriesTest(TestCase):
+    """
+    The whole sign up flow stays within a fixed number of queries
+    """
+
+    phonenumber = "09121234567"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = index_and_bans_in(directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        get_username_index().rebuild(registered_usernames())
+
+    def register(self):
+        response = self.client.post(
+            reverse("users:check"), {"phonenumber": self.phonenumber}
+        )
+        register_url = response["Location"]
+        response = self.client.get(register_url)
+        token = re.search(
+            r'name="otp_cache_key" value="([^"]+)"', response.content.decode()
+        ).group(1)
+        otp = get_otp_store().cache.get(f"otp:{token}").split(":")[1]
+        self.client.post(register_url, {"otp": otp, "otp_cache_key": token})
+        self.client.post(
+            reverse("users:register_info"),
+            {"first_name": "first", "last_name": "last", "email": "a@example.com"},
+        )
+        self.client.get(reverse("users:register_password"))
+        return self.client.post(
+            reverse("users:register_password"), {"password1": "Unguessable-4821"}
+        )
+
+    def test_registration_query_count(self):
+        # 1     confirm the username index's miss before texting an otp
+        # 2     queue the otp sms
+        # 3-5   insert the user, no uniqueness select, in its own savepoint
+        # 6-9   login() creates the session
+        # 10    update last_login
+        # 11-13 the session middleware saves the logged in session
+        with self.assertNumQueries(13):
+            response = self.register()
+        self.assertContains(response, "Successfully")
+        user = get_user_model().objects.get()
+        self.assertEqual(user.username, "+989121234567")
+        self.assertTrue(user.check_password("Unguessable-4821"))
+
+    def test_register_info_without_a_number(self):
+        response = self.client.get(reverse("users:register_info"))
+        self.assertRedirects(response, reverse("users:check"))
+
+    def test_duplicate_username(self):
+        user_model = get_user_model()
+        provision_user(user_model(username="+989121234567"), "Unguessable-4821")
+        with self.assertNumQueries(4), self.assertRaises(UsernameTaken):
+            provision_user(user_model(username="+989121234567"), "Unguessable-4821")
+
+
+class OperationBudgetTest(TestCase):
+    """
+    Every path through the flow stays within its budget in `perf_budgets.json`:
+    queries, writes, cache calls, ban table calls and password hashes, by name.
+    run with UPDATE_PERF_BUDGETS=1 to write the measured counts as the budgets
+    """
+
+    phonenumber = "+989121234567"
+    password = "Unguessable-4821"
+    address = "10.0.0.1"
+    update = os.environ.get("UPDATE_PERF_BUDGETS") == "1"
+    measured = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with open(BUDGETS_PATH) as f:
+            cls.budgets = json.load(f)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.update and cls.measured:
+            with open(BUDGETS_PATH, "w") as f:
+                json.dump(
+                    dict(sorted({**cls.budgets, **cls.measured}.items())), f, indent=2
+                )
+                f.write("\n")
+        super().tearDownClass()
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = index_and_bans_in(directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # replica reads go to the primary, the replica is a second connection to
+        # the test database that wouldn't see the data of the test's transaction
+        replica = override_settings(USERS_READ_REPLICA=None)
+        replica.enable()
+        self.addCleanup(replica.disable)
+        # the counting wraps the hashers configured above
+        self.addCleanup(uninstall)
+        get_username_index().rebuild(registered_usernames())
+        self.client.defaults["REMOTE_ADDR"] = self.address
+
+    def assertWithinBudget(self, path, method, url, data=None, **extra):
+        with count_operations() as counts:
+            response = getattr(self.client, method)(url, data, **extra)
+        # the totals are the sums of the named operations
+        measured = {
+            name: count
+            for name, count in sorted(counts.items())
+            if name not in ("cache", "ban_table")
+        }
+        if self.update:
+            self.measured[path] = measured
+            return response
+        self.assertIn(path, self.budgets, f"no budget for {path}")
+        budget = self.budgets[path]
+        over = {
+            name: f"{count} > {budget.get(name, 0)}"
+            for name, count in measured.items()
+            if count > budget.get(name, 0)
+        }
+        self.assertFalse(over, f"{path} over its budget")
+        return response
+
+    def register_user(self):
+        provision_user(get_user_model()(username=self.phonenumber), self.password)
+
+    def fail_attempts(self, identifier, times=MAX_ATTEMPS):
+        """
+        Record failed attempts, `MAX_ATTEMPS` of them leave one before the ban
+        """
+        for _ in range(times):
+            ban_user_if_necessary(identifier)
+
+    def ban(self, identifier):
+        self.fail_attempts(identifier, MAX_ATTEMPS + 1)
+
+    def start_login(self):
+        self.client.post(reverse("users:check"), {"phonenumber": self.phonenumber})
+
+    def issue_otp(self):
+        response = self.client.get(self.register_url)
+        token = re.search(
+            r'name="otp_cache_key" value="([^"]+)"', response.content.decode()
+        ).group(1)
+        return token, get_otp_store().cache.get(f"otp:{token}").split(":")[1]
+
+    def reach_password_step(self):
+        token, otp = self.issue_otp()
+        self.client.post(self.register_url, {"otp": otp, "otp_cache_key": token})
+        self.client.post(
+            reverse("users:register_info"),
+            {"first_name": "first", "last_name": "last", "email": "a@example.com"},
+        )
+
+    @property
+    def register_url(self):
+        return reverse("users:register", args=[self.phonenumber])
+
+    # check_phonenumber
+
+    def test_check_get(self):
+        self.assertWithinBudget("check_phonenumber.get", "get", reverse("users:check"))
+
+    def test_check_get_banned_username(self):
+        self.register_user()
+        self.start_login()
+        self.ban(self.phonenumber)
+        response = self.assertWithinBudget(
+            "check_phonenumber.get_banned_username", "get", reverse("users:check")
+        )
+        self.assertContains(response, "already banned")
+
+    def test_check_new_phonenumber(self):
+        response = self.assertWithinBudget(
+            "check_phonenumber.post_new",
+            "post",
+            reverse("users:check"),
+            {"phonenumber": self.phonenumber},
+        )
+        self.assertRedirects(response, self.register_url, fetch_redirect_response=False)
+
+    def test_check_registered_phonenumber(self):
+        self.register_user()
+        response = self.assertWithinBudget(
+            "check_phonenumber.post_registered",
+            "post",
+            reverse("users:check"),
+            {"phonenumber": self.phonenumber},
+        )
+        self.assertTemplateUsed(response, "users/login.html")
+
+    def test_check_invalid_phonenumber(self):
+        self.assertWithinBudget(
+            "check_phonenumber.post_invalid",
+            "post",
+            reverse("users:check"),
+            {"phonenumber": "12"},
+        )
+
+    def test_banned_ip(self):
+        self.ban(self.address)
+        response = self.assertWithinBudget(
+            "ban_check.banned_ip", "get", reverse("users:check")
+        )
+        self.assertEqual(response.status_code, 429)
+
+    # login_user
+
+    def test_login_get(self):
+        self.register_user()
+        self.start_login()
+        self.assertWithinBudget("login_user.get", "get", reverse("users:login_user"))
+
+    def test_login_success(self):
+        self.register_user()
+        self.start_login()
+        response = self.assertWithinBudget(
+            "login_user.post_success",
+            "post",
+            reverse("users:login_user"),
+            {"username": self.phonenumber, "password": self.password},
+        )
+        self.assertContains(response, "Successfully")
+
+    def test_login_wrong_password(self):
+        self.register_user()
+        self.start_login()
+        self.assertWithinBudget(
+            "login_user.post_wrong_password",
+            "post",
+            reverse("users:login_user"),
+            {"username": self.phonenumber, "password": "wrong"},
+        )
+
+    def test_login_wrong_password_bans(self):
+        self.register_user()
+        self.start_login()
+        self.fail_attempts(self.phonenumber)
+        response = self.assertWithinBudget(
+            "login_user.post_wrong_password_banning",
+            "post",
+            reverse("users:login_user"),
+            {"username": self.phonenumber, "password": "wrong"},
+        )
+        self.assertRedirects(
+            response, reverse("users:check"), fetch_redirect_response=False
+        )
+
+    def test_login_unregistered(self):
+        self.assertWithinBudget(
+            "login_user.post_unregistered",
+            "post",
+            reverse("users:login_user"),
+            {"username": self.phonenumber, "password": self.password},
+        )
+
+    def test_login_banned_username(self):
+        self.register_user()
+        self.start_login()
+        self.ban(self.phonenumber)
+        response = self.assertWithinBudget(
+            "login_user.post_banned_username",
+            "post",
+            reverse("users:login_user"),
+            {"username": self.phonenumber, "password": self.password},
+        )
+        self.assertContains(response, "user is banned")
+
+    # register_otp
+
+    def test_register_otp_get(self):
+        self.assertWithinBudget("register_otp.get", "get", self.register_url)
+
+    def test_register_otp_get_banned(self):
+        self.ban(self.phonenumber)
+        self.assertWithinBudget("register_otp.get_banned", "get", self.register_url)
+
+    def test_register_otp_reload(self):
+        token, otp = self.issue_otp()
+        # the pending otp is shown again, not texted again
+        self.assertEqual(self.issue_otp(), (token, otp))
+        self.assertEqual(OutboundMessage.objects.count(), 1)
+
+    def test_register_otp_texts_throttled(self):
+        for _ in range(OTP_SENDS_PER_PHONENUMBER):
+            # a new client every time, nothing pending to show again
+            self.client.cookies.clear()
+            self.issue_otp()
+        self.client.cookies.clear()
+        response = self.client.get(self.register_url)
+        self.assertContains(response, "too many otps texted")
+        self.assertEqual(OutboundMessage.objects.count(), OTP_SENDS_PER_PHONENUMBER)
+
+    def test_register_otp_texts_throttled_per_ip(self):
+        for i in range(OTP_SENDS_PER_IP):
+            self.client.get(reverse("users:register", args=[f"+9891212{i:05}"]))
+        response = self.client.get(self.register_url)
+        self.assertContains(response, "too many otps texted")
+        self.assertEqual(OutboundMessage.objects.count(), OTP_SENDS_PER_IP)
+
+    def test_register_otp_invalid_phonenumber(self):
+        self.assertWithinBudget(
+            "register_otp.invalid_phonenumber",
+            "get",
+            reverse("users:register", args=["12"]),
+        )
+
+    def test_register_otp_right(self):
+        token, otp = self.issue_otp()
+        response = self.assertWithinBudget(
+            "register_otp.post_right",
+            "post",
+            self.register_url,
+            {"otp": otp, "otp_cache_key": token},
+        )
+        self.assertRedirects(
+            response, reverse("users:register_info"), fetch_redirect_response=False
+        )
+
+    def test_register_otp_wrong(self):
+        token, otp = self.issue_otp()
+        self.assertWithinBudget(
+            "register_otp.post_wrong",
+            "post",
+            self.register_url,
+            {"otp": f"{(int(otp) + 1) % 10**6:06d}", "otp_cache_key": token},
+        )
+
+    def test_register_otp_wrong_bans(self):
+        token, otp = self.issue_otp()
+        self.fail_attempts(self.phonenumber)
+        response = self.assertWithinBudget(
+            "register_otp.post_wrong_banning",
+            "post",
+            self.register_url,
+            {"otp": f"{(int(otp) + 1) % 10**6:06d}", "otp_cache_key": token},
+        )
+        self.assertRedirects(
+            response, reverse("users:check"), fetch_redirect_response=False
+        )
+
+    def test_register_otp_unknown_token(self):
+        self.assertWithinBudget(
+            "register_otp.post_unknown_token",
+            "post",
+            self.register_url,
+            {"otp": "123456", "otp_cache_key": "0" * 20},
+        )
+
+    # register_info
+
+    def test_register_info_get(self):
+        token, otp = self.issue_otp()
+        self.client.post(self.register_url, {"otp": otp, "otp_cache_key": token})
+        self.assertWithinBudget(
+            "register_info.get", "get", reverse("users:register_info")
+        )
+
+    def test_register_info_post(self):
+        token, otp = self.issue_otp()
+        self.client.post(self.register_url, {"otp": otp, "otp_cache_key": token})
+        self.assertWithinBudget(
+            "register_info.post",
+            "post",
+            reverse("users:register_info"),
+            {"first_name": "first", "last_name": "last", "email": "a@example.com"},
+        )
+
+    # register_password
+
+    def test_register_password_get(self):
+        self.reach_password_step()
+        self.assertWithinBudget(
+            "register_password.get", "get", reverse("users:register_password")
+        )
+
+    def test_register_password_success(self):
+        self.reach_password_step()
+        response = self.assertWithinBudget(
+            "register_password.post_success",
+            "post",
+            reverse("users:register_password"),
+            {"password1": self.password, "password2": self.password},
+        )
+        self.assertContains(response, "Successfully")
+
+    def test_register_password_rejected(self):
+        self.reach_password_step()
+        self.assertWithinBudget(
+            "register_password.post_rejected",
+            "post",
+            reverse("users:register_password"),
+            {"password1": "123", "password2": "123"},
+        )
+
+    def test_register_password_taken(self):
+        self.reach_password_step()
+        self.register_user()
+        self.assertWithinBudget(
+            "register_password.post_taken",
+            "post",
+            reverse("users:register_password"),
+            {"password1": self.password, "password2": self.password},
+        )
+
+    def test_register_password_incomplete(self):
+        self.assertWithinBudget(
+            "register_password.post_incomplete",
+            "post",
+            reverse("users:register_password"),
+            {"password1": self.password, "password2": self.password},
+        )
+
+    # api
+
+    def api_start(self):
+        response = self.client.post(
+            reverse("users:api_start"),
+            {"phonenumber": self.phonenumber},
+            content_type="application/json",
+        )
+        token = response.json()["token"]
+        return token, get_otp_store().cache.get(f"otp:{token}").split(":")[1]
+
+    def api_ticket(self):
+        token, otp = self.api_start()
+        response = self.client.post(
+            reverse("users:api_verify"),
+            {"phonenumber": self.phonenumber, "token": token, "otp": otp},
+            content_type="application/json",
+        )
+        return response.json()["ticket"]
+
+    def api_register(self, path, ticket):
+        return self.assertWithinBudget(
+            path,
+            "post",
+            reverse("users:api_register"),
+            {
+                "ticket": ticket,
+                "first_name": "first",
+                "last_name": "last",
+                "email": "a@example.com",
+                "password1": self.password,
+            },
+            content_type="application/json",
+        )
+
+    def test_api_start_new(self):
+        response = self.assertWithinBudget(
+            "api.start_new",
+            "post",
+            reverse("users:api_start"),
+            {"phonenumber": self.phonenumber},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["next"], "verify")
+        self.assertEqual(response["X-RateLimit-Limit"], str(MAX_ATTEMPS))
+
+    def test_api_start_registered(self):
+        self.register_user()
+        response = self.assertWithinBudget(
+            "api.start_registered",
+            "post",
+            reverse("users:api_start"),
+            {"phonenumber": self.phonenumber},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json(), {"next": "login"})
+
+    def test_api_start_json(self):
+        response = self.client.post(
+            reverse("users:api_start"),
+            {"phonenumber": "0912"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "invalid")
+        self.assertIn("phonenumber", response.json()["fields"])
+
+    def test_api_refuses_forms(self):
+        # a form posted cross-site would log the browser in without a csrf token
+        self.register_user()
+        response = self.client.post(
+            reverse("users:api_login"),
+            {"username": self.phonenumber, "password": self.password},
+        )
+        self.assertEqual(response.status_code, 415)
+        self.assertEqual(response.json(), {"error": "unsupported_media_type"})
+        self.assertNotIn("sessionid", response.cookies)
+
+    def test_api_start_throttled(self):
+        self.register_user()
+        for _ in range(START_LIMIT):
+            response = self.client.post(
+                reverse("users:api_start"),
+                {"phonenumber": self.phonenumber},
+                content_type="application/json",
+            )
+            self.assertEqual(response.json(), {"next": "login"})
+        response = self.client.post(
+            reverse("users:api_start"),
+            {"phonenumber": "+989121234568"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 429)
+
+    def test_api_start_texts_throttled(self):
+        for _ in range(OTP_SENDS_PER_PHONENUMBER):
+            self.api_start()
+        response = self.client.post(
+            reverse("users:api_start"),
+            {"phonenumber": self.phonenumber},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(OutboundMessage.objects.count(), OTP_SENDS_PER_PHONENUMBER)
+
+    def test_api_verify_right(self):
+        token, otp = self.api_start()
+        response = self.assertWithinBudget(
+            "api.verify_right",
+            "post",
+            reverse("users:api_verify"),
+            {"phonenumber": self.phonenumber, "token": token, "otp": otp},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["next"], "register")
+
+    def test_api_verify_wrong(self):
+        token, otp = self.api_start()
+        response = self.assertWithinBudget(
+            "api.verify_wrong",
+            "post",
+            reverse("users:api_verify"),
+            {"phonenumber": self.phonenumber, "token": token, "otp": "000000"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "mismatch")
+        self.assertEqual(response["X-RateLimit-Remaining"], str(MAX_ATTEMPS - 1))
+
+    def test_api_verify_wrong_bans(self):
+        token, otp = self.api_start()
+        self.fail_attempts(self.phonenumber)
+        response = self.assertWithinBudget(
+            "api.verify_wrong_banning",
+            "post",
+            reverse("users:api_verify"),
+            {"phonenumber": self.phonenumber, "token": token, "otp": "000000"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+
+    def test_api_register_success(self):
+        response = self.api_register("api.register_success", self.api_ticket())
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(
+            get_user_model().objects.get(username=self.phonenumber).check_password(
+                self.password
+            )
+        )
+
+    def test_api_register_taken(self):
+        ticket = self.api_ticket()
+        self.register_user()
+        response = self.api_register("api.register_taken", ticket)
+        self.assertEqual(response.status_code, 409)
+
+    def test_api_register_forged_ticket(self):
+        response = self.api_register("api.register_forged", f"{self.phonenumber}:x")
+        self.assertEqual(response.status_code, 403)
+
+    def test_api_login_success(self):
+        self.register_user()
+        response = self.assertWithinBudget(
+            "api.login_success",
+            "post",
+            reverse("users:api_login"),
+            {"username": self.phonenumber, "password": self.password},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json(), {"ok": True})
+        self.assertIn("sessionid", response.cookies)
+
+    def test_api_login_wrong_password(self):
+        self.register_user()
+        response = self.assertWithinBudget(
+            "api.login_wrong_password",
+            "post",
+            reverse("users:api_login"),
+            {"username": self.phonenumber, "password": "wrong"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["error"], "invalid_credentials")
+        self.assertEqual(response["X-RateLimit-Remaining"], str(MAX_ATTEMPS - 1))
+
+    def test_api_login_banned_username(self):
+        self.register_user()
+        self.ban(self.phonenumber)
+        response = self.assertWithinBudget(
+            "api.login_banned_username",
+            "post",
+            reverse("users:api_login"),
+            {"username": self.phonenumber, "password": self.password},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json(), {"error": "banned"})
+
+
+@override_settings(
+    USERS_BAN_PREFIXES={"IPV4": [(24, 5)], "IPV6": [(64, 5)], "PHONE": [(10, 5)]}
+)
+class BanPrefixTest(TestCase):
+    """
+    Failures spread over a subnet or a block of phonenumbers ban all of it
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = index_and_bans_in(directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def spread(self, identifiers):
+        # one failure each, never enough to ban any of them alone
+        for identifier in identifiers:
+            self.assertFalse(ban_user_if_necessary(identifier))
+
+    def test_ipv4_subnet(self):
+        self.spread(f"203.0.113.{i}" for i in range(1, 6))
+        self.assertTrue(ban_user_if_necessary("203.0.113.6"))
+        self.assertTrue(check_is_user_banned("203.0.113.200"))
+        self.assertFalse(check_is_user_banned("203.0.114.1"))
+
+    def test_ipv6_subnet(self):
+        self.spread(f"2001:db8::{i:x}" for i in range(1, 6))
+        self.assertTrue(ban_user_if_necessary("2001:db8::ffff:1"))
+        self.assertTrue(check_is_user_banned("2001:db8::1:2:3:4"))
+        self.assertFalse(check_is_user_banned("2001:db8:0:1::1"))
+
+    def test_phonenumber_block(self):
+        self.spread(f"+98912123400{i}" for i in range(5))
+        self.assertTrue(ban_user_if_necessary("+989121234005"))
+        self.assertTrue(check_is_user_banned("+989121234999"))
+        self.assertFalse(check_is_user_banned("+989121235000"))
+
+    def test_reset_keeps_the_subnet_count(self):
+        self.spread(f"203.0.113.{i}" for i in range(1, 6))
+        reset_user_attempts(*(f"203.0.113.{i}" for i in range(1, 6)))
+        self.assertTrue(ban_user_if_necessary("203.0.113.1"))
+
+    def test_api_reports_the_subnet_ban(self):
+        self.spread(f"203.0.113.{i}" for i in range(1, 6))
+        ban_user_if_necessary("203.0.113.6")
+        response = self.client.post(
+            reverse("users:api_start"),
+            {"phonenumber": "09121234567"},
+            content_type="application/json",
+            REMOTE_ADDR="203.0.113.50",
+        )
+        self.assertEqual(response.status_code, 429)
+
+
+class AuthTokenTest(TestCase):
+    """
+    With auth tokens on, a logged in request costs no query until logout
+    """
+
+    phonenumber = "+989121234567"
+    password = "Unguessable-4821"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        for settings in (
+            index_and_bans_in(directory.name),
+            override_settings(
+                USERS_AUTH_TOKENS={
+                    "ENABLED": True,
+                    "DENYLIST_PATH": f"{directory.name}/denylist",
+                },
+                USERS_READ_REPLICA=None,
+            ),
+        ):
+            settings.enable()
+            self.addCleanup(settings.disable)
+        get_username_index().rebuild(registered_usernames())
+        self.user = provision_user(
+            get_user_model()(username=self.phonenumber), self.password
+        )
+
+    def login(self):
+        self.client.post(reverse("users:check"), {"phonenumber": self.phonenumber})
+        response = self.client.post(
+            reverse("users:login_user"),
+            {"username": self.phonenumber, "password": self.password},
+        )
+        self.assertIn("users_auth", response.cookies)
+        return response.cookies["users_auth"].value
+
+    def test_authenticated_request_without_queries(self):
+        self.login()
+        # the first one loads the user into the cache
+        self.client.get(reverse("users:check"))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("users:check"))
+        self.assertEqual(response.wsgi_request.user, self.user)
+
+    def test_bearer_header(self):
+        token = self.login()
+        self.client.cookies.clear()
+        response = self.client.get(
+            reverse("users:check"), headers={"Authorization": f"Bearer {token}"}
+        )
+        self.assertEqual(response.wsgi_request.user, self.user)
+
+    def test_logout_revokes_the_token(self):
+        token = self.login()
+        self.client.post(reverse("users:logout_user"))
+        self.client.cookies.clear()
+        self.client.cookies["users_auth"] = token
+        response = self.client.get(reverse("users:check"))
+        self.assertFalse(response.wsgi_request.user.is_authenticated)
+
+    def test_password_change_invalidates_the_token(self):
+        token = self.login()
+        self.user.set_password("Another-Unguessable-1")
+        self.user.save()
+        self.client.cookies.clear()
+        self.client.cookies["users_auth"] = token
+        response = self.client.get(reverse("users:check"))
+        self.assertFalse(response.wsgi_request.user.is_authenticated)
+
+    def test_forged_token(self):
+        token = self.login()
+        self.client.cookies.clear()
+        self.client.cookies["users_auth"] = token.replace(
+            f"{self.user.pk}:", f"{self.user.pk + 1}:", 1
+        )
+        response = self.client.get(reverse("users:check"))
+        self.assertFalse(response.wsgi_request.user.is_authenticated)
+
+    def test_full_denylist_fails_closed(self):
+        # a single bucket, the ninth revocation can't get a slot of its own
+        denylist = SharedBanTable(f"{self.directory}/full", slots=8)
+        now = int(time.time())
+        for i in range(9):
+            denylist.deny(f"token:{i}", now + 60 + i, now=now)
+        self.assertEqual(denylist.denied([f"token:{i}" for i in range(9)]), [True] * 9)
+        self.assertEqual(denylist.denied(["token:never-revoked"]), [True])
+        self.assertEqual(denylist.denied(["token:0"], now=now + 69), [False])
+
+
+class UserDirectoryTest(TestCase):
+    """
+    The phonenumber check loads the user once for the login that follows
+    """
+
+    phonenumber = "+989121234567"
+    password = "Unguessable-4821"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for settings in (
+            index_and_bans_in(directory.name),
+            override_settings(USERS_READ_REPLICA=None),
+        ):
+            settings.enable()
+            self.addCleanup(settings.disable)
+        get_username_index().rebuild(registered_usernames())
+        self.user = provision_user(
+            get_user_model()(username=self.phonenumber), self.password
+        )
+
+    def login(self, password):
+        return self.client.post(
+            reverse("users:login_user"),
+            {"username": self.phonenumber, "password": password},
+        )
+
+    def test_check_then_login_reads_the_user_once(self):
+        with self.assertNumQueries(1):
+            self.client.post(reverse("users:check"), {"phonenumber": self.phonenumber})
+            self.login("wrong")
+            self.login("still wrong")
+
+    def test_password_change_drops_the_entry(self):
+        self.client.post(reverse("users:check"), {"phonenumber": self.phonenumber})
+        self.user.set_password("Another-Unguessable-1")
+        self.user.save()
+        self.assertNotContains(self.login(self.password), "Successfully")
+        self.assertContains(self.login("Another-Unguessable-1"), "Successfully")
+
+    def test_only_phonenumbers_are_cached(self):
+        directory = get_user_directory()
+        self.assertIsNone(directory.key("+98 912 123 4567"))
+        get_user_model().objects.create(username="admin")
+        with self.assertNumQueries(2):
+            self.assertIsNotNone(directory.entry("admin"))
+            self.assertIsNotNone(directory.entry("admin"))
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", CacheKeyWarning)
+            get_user_model().objects.create(username="+98 912 123 4568")
+            directory.entry("+98 912 123 4568")
+
+    def test_change_in_another_worker_drops_the_entry(self):
+        directory = get_user_directory()
+        directory.entry(self.phonenumber)
+        get_user_model().objects.filter(pk=self.user.pk).update(is_active=False)
+        # a worker with a cache of its own, sharing the stamps of the host
+        other = UserDirectory(
+            "default", prefix=directory.prefix, stamps=directory.stamps
+        )
+        other.discard(self.phonenumber)
+        self.assertFalse(directory.user(self.phonenumber).is_active)
+
+
+class SessionSweeperTest(TestCase):
+    """
+    Expired sessions go in batches, live ones stay
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = index_and_bans_in(directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.sweeper = SessionSweeper(
+            BATCH_SIZE=3,
+            PAUSE=0,
+            PURGE_CACHES=False,
+            STATE_PATH=os.path.join(directory.name, "sweeper.json"),
+        )
+        now = timezone.now()
+        # 7 expired, 3 live
+        for minutes in [*range(-7, 0), 5, 10, 15]:
+            store = SessionStore()
+            store.set_expiry(now + timedelta(minutes=minutes))
+            store.save()
+
+    def test_sweep_in_batches(self):
+        stats = self.sweeper.sweep()
+        self.assertEqual((stats["deleted"], stats["batches"]), (7, 3))
+        self.assertEqual(Session.objects.count(), 3)
+        self.assertFalse(self.sweeper.load_state()["running"])
+
+    def test_resume_from_the_saved_progress(self):
+        self.sweeper.options["BATCH_SIZE"] = 2
+        # stopped after its first batch
+        self.sweeper._stop.wait = lambda timeout: self.sweeper.stop()
+        self.assertEqual(self.sweeper.sweep()["deleted"], 2)
+        self.assertTrue(self.sweeper.load_state()["running"])
+        stats = SessionSweeper(**self.sweeper.options).sweep()
+        self.assertTrue(stats["resumed"])
+        self.assertEqual(stats["deleted"], 5)
+        self.assertEqual(Session.objects.count(), 3)
+
+    def test_session_expiring_before_the_cursor(self):
+        self.sweeper.sweep()
+        # saved after the sweep, expired before the last session it deleted
+        store = SessionStore()
+        store.set_expiry(timezone.now() - timedelta(minutes=30))
+        store.save()
+        self.assertEqual(self.sweeper.sweep()["deleted"], 1)
+        self.assertEqual(Session.objects.count(), 3)
+
+    def test_purge_expired_otps(self):
+        store = get_otp_store()
+        store.cache.clear()
+        store.cache.set(store.key("expired"), "0:123456:+989121234567", timeout=-1)
+        store.issue("+989121234567")
+        self.assertEqual(purge_caches()["otp"], 1)
+        self.assertEqual(len(store.cache._cache), 1)
+
+
+class RenderingTest(TestCase):
+    """
+    Cached pages are the rendered ones, revalidated with an ETag
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = index_and_bans_in(directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    @staticmethod
+    def without_csrf_token(response):
+        content = response.content.decode()
+        return re.sub(r'csrfmiddlewaretoken" value="\w+"', "", content)
+
+    def test_spliced_page_is_the_rendered_one(self):
+        request = RequestFactory().get("/", REMOTE_ADDR="203.0.113.7")
+        request.user = AnonymousUser()
+        context = {"form": LoginForm(initial={"username": '"><script>'})}
+        self.assertEqual(
+            self.without_csrf_token(render_page(request, "users/login.html", context)),
+            self.without_csrf_token(render(request, "users/login.html", context)),
+        )
+
+    def test_conditional_get(self):
+        response = self.client.get(reverse("users:check"))
+        etag = response.headers["ETag"]
+        response = self.client.get(
+            reverse("users:check"), headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 304)
+        # the header shows the ip
+        response = self.client.get(
+            reverse("users:check"),
+            headers={"If-None-Match": etag},
+            REMOTE_ADDR="203.0.113.7",
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_compressed(self):
+        response = self.client.get(
+            reverse("users:check"), headers={"Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+
+
+class AdmissionControlTest(TestCase):
+    """
+    Gates queue and turn requests away, late logins shed the sign ups first
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for settings in (
+            index_and_bans_in(directory.name),
+            override_settings(USERS_ADMISSION={"ENABLED": True}),
+        ):
+            settings.enable()
+            self.addCleanup(settings.disable)
+        # the middleware stack is built with admission control on
+        self.client = Client()
+
+    def test_gate(self):
+        gate = Gate(limit=1, queue=1)
+        self.assertIs(gate.enter(), True)
+        waiter = gate.enter()
+        self.assertIsNone(gate.enter())
+        gate.leave()
+        # the slot went to the queued request
+        self.assertTrue(gate.wait(waiter, 0))
+        self.assertEqual(gate.running, 1)
+        gate.leave()
+        self.assertEqual(gate.running, 0)
+
+    def test_late_logins_shed_sign_ups(self):
+        controller = get_admission_controller()
+        login = controller.classes[controller.priority["login_user"]]
+        now = time.monotonic()
+        # the fastest login of the last interval missed the target
+        login.observe(login.target + 1, now - login.interval)
+        login.observe(login.target + 1, now)
+        response = self.client.get(reverse("users:register", args=["+989121234567"]))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], str(controller.retry_after))
+        response = self.client.get(reverse("users:login_user"))
+        self.assertNotEqual(response.status_code, 503)
+
+
+class HashingServiceTest(TestCase):
+    """
+    A saturated or slow hashing pool fails fast, and the views answer with a 503
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for settings in (
+            index_and_bans_in(directory.name),
+            override_settings(
+                PASSWORD_HASHERS=["users.hashing.PooledPBKDF2PasswordHasher"],
+                USERS_HASHING={"WORKERS": 1, "QUEUE": 0},
+                USERS_READ_REPLICA=None,
+            ),
+        ):
+            settings.enable()
+            self.addCleanup(settings.disable)
+        self.service = get_hashing_service()
+
+    def hold_every_slot(self):
+        self.assertTrue(self.service._slots.acquire(blocking=False))
+        self.addCleanup(self.service._slots.release)
+
+    def test_overloaded(self):
+        self.hold_every_slot()
+        with self.assertRaises(HashingOverloaded):
+            self.service.pbkdf2("password", "salt", 1000, "sha256")
+
+    def test_deadline(self):
+        self.addCleanup(self.service.shutdown)
+        # the pool doesn't even start its process within a millisecond
+        with hashing_deadline(0.001), self.assertRaises(HashingTimeout):
+            self.service.pbkdf2("password", "salt", 100_000, "sha256")
+
+    def test_unavailable_is_a_503(self):
+        self.hold_every_slot()
+        response = self.client.post(
+            reverse("users:login_user"),
+            {"username": "+989121234567", "password": "Unguessable-4821"},
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response.headers)
+
+    def test_forked_child_starts_over(self):
+        slots = self.service._slots
+        # as seen from a forked child
+        self.service._pid = -1
+        self.service._check_pid()
+        self.assertIsNot(self.service._slots, slots)
+        self.assertIsNone(self.service._executor)
+
+
+class OTPStoreTest(SimpleTestCase):
+    """
+    An otp verifies once, for its phonenumber, with a few guesses and before
+    it expires
+    """
+
+    phonenumber = "+989121234567"
+
+    def setUp(self):
+        self.store = OTPStore(ttl=60, max_attempts=3)
+        self.store.cache.clear()
+        self.token, self.code = self.store.issue(self.phonenumber)
+
+    def verify(self, code, phonenumber=phonenumber):
+        return self.store.verify(self.token, phonenumber, code)
+
+    def wrong(self):
+        return "000000" if self.code != "000000" else "111111"
+
+    def test_verified_once(self):
+        self.assertEqual(self.verify(self.code), OTPResult.VERIFIED)
+        self.assertEqual(self.verify(self.code), OTPResult.MISSING)
+
+    def test_bound_to_the_phonenumber(self):
+        self.assertEqual(self.verify(self.code, "+989121234568"), OTPResult.MISMATCH)
+        self.assertEqual(self.verify(self.code), OTPResult.VERIFIED)
+
+    def test_exhausted(self):
+        for _ in range(self.store.max_attempts - 1):
+            self.assertEqual(self.verify(self.wrong()), OTPResult.MISMATCH)
+        self.assertEqual(self.verify(self.wrong()), OTPResult.EXHAUSTED)
+        # the right code is too late
+        self.assertEqual(self.verify(self.code), OTPResult.MISSING)
+
+    def test_expired(self):
+        with patch("time.time", return_value=time.time() + 61):
+            self.assertEqual(self.verify(self.code), OTPResult.EXPIRED)
+
+    def test_pending(self):
+        self.assertTrue(self.store.pending(self.token, self.phonenumber))
+        self.assertFalse(self.store.pending(self.token, "+989121234568"))
+        self.verify(self.code)
+        self.assertFalse(self.store.pending(self.token, self.phonenumber))
+
+    def test_stats(self):
+        before = self.store.stats()
+        self.store.issue(self.phonenumber)
+        self.verify(self.wrong())
+        self.verify(self.code)
+        self.verify(self.code)
+        after = self.store.stats()
+        changed = {
+            name: after[name] - before[name]
+            for name in ("issued", "verified", "mismatch", "evicted_or_reused")
+        }
+        self.assertEqual(
+            changed, {"issued": 1, "verified": 1, "mismatch": 1, "evicted_or_reused": 1}
+        )
+        # the otp issued by setUp was used, the one issued here is left
+        self.assertEqual(after["entries"], 1)
+
+
+class SMSDispatcherTest(TestCase):
+    """
+    Claims, retries with backoff and takes over the claims of dead workers
+    """
+
+    def setUp(self):
+        self.gateway = FakeSMSGateway()
+        self.dispatcher = self.worker()
+        self.message = enqueue_sms("+989121234567", "your code is 123456")
+
+    def worker(self, gateway=None):
+        return SMSDispatcher(
+            gateway or self.gateway,
+            BATCH_SIZE=2,
+            WORKERS=1,
+            MAX_ATTEMPTS=2,
+            BACKOFF=60,
+            LEASE=60,
+        )
+
+    def test_claim(self):
+        for i in range(2):
+            enqueue_sms(f"+98912123456{i}", "hi")
+        self.assertEqual(len(self.dispatcher.claim()), 2)
+        self.assertEqual(len(self.dispatcher.claim()), 1)
+        self.assertEqual(self.dispatcher.claim(), [])
+        self.assertFalse(
+            OutboundMessage.objects.exclude(status=OutboundMessage.SENDING).exists()
+        )
+
+    def test_sent(self):
+        self.assertEqual(self.dispatcher.run_once(), 1)
+        self.assertEqual(
+            self.gateway.outbox, [("+989121234567", "your code is 123456")]
+        )
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, OutboundMessage.SENT)
+        self.assertEqual(self.message.body, "")
+
+    def test_retry_with_backoff(self):
+        dispatcher = self.worker(FakeSMSGateway(failure_rate=1))
+        self.assertEqual(dispatcher.run_once(), 0)
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, OutboundMessage.PENDING)
+        self.assertEqual(self.message.attempts, 1)
+        self.assertGreater(self.message.next_attempt_at, timezone.now())
+        # not due before the backoff is over
+        self.assertEqual(dispatcher.claim(), [])
+        OutboundMessage.objects.update(next_attempt_at=timezone.now())
+        dispatcher.run_once()
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, OutboundMessage.FAILED)
+        self.assertEqual(self.message.attempts, 2)
+        self.assertEqual(self.message.body, "")
+        self.assertEqual(dispatcher.stats.summary()["failed"], 1)
+
+    def test_lease_takeover(self):
+        # a worker that died after claiming the message
+        self.dispatcher.claim()
+        other = self.worker()
+        self.assertEqual(other.claim(), [])
+        OutboundMessage.objects.update(
+            claimed_at=timezone.now() - timedelta(seconds=61)
+        )
+        self.assertEqual(other.run_once(), 1)
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, OutboundMessage.SENT)
+
+
+class AsyncFlowURLs:
+    """
+    The flow served by `users.async_views` and `users.async_api`, whichever
+    one `USERS_ASYNC_VIEWS` picked
+    """
+
+    urlpatterns = [
+        path("", include((flow_urlpatterns(async_views, async_api), "users")))
+    ]
+
+
+class AsyncFlowTest(TestCase):
+    """
+    The async views and api go through the whole flow, sign up then login
+    """
+
+    phonenumber = "+989121234567"
+    password = "Unguessable-4821"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for settings in (
+            index_and_bans_in(directory.name),
+            override_settings(ROOT_URLCONF=AsyncFlowURLs, USERS_READ_REPLICA=None),
+        ):
+            settings.enable()
+            self.addCleanup(settings.disable)
+        get_username_index().rebuild(registered_usernames())
+
+    async def otp(self, token):
+        return (await get_otp_store().cache.aget(f"otp:{token}")).split(":")[1]
+
+    async def test_sign_up_then_login(self):
+        client = self.async_client
+        response = await client.post(
+            reverse("users:check"), {"phonenumber": self.phonenumber}
+        )
+        register_url = response["Location"]
+        response = await client.get(register_url)
+        token = re.search(
+            r'name="otp_cache_key" value="([^"]+)"', response.content.decode()
+        ).group(1)
+        response = await client.post(
+            register_url, {"otp": await self.otp(token), "otp_cache_key": token}
+        )
+        self.assertEqual(response["Location"], reverse("users:register_info"))
+        response = await client.post(
+            reverse("users:register_info"),
+            {"first_name": "first", "last_name": "last", "email": "a@example.com"},
+        )
+        self.assertEqual(response["Location"], reverse("users:register_password"))
+        response = await client.post(
+            reverse("users:register_password"), {"password1": self.password}
+        )
+        self.assertContains(response, "Successfully")
+        await client.post(reverse("users:logout_user"))
+        response = await client.post(
+            reverse("users:check"), {"phonenumber": self.phonenumber}
+        )
+        # a registered number gets the login form
+        self.assertContains(response, 'name="password"')
+        response = await client.post(
+            reverse("users:login_user"),
+            {"username": self.phonenumber, "password": self.password},
+        )
+        self.assertContains(response, "Successfully")
+
+    async def test_api(self):
+        client = self.async_client
+        response = await client.post(
+            reverse("users:api_start"),
+            {"phonenumber": self.phonenumber},
+            content_type="application/json",
+        )
+        token = response.json()["token"]
+        response = await client.post(
+            reverse("users:api_verify"),
+            {
+                "phonenumber": self.phonenumber,
+                "token": token,
+                "otp": await self.otp(token),
+            },
+            content_type="application/json",
+        )
+        response = await client.post(
+            reverse("users:api_register"),
+            {
+                "ticket": response.json()["ticket"],
+                "first_name": "first",
+                "last_name": "last",
+                "email": "a@example.com",
+                "password1": self.password,
+            },
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        response = await client.post(
+            reverse("users:api_start"),
+            {"phonenumber": self.phonenumber},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["next"], "login")
+        response = await client.post(
+            reverse("users:api_login"),
+            {"username": self.phonenumber, "password": self.password},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json(), {"ok": True})
+        response = await client.post(
+            reverse("users:api_login"),
+            {"username": self.phonenumber, "password": "wrong"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["error"], "invalid_credentials")
+
+
+class ReplicaRouterTest(TransactionTestCase):
+    """
+    Only the reads inside `read_from_replica()` go to the replica, committed
+    writes since the test replica is another connection to the same database
+    """
+
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = index_and_bans_in(directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = provision_user(
+            get_user_model()(username="+989121234567"), "Unguessable-4821"
+        )
+
+    def test_routing(self):
+        router, user_model = ReplicaRouter(), get_user_model()
+        self.assertIsNone(router.db_for_read(user_model))
+        with read_from_replica():
+            self.assertEqual(router.db_for_read(user_model), "replica")
+            self.assertEqual(router.db_for_write(user_model), "default")
+        self.assertFalse(router.allow_migrate("replica", "users"))
+        self.assertTrue(router.allow_migrate("default", "users"))
+
+    def test_lookup_reads_the_replica(self):
+        with self.assertNumQueries(0), self.assertNumQueries(1, using="replica"):
+            with read_from_replica():
+                user = get_user_model().objects.get(username="+989121234567")
+        self.assertEqual(user._state.db, "replica")
+        # and is written back to the primary
+        with self.assertNumQueries(1), self.assertNumQueries(0, using="replica"):
+            user.save(update_fields=["first_name"])
+
+    @override_settings(USERS_READ_REPLICA=None)
+    def test_no_replica(self):
+        with read_from_replica():
+            self.assertIsNone(ReplicaRouter().db_for_read(get_user_model()))
+
+
+class PhonenumberTest(TestCase):
+    """
+    Any way of typing a number of the configured regions normalizes to E.164
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = index_and_bans_in(directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_local_and_international_formats(self):
+        for raw in [
+            "09121234567",
+            "9121234567",
+            "+989121234567",
+            "00989121234567",
+            " +98 912 123 4567 ",
+            "0912-123-4567",
+            "0912 (123) 4567",
+        ]:
+            with self.subTest(raw=raw):
+                self.assertEqual(normalize_phonenumber(raw), "+989121234567")
+
+    def test_other_regions(self):
+        self.assertIsNone(normalize_phonenumber("+14155552671"))
+        with override_settings(USERS_PHONENUMBER_REGIONS=["IR", "US"]):
+            self.assertEqual(normalize_phonenumber("+14155552671"), "+14155552671")
+            self.assertEqual(normalize_phonenumber("09121234567"), "+989121234567")
+
+    def test_garbage(self):
+        for raw in [
+            None,
+            9121234567,
+            "",
+            "+",
+            "phonenumber",
+            "0912",
+            "+98912123456789",
+            "09121234567; drop table",
+        ]:
+            with self.subTest(raw=raw):
+                self.assertIsNone(normalize_phonenumber(raw))
+
+    def test_form_field(self):
+        field = PhonenumberForm.base_fields["phonenumber"]
+        self.assertEqual(field.to_python("0912 123 4567"), "+989121234567")
+        # left as typed for the validator to reject
+        self.assertEqual(field.to_python("phonenumber"), "phonenumber")
+        self.assertEqual(field.to_python(""), "")
+        form = PhonenumberForm({"phonenumber": "+14155552671"})
+        self.assertFalse(form.is_valid())
+        form = PhonenumberForm({"phonenumber": "0098 912 123 4567"})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data["phonenumber"], "+989121234567")
+
+    def test_migration_normalizes_usernames(self):
+        user_model = get_user_model()
+        user_model.objects.create(username="09121234567")
+        user_model.objects.create(username="admin")
+        get_username_index().rebuild(registered_usernames())
+        normalize_usernames(django_apps, None)
+        self.assertEqual(
+            set(user_model.objects.values_list("username", flat=True)),
+            {"+989121234567", "admin"},
+        )
+        # the renamed username isn't in it, lookups query until it is rebuilt
+        self.assertFalse(get_username_index().ready)
+
+    def test_migration_fails_on_collisions(self):
+        user_model = get_user_model()
+        user_model.objects.create(username="09121234567")
+        user_model.objects.create(username="+98 912 123 4567")
+        with self.assertRaisesMessage(RuntimeError, "+989121234567"):
+            normalize_usernames(django_apps, None)
+        self.assertEqual(user_model.objects.filter(username="09121234567").count(), 1)
+
+
+class ImportUsersTest(TestCase):
+    """
+    `import_users` counts what it inserted and resumes after its checkpoint
+    """
+
+    rows = [
+        "phonenumber,password,first_name",
+        "09121234561,Unguessable-4821,first",
+        "+98 912 123 4561,,duplicate",
+        "not a phonenumber,,invalid",
+        "09121234562,,registered",
+        "09121234563,,",
+        "09121234564,,",
+    ]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = index_and_bans_in(directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        get_username_index().rebuild(registered_usernames())
+        provision_user(get_user_model()(username="+989121234562"), None)
+        self.path = os.path.join(directory.name, "users.csv")
+        with open(self.path, "w") as f:
+            f.write("\n".join(self.rows) + "\n")
+
+    def import_users(self):
+        out = StringIO()
+        call_command("import_users", self.path, chunk_size=2, workers=1, stdout=out)
+        return json.loads(out.getvalue().splitlines()[-1])
+
+    def test_import(self):
+        stats = self.import_users()
+        self.assertEqual(
+            (stats["read"], stats["invalid"], stats["duplicate"], stats["imported"]),
+            (6, 1, 2, 3),
+        )
+        user = get_user_model().objects.get(username="+989121234561")
+        self.assertEqual(user.first_name, "first")
+        self.assertTrue(user.check_password("Unguessable-4821"))
+        self.assertFalse(os.path.exists(f"{self.path}.checkpoint"))
+
+    def test_registered_since_the_lookup(self):
+        importer = UserImporter(chunk_size=2, workers=1)
+        stats = ImportStats()
+        user_model = get_user_model()
+        users = [
+            (user_model(username="+989121234563"), None),
+            (user_model(username="+989121234562"), None),
+        ]
+        importer.insert(users, iter(()), stats.as_dict(), stats)
+        self.assertEqual((stats.imported, stats.conflicts), (1, 1))
+
+    def test_import_drops_directory_entries(self):
+        # bulk_create sends no post_save, the importer bumps the stamps itself
+        stamps = get_user_directory().stamps
+        before = stamps.stamp("+989121234563")
+        self.import_users()
+        self.assertGreater(stamps.stamp("+989121234563"), before)
+
+    def test_resume_after_the_checkpoint(self):
+        insert = UserImporter.insert
+        calls = []
+
+        def interrupted(importer, *args):
+            # the second chunk never gets in
+            if len(calls) == 1:
+                raise KeyboardInterrupt
+            calls.append(args)
+            return insert(importer, *args)
+
+        with patch.object(UserImporter, "insert", interrupted):
+            with self.assertRaisesMessage(CommandError, "resume after row 2"):
+                self.import_users()
+        self.assertEqual(get_user_model().objects.count(), 2)
+        stats = self.import_users()
+        self.assertEqual((stats["read"], stats["imported"]), (6, 3))
+        self.assertEqual(get_user_model().objects.count(), 4)
+
+
+def hit_many(table, key, times):
+    # in a forked process, with the table object of the parent
+    for _ in range(times):
+        table.hit(key, 1 << 30, 3600)
+
+
+class SharedBanTableTest(SimpleTestCase):
+    """
+    Attempts, bans and their expiry, eviction, and exact counts across processes
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = f"{directory.name}/bans"
+        self.now = int(time.time())
+
+    def test_hit_ban_reset(self):
+        table = SharedBanTable(self.path)
+        for attempts in range(1, 4):
+            self.assertEqual(table.hit("ip:1", 3, 60, now=self.now), (attempts, 0))
+        self.assertEqual(table.hit("ip:1", 3, 60, now=self.now), (4, self.now + 60))
+        self.assertEqual(table.ban_until(["ip:1", "ip:2"]), [self.now + 60, 0])
+        table.reset("ip:1")
+        # the attempts are gone, the ban stays
+        self.assertEqual(table.ban_until(["ip:1"]), [self.now + 60])
+        self.assertEqual(table.hit("ip:1", 3, 60, now=self.now), (1, self.now + 60))
+
+    def test_expiry(self):
+        table = SharedBanTable(self.path)
+        for _ in range(3):
+            table.hit("ip:1", 1, 60, now=self.now)
+        # the window is over, counting starts again and the ban is over
+        self.assertEqual(
+            table.hit("ip:1", 1, 60, now=self.now + 60), (1, self.now + 60)
+        )
+        self.assertEqual(table.stats(now=self.now + 120)["used"], 0)
+        self.assertEqual(table.purge(now=self.now + 120), 1)
+        self.assertEqual(table.ban_until(["ip:1"]), [0])
+
+    def test_victim(self):
+        # a single bucket of 8 slots
+        table = SharedBanTable(self.path, slots=8)
+        for i in range(8):
+            table.hit(f"ip:{i}", 10, 60 if i != 5 else 1, now=self.now + i)
+        # the expired record makes way first
+        table.hit("ip:new", 10, 60, now=self.now + 10)
+        self.assertEqual(table.hit("ip:0", 10, 60, now=self.now + 11)[0], 2)
+        # then the least recently seen, ip:1 now
+        table.hit("ip:newer", 10, 60, now=self.now + 12)
+        self.assertEqual(table.hit("ip:1", 10, 60, now=self.now + 13)[0], 1)
+        self.assertEqual(table.hit("ip:0", 10, 60, now=self.now + 14)[0], 3)
+
+    def test_bans_are_never_evicted(self):
+        table = SharedBanTable(self.path, slots=8)
+        for i in range(7):
+            table.hit(f"ip:{i}", 0, 60, now=self.now + i)
+        table.hit("ip:counted", 10, 60, now=self.now)
+        # only the counter that isn't banned makes way
+        self.assertEqual(
+            table.hit("ip:new", 0, 60, now=self.now + 10), (1, self.now + 70)
+        )
+        self.assertEqual(table.ban_until(["ip:counted"]), [0])
+        # a bucket full of bans is banned as a whole, the evicted ban included
+        self.assertEqual(
+            table.hit("ip:newer", 10, 60, now=self.now + 11), (11, self.now + 71)
+        )
+        banned = [f"ip:{i}" for i in range(7)] + ["ip:new", "ip:newer", "ip:counted"]
+        self.assertTrue(
+            all(until >= self.now + 60 for until in table.ban_until(banned))
+        )
+        self.assertEqual(table.stats(now=self.now + 72)["used"], 0)
+
+    def test_keyed_hash(self):
+        self.assertNotEqual(key_hash("ip:1", b"a"), key_hash("ip:1", b"b"))
+        one = SharedBanTable(self.path, secret=b"a")
+        one.hit("ip:1", 0, 60)
+        self.assertTrue(one.ban_until(["ip:1"])[0])
+        # reopened with another secret, the keys hash elsewhere
+        other = SharedBanTable(self.path, secret=b"b")
+        self.assertEqual(other.ban_until(["ip:1"]), [0])
+
+    def test_default_path_is_private(self):
+        with tempfile.TemporaryDirectory() as runtime:
+            with patch.dict(os.environ, {"XDG_RUNTIME_DIR": runtime}):
+                os.chmod(runtime, 0o755)
+                with self.assertRaises(ImproperlyConfigured):
+                    default_table_path()
+                os.chmod(runtime, 0o700)
+                self.assertEqual(os.path.dirname(default_table_path()), runtime)
+
+    def test_exact_counts_across_processes(self):
+        table = SharedBanTable(self.path)
+        table.hit("ip:1", 1 << 30, 3600)
+        context = multiprocessing.get_context("fork")
+        processes = [
+            context.Process(target=hit_many, args=(table, "ip:1", 250))
+            for _ in range(4)
+        ]
+        for process in processes:
+            process.start()
+        # and this process at the same time
+        hit_many(table, "ip:1", 250)
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(table.hit("ip:1", 1 << 30, 3600)[0], 1 + 5 * 250 + 1)
+
+
+class AttemptCounterTest(SimpleTestCase):
+    """
+    Concurrent failures of the same identifier are all counted, per backend
+    """
+
+    threads = 8
+    hits = 50
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        caches = {
+            "locmem": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "file": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": f"{directory.name}/cache",
+            },
+        }
+        if REDIS_URL:
+            caches["redis"] = {
+                "BACKEND": "django.core.cache.backends.redis.RedisCache",
+                "LOCATION": REDIS_URL,
+            }
+        settings = override_settings(CACHES=caches)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def assertCountsEveryHit(self, counter):
+        counter.cache.clear()
+        # never banned, so only the counting is under test
+        limits = [1 << 30]
+
+        def hit_many():
+            for _ in range(self.hits):
+                counter.hit(["ip:1"], limits)
+
+        threads = [threading.Thread(target=hit_many) for _ in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        attempts = counter.hit(["ip:1"], limits)[0].attempts
+        self.assertEqual(attempts, self.threads * self.hits + 1)
+
+    def test_locmem(self):
+        self.assertCountsEveryHit(CacheAttemptCounter("locmem"))
+
+    def test_file(self):
+        self.assertCountsEveryHit(FileCacheAttemptCounter("file"))
+
+    @skipUnless(REDIS_URL, "set USERS_TEST_REDIS_URL to test against redis")
+    def test_redis(self):
+        self.assertCountsEveryHit(RedisAttemptCounter("redis"))
+
+
+class UsernameIndexTest(SimpleTestCase):
+    """
+    The index never misses a registered username, not even during a rebuild
+    """
+
+    usernames = [f"+98912{i:07d}" for i in range(2000)]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.index = UsernameIndex(f"{directory.name}/usernames", capacity=10_000)
+
+    def test_no_false_negatives(self):
+        self.assertTrue(self.index.might_contain("+989120000000"))
+        self.index.rebuild(self.usernames)
+        self.assertTrue(all(map(self.index.might_contain, self.usernames)))
+        new = [f"+98935{i:07d}" for i in range(1000)]
+        false_positives = sum(map(self.index.might_contain, new))
+        self.assertLess(false_positives, 50)
+
+    def test_added_during_a_rebuild(self):
+        self.index.rebuild(self.usernames[:1000])
+
+        def registered():
+            yield from self.usernames[1000:]
+            # the rebuild still answers from the previous filter
+            self.assertTrue(self.index.ready)
+            self.assertTrue(self.index.might_contain(self.usernames[0]))
+            self.assertFalse(self.index.might_contain(self.usernames[1500]))
+            # saved while the rebuild runs, not committed when it was read
+            self.index.add("+989350000000")
+
+        self.assertEqual(self.index.rebuild(registered()), 1001)
+        self.assertTrue(self.index.might_contain("+989350000000"))
+        self.assertTrue(all(map(self.index.might_contain, self.usernames[1000:])))
+        # the rebuilt filter only holds what is registered now
+        self.assertLess(sum(map(self.index.might_contain, self.usernames[:1000])), 50)
+
+
+class UnindexedUserTest(TestCase):
+    """
+    A user written without the signal, missed by the username index, is still
+    sent to log in and never texted an otp
+    """
+
+    phonenumber = "+989121234567"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for settings in (
+            index_and_bans_in(directory.name),
+            override_settings(USERS_READ_REPLICA=None),
+        ):
+            settings.enable()
+            self.addCleanup(settings.disable)
+        get_username_index().rebuild(registered_usernames())
+        # e.g. created on another host
+        get_user_model().objects.bulk_create(
+            [get_user_model()(username=self.phonenumber)]
+        )
+
+    def test_register_sends_to_login(self):
+        response = self.client.post(
+            reverse("users:check"), {"phonenumber": self.phonenumber}
+        )
+        self.assertRedirects(
+            response,
+            reverse("users:register", args=[self.phonenumber]),
+            fetch_redirect_response=False,
+        )
+        response = self.client.get(response["Location"])
+        self.assertContains(response, 'name="password"')
+        self.assertFalse(OutboundMessage.objects.exists())
+        # learnt, the next check goes straight to the login
+        response = self.client.post(
+            reverse("users:check"), {"phonenumber": self.phonenumber}
+        )
+        self.assertContains(response, 'name="password"')
+
+    def test_api_start(self):
+        response = self.client.post(
+            reverse("users:api_start"),
+            {"phonenumber": self.phonenumber},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json(), {"next": "login"})
+        self.assertFalse(OutboundMessage.objects.exists())
+
+    def test_taken_username_is_learnt(self):
+        with self.assertRaises(UsernameTaken):
+            provision_user(get_user_model()(username=self.phonenumber), None)
+        self.assertTrue(get_username_index().might_contain(self.phonenumber))
+
+
+class WizardStoreTest(SimpleTestCase):
+    """
+    The state survives a round trip and is dropped when tampered with,
+    expired or cleared, in both stores
+    """
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.stores = [SignedCookieWizardStore(ttl=60), CacheWizardStore(ttl=60)]
+
+    def request(self, cookie=None):
+        request = self.factory.get("/")
+        if cookie is not None:
+            request.COOKIES["users_wizard"] = cookie
+        return request
+
+    def save(self, store, values, request=None):
+        """
+        The cookie of the response storing `values`
+        """
+        state = WizardState(store, request or self.request())
+        if values:
+            state.update(values)
+        else:
+            state.clear()
+        response = HttpResponse()
+        state.save(response)
+        return response.cookies["users_wizard"]
+
+    def test_round_trip(self):
+        for store in self.stores:
+            with self.subTest(store=type(store).__name__):
+                cookie = self.save(store, {"username": "+989121234567"})
+                self.assertEqual(cookie["max-age"], 60)
+                state = WizardState(store, self.request(cookie.value))
+                self.assertEqual(state.get("username"), "+989121234567")
+
+    def test_tampered(self):
+        for store in self.stores:
+            with self.subTest(store=type(store).__name__):
+                value = self.save(store, {"username": "+989121234567"}).value
+                tampered = value[:-1] + ("A" if value[-1] != "A" else "B")
+                self.assertEqual(store.load(self.request(tampered)), {})
+
+    def test_expired(self):
+        clocks = [
+            "django.core.signing.time.time",
+            "django.core.cache.backends.locmem.time.time",
+        ]
+        for store, clock in zip(self.stores, clocks):
+            with self.subTest(store=type(store).__name__):
+                value = self.save(store, {"username": "+989121234567"}).value
+                with patch(clock, return_value=time.time() + 61):
+                    self.assertEqual(store.load(self.request(value)), {})
+
+    def test_clear(self):
+        for store in self.stores:
+            with self.subTest(store=type(store).__name__):
+                value = self.save(store, {"username": "+989121234567"}).value
+                cookie = self.save(store, {}, self.request(value))
+                # the cookie is deleted
+                self.assertEqual((cookie.value, cookie["max-age"]), ("", 0))
+                if isinstance(store, CacheWizardStore):
+                    self.assertIsNone(store.cache.get(store.key(value)))
+
+
+def count_otps(amount):
+    # in a forked worker, which writes a file of its own
+    count(OTPS_ISSUED, amount=amount)
+
+
+class MetricsTest(TestCase):
+    """
+    `/metrics` sums every worker, the ones that are gone included
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for settings in (
+            index_and_bans_in(directory.name),
+            override_settings(USERS_READ_REPLICA=None),
+        ):
+            settings.enable()
+            self.addCleanup(settings.disable)
+        self.directory = Path(directory.name, "metrics")
+
+    def scrape(self):
+        response = self.client.get(reverse("users:metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"].split(";")[0], "text/plain")
+        return response.content.decode()
+
+    def test_output(self):
+        self.client.get(reverse("users:check"))
+        output = self.scrape()
+        self.assertIn("# TYPE users_view_duration_seconds histogram", output)
+        self.assertIn('users_view_duration_seconds_count{view="check"} 1', output)
+        self.assertIn("# TYPE users_otps_issued_total counter", output)
+        self.assertIn("users_otps_issued_total 0", output)
+
+    def test_queries_and_cache_calls(self):
+        # counted without the patching of `users.instrumentation`
+        uninstall()
+        self.assertFalse(hasattr(CursorWrapper.execute, "__counted__"))
+        get_user_model().objects.create(username="+989121234567")
+        self.client.post(reverse("users:check"), {"phonenumber": "09121234567"})
+        output = self.scrape()
+        queries = re.search(r"^users_db_queries_total (\S+)$", output, re.M)
+        self.assertGreater(float(queries.group(1)), 0)
+        # the user directory looked the user up
+        self.assertRegex(
+            output, r'users_cache_operations_total\{operation="get"\} [1-9]'
+        )
+
+    def test_dead_workers_are_retired(self):
+        count(OTPS_ISSUED)
+        worker = multiprocessing.get_context("fork").Process(
+            target=count_otps, args=(2,)
+        )
+        worker.start()
+        worker.join()
+        self.assertTrue((self.directory / f"{worker.pid}.metrics").exists())
+        self.assertIn("users_otps_issued_total 3", self.scrape())
+        # folded into the retired counts, and still summed
+        self.assertFalse((self.directory / f"{worker.pid}.metrics").exists())
+        self.assertTrue((self.directory / RETIRED).exists())
+        self.assertIn("users_otps_issued_total 3", self.scrape())
+
+
+class StartupReportTest(SimpleTestCase):
+    """
+    `startup_report` times the imports and the first requests of fresh workers
+    """
+
+    def test_report(self):
+        out = StringIO()
+        call_command("startup_report", requests=1, modules=3, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertRegex(lines[0], r"^\d+ modules imported in [\d.]+ms$")
+        # the 3 slowest under their header
+        self.assertEqual(lines[1].split(), ["self", "cumulative", "module"])
+        for line in lines[2:5]:
+            self.assertRegex(line, r"^\s+[\d.]+ms\s+[\d.]+ms  \S+$")
+        self.assertEqual(lines[5], "")
+        self.assertIn("first 1 requests to /check/ of a fresh worker", lines)
+        self.assertRegex(lines[-2], r"^\s+cold\s+[\d.]+ms\s+[\d.]+ms$")
+        self.assertRegex(lines[-1], r"^\s+warm\s+[\d.]+ms\s+[\d.]+ms$")
+
+
+class ProfileReportTest(TestCase):
+    """
+    `profile_report` sums up the profiles `ProfilingMiddleware` wrote, per view
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = index_and_bans_in(directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.directory = Path(directory.name, "profiles")
+
+    def report(self, **options):
+        out = StringIO()
+        call_command("profile_report", dir=str(self.directory), stdout=out, **options)
+        return out.getvalue()
+
+    def profile(self, mode):
+        token = self.report(token=True).strip()
+        options = {"ENABLED": True, "MODE": mode, "DIR": str(self.directory)}
+        with override_settings(USERS_PROFILING=options):
+            # the middleware is set up by the first request of a client
+            client = Client()
+            client.get(reverse("users:check"), HTTP_X_USERS_PROFILE=token)
+            client.get(reverse("users:check"))
+        return self.report()
+
+    def test_cprofile(self):
+        output = self.profile("cprofile")
+        # only the request with the token
+        self.assertEqual(len(list(self.directory.glob("check.*.prof"))), 1)
+        self.assertIn("check, 1 profiles", output)
+        self.assertIn("function calls", output)
+
+    def test_sample(self):
+        output = self.profile("sample")
+        self.assertEqual(len(list(self.directory.glob("check.*.stacks"))), 1)
+        self.assertRegex(output, r"check, 1 sampled profiles, \d+ samples")
+
+    def test_one_cprofile_at_a_time(self):
+        token = self.report(token=True).strip()
+        options = {"ENABLED": True, "MODE": "cprofile", "DIR": str(self.directory)}
+        with override_settings(USERS_PROFILING=options):
+            client = Client(HTTP_X_USERS_PROFILE=token)
+            # another thread is profiled
+            with _cprofile_lock:
+                self.assertEqual(client.get(reverse("users:check")).status_code, 200)
+            # another profiling tool is active, as python 3.12+ reports it
+            with patch("cProfile.Profile.enable", side_effect=ValueError):
+                self.assertEqual(client.get(reverse("users:check")).status_code, 200)
+            self.assertFalse(self.directory.exists())
+            # neither left this thread or the lock marked as profiling
+            client.get(reverse("users:check"))
+        self.assertEqual(len(list(self.directory.glob("check.*.prof"))), 1)
+
+    def test_no_profiles(self):
+        with self.assertRaisesMessage(CommandError, "no profiles in"):
+            self.report()
+
+
+class LoadTestTest(SimpleTestCase):
+    """
+    The journeys of `bench_funnel` and how their timings are summed up
+    """
+
+    def test_build_journeys(self):
+        users = [f"+98912123456{i}" for i in range(4)]
+        journeys = build_journeys(users, "password", 1, ["+989121234569"] * 2)
+        kinds = [kind for kind, _, _ in journeys]
+        # an attacker after every other user
+        self.assertEqual(kinds, ["user", "user", "attacker", "user", "user", "attacker"])
+        # a client address each, bans don't spill over
+        self.assertEqual(len({address for _, address, _ in journeys}), 6)
+        _, _, journey = journeys[0]
+        self.assertEqual(next(journey).name, "check_get")
+
+    def test_percentile(self):
+        ordered = list(range(1, 101))
+        self.assertEqual([percentile(ordered, p) for p in (50, 95, 99)], [50, 95, 99])
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_latency_summary(self):
+        self.assertEqual(
+            latency_summary([0.004, 0.001, 0.003, 0.002]),
+            {"p50": 2.0, "p95": 4.0, "p99": 4.0, "mean": 2.5, "max": 4.0},
+        )
+        self.assertEqual(set(latency_summary([]).values()), {None})
+
+    def test_recorder_summary(self):
+        recorder = Recorder()
+        check = Step("check_get", "GET", "/check/")
+        recorder.record(check, Response(200, "", ""), 0.001, {"queries": 2})
+        recorder.record(check, Response(500, "", ""), 0.003, {"queries": 4, "cache": 1})
+        # from a server out of process, nothing counted
+        logout = Step("logout", "POST", "/logout/", expect=302)
+        recorder.record(logout, Response(302, "", ""), 0.002, None)
+        recorder.journey_done("user", True)
+        recorder.started, recorder.finished = 10.0, 12.0
+        summary = recorder.summary()
+        self.assertEqual(
+            (summary["elapsed_s"], summary["throughput_rps"], summary["journeys"]),
+            (2.0, 1.5, {"user_completed": 1}),
+        )
+        self.assertEqual(
+            summary["steps"]["check_get"],
+            {
+                "requests": 2,
+                "errors": 1,
+                "statuses": {"200": 1, "500": 1},
+                "latency_ms": latency_summary([0.001, 0.003]),
+                "operations": {
+                    "ban_table": 0.0,
+                    "cache": 0.5,
+                    "hashes": 0.0,
+                    "queries": 3.0,
+                    "writes": 0.0,
+                },
+            },
+        )
+        self.assertIsNone(summary["steps"]["logout"]["operations"])
+        self.assertEqual(summary["overall"]["requests"], 3)
+        # averaged over the counted requests only
+        self.assertEqual(summary["overall"]["operations"]["queries"], 3.0)
+
+
+class BenchFunnelTest(SimpleTestCase):
+    """
+    `bench_funnel` drives the journeys against a database of its own
+    """
+
+    def test_report(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = f"{directory}/result.json"
+            # a process of its own, the database of the test run is in memory
+            subprocess.run(
+                [
+                    sys.executable,
+                    "manage.py",
+                    "bench_funnel",
+                    "--users=2",
+                    "--attackers=1",
+                    "--concurrency=2",
+                    "--fast-hashing",
+                    f"--output={output}",
+                ],
+                cwd=django_settings.BASE_DIR,
+                capture_output=True,
+                check=True,
+            )
+            with open(output) as f:
+                result = json.load(f)
+        self.assertEqual(
+            result["journeys"], {"attacker_completed": 1, "user_completed": 2}
+        )
+        self.assertEqual(result["overall"]["errors"], 0)
+        self.assertIn("register_password", result["steps"])
+
+    def test_isolated_puts_the_test_database_back(self):
+        test_settings = connections["default"].settings_dict["TEST"]
+        name = test_settings["NAME"]
+        command = "users.management.commands.bench_funnel"
+        with tempfile.TemporaryDirectory() as directory:
+            with patch(f"{command}.setup_databases"), patch(
+                f"{command}.teardown_databases"
+            ):
+                with isolated(directory, fast_hashing=False):
+                    self.assertEqual(test_settings["NAME"], f"{directory}/db.sqlite3")
+        self.assertEqual(test_settings["NAME"], name)
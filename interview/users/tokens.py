@@ -0,0 +1,273 @@
+"""
+Signed stateless auth tokens
+
+with the session, every authenticated request reads the session row and then
+the user row. `TokenAuthenticationMiddleware` authenticates the requests
+carrying a token instead, without touching either:
+
+    <user id>:<fingerprint>:<timestamp>:<signature>
+
+signed with the secret key, so checking it is an hmac. the fingerprint is the
+start of the user's session auth hash, which changes with the password, so a
+password change invalidates every token of the user. the token travels in the
+`COOKIE_NAME` cookie, set on the response of a login, or in an
+`Authorization: Bearer` header, and expires `TTL` seconds after it was issued,
+a token past half its age is replaced on the way out.
+
+the user object comes from `UserCache`, a small per process lru of the users
+seen in the last `USER_TTL` seconds, so a steady stream of requests of the same
+users costs no query at all, only a miss loads the user by id.
+
+logging out revokes the token in a denylist, a `SharedBanTable` of its own
+shared by the worker processes in memory, an entry only lives as long as the
+token it revokes could. a revocation is never evicted: when a bucket of the
+table is full every token hashing to it counts as revoked until the last of its
+entries expires, so an undersized table logs users out but never lets a revoked
+token back in. the table is sized for `LOGOUTS_PER_HOUR` over a whole `TTL`,
+twice over, unless `DENYLIST_SLOTS` is set.
+
+the session is still written by `login()` and flushed by `logout()`, the
+middleware only reacts to their signals, so the views are the same in both
+modes and a client without a token falls back to the session. disabled
+(`USERS_AUTH_TOKENS["ENABLED"]`, the default) the middleware removes itself
+from the stack.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+
+from .bantable import SharedBanTable
+from .runtime import private_tempdir
+
+DEFAULTS = {
+    "ENABLED": False,
+    "COOKIE_NAME": "users_auth",
+    # seconds a token is valid for
+    "TTL": 12 * 3600,
+    # users kept in memory per process, and the seconds they are trusted for
+    "USER_CACHE_SIZE": 1024,
+    "USER_TTL": 60,
+    # the denylist, in the private temp directory by default
+    "DENYLIST_PATH": None,
+    "DENYLIST_SLOTS": None,
+    # the expected peak, sizes the denylist when `DENYLIST_SLOTS` isn't set
+    "LOGOUTS_PER_HOUR": 2000,
+}
+SIGNING_SALT = "users.tokens"
+FINGERPRINT_LENGTH = 16
+DENYLIST_KEY_PREFIX = "token"
+BEARER = "Bearer "
+
+
+def get_token_settings():
+    return {**DEFAULTS, **getattr(settings, "USERS_AUTH_TOKENS", {})}
+
+
+def denylist_slots(options):
+    """
+    Slots for every token revoked within a `TTL` at the expected rate, twice
+    over so the buckets rarely fill up
+    """
+    return max(2 * options["LOGOUTS_PER_HOUR"] * options["TTL"] // 3600, 1024)
+
+
+def default_denylist_path():
+    name = hashlib.blake2b(str(settings.BASE_DIR).encode(), digest_size=6).hexdigest()
+    return os.path.join(private_tempdir(), f"ubaar-denylist-{name}")
+
+
+def fingerprint(user):
+    return user.get_session_auth_hash()[:FINGERPRINT_LENGTH]
+
+
+class UserCache:
+    """
+    The users seen in the last `ttl` seconds, least recently used out first
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        `(user, fingerprint)`, None if missing or too old
+        """
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            if entry[2] <= time.monotonic():
+                del self._users[user_id]
+                return None
+            self._users.move_to_end(user_id)
+            return entry[:2]
+
+    def put(self, user):
+        entry = (user, fingerprint(user), time.monotonic() + self.ttl)
+        # keyed like the token carries it
+        user_id = str(user.pk)
+        with self._lock:
+            self._users[user_id] = entry
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+        return entry[:2]
+
+    def discard(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+class TokenAuthority:
+    """
+    Issues, checks and revokes the tokens
+    """
+
+    def __init__(self, options):
+        self.cookie_name = options["COOKIE_NAME"]
+        self.ttl = options["TTL"]
+        self.signer = signing.TimestampSigner(salt=SIGNING_SALT)
+        self.users = UserCache(options["USER_CACHE_SIZE"], options["USER_TTL"])
+        self.denylist = SharedBanTable(
+            options["DENYLIST_PATH"] or default_denylist_path(),
+            slots=options["DENYLIST_SLOTS"] or denylist_slots(options),
+        )
+
+    def issue(self, user):
+        return self.signer.sign(f"{user.pk}:{fingerprint(user)}")
+
+    def token(self, request):
+        header = request.headers.get("Authorization", "")
+        if header.startswith(BEARER):
+            return header[len(BEARER) :]
+        return request.COOKIES.get(self.cookie_name)
+
+    def claims(self, token):
+        """
+        `(user id, fingerprint, issued at)` of a valid token, None otherwise
+        """
+        try:
+            value = self.signer.unsign(token, max_age=self.ttl)
+        except signing.BadSignature:
+            return None
+        user_id, _, user_fingerprint = value.partition(":")
+        if self.revoked(token):
+            return None
+        issued = signing.b62_decode(token.rsplit(":", 2)[1])
+        return user_id, user_fingerprint, issued
+
+    def revoked(self, token):
+        return self.denylist.denied([self._denylist_key(token)])[0]
+
+    def revoke(self, token):
+        """
+        Deny `token` for the rest of its life
+        """
+        try:
+            self.signer.unsign(token, max_age=self.ttl)
+        except signing.BadSignature:
+            # expired or forged, nothing to revoke
+            return
+        issued = signing.b62_decode(token.rsplit(":", 2)[1])
+        self.denylist.deny(self._denylist_key(token), issued + self.ttl)
+
+    @staticmethod
+    def _denylist_key(token):
+        return f"{DENYLIST_KEY_PREFIX}:{token.rpartition(':')[2]}"
+
+    def user(self, user_id, user_fingerprint):
+        """
+        The active user of a token, from the cache or loaded once
+        """
+        entry = self.users.get(user_id)
+        if entry is None or entry[1] != user_fingerprint:
+            # a miss, or the password changed since the user was cached
+            entry = self._cache(user_id, self._active(user_id).first())
+        return self._matching(entry, user_fingerprint)
+
+    async def auser(self, user_id, user_fingerprint):
+        entry = self.users.get(user_id)
+        if entry is None or entry[1] != user_fingerprint:
+            entry = self._cache(user_id, await self._active(user_id).afirst())
+        return self._matching(entry, user_fingerprint)
+
+    @staticmethod
+    def _active(user_id):
+        return get_user_model()._default_manager.filter(pk=user_id, is_active=True)
+
+    def _cache(self, user_id, user):
+        if user is None:
+            self.users.discard(user_id)
+            return None
+        return self.users.put(user)
+
+    @staticmethod
+    def _matching(entry, user_fingerprint):
+        if entry is None or entry[1] != user_fingerprint:
+            return None
+        return entry[0]
+
+    def set_cookie(self, response, user):
+        response.set_cookie(
+            self.cookie_name,
+            self.issue(user),
+            max_age=self.ttl,
+            secure=settings.SESSION_COOKIE_SECURE,
+            httponly=True,
+            samesite="Lax",
+        )
+
+    def stale(self, issued):
+        return time.time() - issued > self.ttl / 2
+
+
+_authority = None
+
+
+def get_token_authority():
+    global _authority
+    if _authority is None:
+        _authority = TokenAuthority(get_token_settings())
+    return _authority
+
+
+def reset_token_authority(**kwargs):
+    global _authority
+    _authority = None
+
+
+# receivers of the auth signals, connected in `UsersConfig.ready`
+
+
+def token_login(sender, request, user, **kwargs):
+    if request is not None:
+        request._token_login = user
+
+
+def token_logout(sender, request, user, **kwargs):
+    if request is not None:
+        request._token_logout = True
+
+
+def forget_user(sender, instance, **kwargs):
+    """
+    Drop a saved or deleted user from this process' cache, the other processes
+    reload it within `USER_TTL` seconds
+    """
+    if _authority is not None:
+        _authority.users.discard(str(instance.pk))
+
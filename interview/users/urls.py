@@ -1,16 +1,33 @@
+from django.conf import settings
 from django.urls import path
 from django.views.generic import RedirectView
 
-from . import views
+from . import api, async_api, async_views, views
+
+# the same flow, served natively by whichever handler is running it
+flow = async_views if settings.USERS_ASYNC_VIEWS else views
+flow_api = async_api if settings.USERS_ASYNC_VIEWS else api
 
 app_name = "users"
 
-urlpatterns = [
-    path("", RedirectView.as_view(pattern_name="users:check")),
-    path("check/", views.check_phonenumber, name="check"),
-    path("login/", views.login_user, name="login_user"),
-    path("logout/", views.logout_user, name="logout_user"),
-    path("register/<str:phonenumber>/", views.register_otp, name="register"),
-    path("register_info/", views.register_info, name="register_info"),
-    path("register_password/", views.register_password, name="register_password"),
-]
+
+def flow_urlpatterns(flow, flow_api):
+    return [
+        path("", RedirectView.as_view(pattern_name="users:check")),
+        path("check/", flow.check_phonenumber, name="check"),
+        path("login/", flow.login_user, name="login_user"),
+        path("logout/", flow.logout_user, name="logout_user"),
+        path("register/<str:phonenumber>/", flow.register_otp, name="register"),
+        path("register_info/", flow.register_info, name="register_info"),
+        path("register_password/", flow.register_password, name="register_password"),
+        # json for the mobile apps, see `users.api`
+        path("api/start/", flow_api.start, name="api_start"),
+        path("api/verify/", flow_api.verify, name="api_verify"),
+        path("api/register/", flow_api.register, name="api_register"),
+        path("api/login/", flow_api.login_user, name="api_login"),
+        # reads files, the sync view under both handlers
+        path("metrics", views.metrics, name="metrics"),
+    ]
+
+
+urlpatterns = flow_urlpatterns(flow, flow_api)
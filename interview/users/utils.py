@@ -1,69 +1,234 @@
-from datetime import datetime
+from collections import Counter
+from math import ceil
 
-from django.core.cache import cache
+from .attempts import (BAN_PERIOD_MINUTE, MAX_ATTEMPS, AttemptState,
+                       get_attempt_counter)
+from .banindex import get_prefix_index
+from .metrics import BAN_CHECKS, BANS_ISSUED, count
+from .otp import OTP_SENDS_PER_IP, OTP_SENDS_PER_PHONENUMBER
 
-MAX_ATTEMPS = 3
-BAN_PERIOD_MINUTE = 60
-DEFAULT_USER_STAT = {"attempts": 0, "ban_start_time": None}
+
+def ban_paths(identifiers):
+    """
+    The path of every identifier that isn't None in the prefix index, itself
+    and the subnets or number ranges covering it, see `users.banindex`
+    """
+    index = get_prefix_index()
+    return [
+        index.path(identifier) for identifier in identifiers if identifier is not None
+    ]
 
 
-def get_ban_remaining_time(identifier):
+def path_limits(paths):
     """
-    Returns remaining ban time saved in cache based on identifier as cache key
-    if no cache value found, return a default
+    The limit of every key on the paths, each key once
     """
-    # if `identifier` is None (cache not set yet), don't even check
-    if identifier is None:
-        return 0
-    user_ban_start_time = cache.get(identifier, DEFAULT_USER_STAT).get("ban_start_time")
-    # calculate user's remaining ban
-    # if user_ban_start_time is None, then the user is not banned, so return 0
-    remaining_time_minutes = (
-        BAN_PERIOD_MINUTE - (datetime.now() - user_ban_start_time).seconds / 60
-        if user_ban_start_time
-        else 0
-    )
-    return remaining_time_minutes
+    return {key: limit for path in paths for key, limit in path}
+
+
+def remaining_per_identifier(identifiers, paths, remaining):
+    """
+    The longest ban along the path of each identifier, 0 for the None ones
+    """
+    banned = [max(remaining[key] for key, _ in path) for path in paths]
+    count_ban_checks(banned)
+    banned = iter(banned)
+    return [0 if identifier is None else next(banned) for identifier in identifiers]
+
+
+def states_per_identifier(paths, states):
+    """
+    The attempts of each identifier itself, and the longest ban along its path
+    """
+    return [
+        AttemptState(
+            states[path[0][0]].attempts,
+            max(states[key].ban_remaining for key, _ in path),
+        )
+        for path in paths
+    ]
+
+
+def count_ban_checks(remaining):
+    hits = sum(1 for seconds in remaining if seconds)
+    count(BAN_CHECKS, "hit", hits)
+    count(BAN_CHECKS, "miss", len(remaining) - hits)
+
+
+def count_bans_issued(paths, states):
+    """
+    Count the identifiers and the prefixes the failure just banned
+    """
+    issued = {}
+    for path in paths:
+        for depth, (key, limit) in enumerate(path):
+            state = states[key]
+            # a ban starts with the first failure over the limit
+            if state.ban_remaining and state.attempts == limit + 1:
+                issued[key] = "prefix" if depth else "identifier"
+    scopes = Counter(issued.values())
+    for scope in ("identifier", "prefix"):
+        count(BANS_ISSUED, scope, scopes[scope])
+
+
+def get_ban_remaining_times(*identifiers):
+    """
+    Returns remaining ban time in seconds for each identifier, checked in a single
+    cache round trip along with the subnets or number ranges covering it
+    `identifier` could be username or ip, if it is None (session not set yet)
+    don't even check and report 0 for it
+    """
+    paths = ban_paths(identifiers)
+    if not paths:
+        return [0] * len(identifiers)
+    keys = list(path_limits(paths))
+    remaining = dict(zip(keys, get_attempt_counter().remaining(keys)))
+    return remaining_per_identifier(identifiers, paths, remaining)
+
+
+def get_ban_remaining_seconds(*identifiers):
+    """
+    Returns the greatest remaining ban time in seconds among the identifiers
+    """
+    return max(get_ban_remaining_times(*identifiers), default=0)
+
+
+def get_ban_remaining_time(*identifiers):
+    """
+    Returns the greatest remaining ban time in minutes among the identifiers
+    if the user is not banned by any of them, return 0
+    """
+    return ceil(get_ban_remaining_seconds(*identifiers) / 60)
 
 
 def check_is_user_banned(identifier):
     """
     Returns True if user remaining ban time is other that 0, which
-    should mean than user is still banned
-    """
-    return bool(get_ban_remaining_time(identifier))
-
-
-def ban_user_if_necessary(identifier):
-    """
-    Check user attempts and ban it neccessory
-    check cache with `identifier` as key for testing user stats
-    `identifier` could be username or ip
-    set appropriate cache key, value and timeout
-    return `if user is banned`
-    """
-    user_current_stat = cache.get(identifier, DEFAULT_USER_STAT)
-    user_attemps = user_current_stat["attempts"]
-    user_ban_start_time = user_current_stat["ban_start_time"]
-    # the first time user is axceeding the limit, initiate a ban start time.
-    if user_attemps == MAX_ATTEMPS:
-        user_ban_start_time = datetime.now()
-    user_new_stat = {
-        "attempts": user_attemps + 1,
-        "ban_start_time": user_ban_start_time,
-    }
-    # calculate the remaining time, if user_ban_start_time is None, then remaining time is
-    # the full amount (BAN_PERIOD_MINUTE)
-    remaining_time_minutes = (
-        BAN_PERIOD_MINUTE - (datetime.now() - user_ban_start_time).seconds / 60
-        if user_ban_start_time
-        else 0
-    )
-    # set cache expiry to be BAN_PERIOD_MINUTE
-    cache.set(
-        identifier,
-        user_new_stat,
-        timeout=BAN_PERIOD_MINUTE * 60 - remaining_time_minutes,
-    )
-
-    return bool(remaining_time_minutes)
+    should mean than user is still banned, by itself or by its subnet
+    """
+    return bool(get_ban_remaining_seconds(identifier))
+
+
+def record_failed_attempt(*identifiers):
+    """
+    Record a failed attempt for every identifier and the prefixes covering it,
+    and ban the ones exceeding their limit for `BAN_PERIOD_MINUTE`
+    returns the `AttemptState` of every identifier that isn't None
+    """
+    paths = ban_paths(identifiers)
+    if not paths:
+        return []
+    limits = path_limits(paths)
+    states = get_attempt_counter().hit(list(limits), list(limits.values()))
+    states = dict(zip(limits, states))
+    count_bans_issued(paths, states)
+    return states_per_identifier(paths, states)
+
+
+def ban_user_if_necessary(*identifiers):
+    """
+    Record a failed attempt for every identifier and ban the ones exceeding
+    `MAX_ATTEMPS` for `BAN_PERIOD_MINUTE`
+    `identifier` could be username or ip, all of them are updated in one batch
+    return `if user is banned` by any of the identifiers
+    """
+    states = record_failed_attempt(*identifiers)
+    return any(state.ban_remaining for state in states)
+
+
+def reset_user_attempts(*identifiers):
+    """
+    Clear the failed attempts of the identifiers, e.g. after a successful login
+    the prefixes keep theirs, one good client doesn't clear its subnet
+    """
+    checked = [identifier for identifier in identifiers if identifier is not None]
+    if checked:
+        get_attempt_counter().reset(checked)
+
+
+def throttle(action, identifier, limit):
+    """
+    Count a use of a rate limited `action` by `identifier` (e.g. an ip), on
+    the attempt counter under its own key, returns the seconds it is banned
+    for once it was used more than `limit` times in the ban period
+    """
+    if identifier is None:
+        return 0
+    (state,) = get_attempt_counter().hit([f"{action}:{identifier}"], [limit])
+    return state.ban_remaining
+
+
+def otp_sends(phonenumber, ip_address):
+    """
+    The throttle key and limit of the otps texted to the phonenumber, and of
+    the ones asked for by the ip
+    """
+    sends = {f"sms:{phonenumber}": OTP_SENDS_PER_PHONENUMBER}
+    if ip_address is not None:
+        sends[f"sms:{ip_address}"] = OTP_SENDS_PER_IP
+    return sends
+
+
+def throttle_otp(phonenumber, ip_address):
+    """
+    Count an otp texted to `phonenumber` for `ip_address`, in a single cache
+    round trip, returns the seconds either is refused another one for
+    """
+    sends = otp_sends(phonenumber, ip_address)
+    states = get_attempt_counter().hit(list(sends), list(sends.values()))
+    return max(state.ban_remaining for state in states)
+
+
+# async counterparts, used by the async views and middleware
+
+
+async def aget_ban_remaining_times(*identifiers):
+    paths = ban_paths(identifiers)
+    if not paths:
+        return [0] * len(identifiers)
+    keys = list(path_limits(paths))
+    remaining = dict(zip(keys, await get_attempt_counter().aremaining(keys)))
+    return remaining_per_identifier(identifiers, paths, remaining)
+
+
+async def aget_ban_remaining_seconds(*identifiers):
+    return max(await aget_ban_remaining_times(*identifiers), default=0)
+
+
+async def aget_ban_remaining_time(*identifiers):
+    return ceil(await aget_ban_remaining_seconds(*identifiers) / 60)
+
+
+async def arecord_failed_attempt(*identifiers):
+    paths = ban_paths(identifiers)
+    if not paths:
+        return []
+    limits = path_limits(paths)
+    states = await get_attempt_counter().ahit(list(limits), list(limits.values()))
+    states = dict(zip(limits, states))
+    count_bans_issued(paths, states)
+    return states_per_identifier(paths, states)
+
+
+async def aban_user_if_necessary(*identifiers):
+    states = await arecord_failed_attempt(*identifiers)
+    return any(state.ban_remaining for state in states)
+
+
+async def areset_user_attempts(*identifiers):
+    checked = [identifier for identifier in identifiers if identifier is not None]
+    if checked:
+        await get_attempt_counter().areset(checked)
+
+
+async def athrottle(action, identifier, limit):
+    if identifier is None:
+        return 0
+    (state,) = await get_attempt_counter().ahit([f"{action}:{identifier}"], [limit])
+    return state.ban_remaining
+
+
+async def athrottle_otp(phonenumber, ip_address):
+    sends = otp_sends(phonenumber, ip_address)
+    states = await get_attempt_counter().ahit(list(sends), list(sends.values()))
+    return max(state.ban_remaining for state in states)
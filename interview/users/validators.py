@@ -1,8 +1,82 @@
-import phonenumbers
+"""
+Phonenumber validation and normalization
+
+every phonenumber is stored, looked up and banned by its canonical E.164 form
+(`+989121234567`), whichever way it was typed (`09121234567`, `+98 912 ...`).
+
+`normalize_phonenumber` only accepts numbers of the regions in
+`USERS_PHONENUMBER_REGIONS`, so phonenumbers only ever loads the metadata of
+those regions. input that can't be a phonenumber is turned down by a regex
+before parsing and the parsed results are kept in a bounded lru cache, so a
+flow that validates the same number on every step parses it once.
+
+phonenumbers itself is imported on the first normalization, not at url loading.
+"""
+
+import re
+from functools import lru_cache
+
+from django.conf import settings
 from django.core.exceptions import ValidationError
 
+PHONENUMBER_REGIONS = ("IR",)
+NORMALIZE_CACHE_SIZE = 4096
+# digits with the usual separators and an optional leading + or 00
+PHONENUMBER_RE = re.compile(r"\+?[0-9][0-9 ().-]{5,19}")
+SEPARATORS_RE = re.compile(r"[ ().-]")
+
+
+def get_phonenumber_regions():
+    return tuple(getattr(settings, "USERS_PHONENUMBER_REGIONS", PHONENUMBER_REGIONS))
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _normalize(raw, regions):
+    import phonenumbers
+
+    number = SEPARATORS_RE.sub("", raw)
+    if number.startswith("00"):
+        number = "+" + number[2:]
+    if number.startswith("+"):
+        # international numbers of other countries are rejected before parsing,
+        # parsing them would load their metadata
+        country_codes = {phonenumbers.country_code_for_region(r) for r in regions}
+        if not any(number[1:].startswith(str(code)) for code in country_codes):
+            return None
+    for region in regions:
+        try:
+            parsed = phonenumbers.parse(number, region)
+        except phonenumbers.NumberParseException:
+            continue
+        if phonenumbers.is_valid_number_for_region(parsed, region):
+            return phonenumbers.format_number(
+                parsed, phonenumbers.PhoneNumberFormat.E164
+            )
+    return None
+
+
+def normalize_phonenumber(raw):
+    """
+    The E.164 form of `raw`, None if it isn't a valid phonenumber of the
+    configured regions
+    """
+    if not isinstance(raw, str):
+        return None
+    raw = raw.strip()
+    # obviously invalid input never reaches the parser, nor the cache
+    if not PHONENUMBER_RE.fullmatch(raw):
+        return None
+    return _normalize(raw, get_phonenumber_regions())
+
+
+def canonical_phonenumber(raw):
+    """
+    The E.164 form of `raw` when it is valid, else `raw` itself, for keys that
+    must be stable for invalid input too, like ban keys
+    """
+    return normalize_phonenumber(raw) or raw
+
 
 def phonenumber_validator(pn):
-    phonenumber = phonenumbers.parse(pn, "IR")
-    if not phonenumbers.is_valid_number(phonenumber):
+    if normalize_phonenumber(pn) is None:
         raise ValidationError(f"{pn} is not a valid phonenumber", params={"value": pn})
@@ -1,23 +1,47 @@
-from secrets import token_urlsafe
+from django.contrib.auth import get_user_model, login, logout
+from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import reverse
 
-from django.contrib.auth import authenticate, login, logout
-from django.contrib.auth.forms import get_user_model
-from django.core.cache import cache
-from django.db.models import ObjectDoesNotExist
-from django.http import HttpResponseRedirect
-from django.shortcuts import render, reverse
-
-from .forms import (LoginForm, OTPForm, PhonenumberForm, RegisterForm,
-                    RegisterInfoForm, RegisterPasswordForm)
-from .otp import generate_random_otp
-from .utils import (ban_user_if_necessary, check_is_user_banned,
-                    get_ban_remaining_time)
+from .forms import (LoginForm, OTPForm, PhonenumberForm, RegisterInfoForm,
+                    RegisterPasswordForm)
+from .membership import username_exists
+from .metrics import get_metrics_store
+from .otp import (OTP_ERRORS, OTPResult, get_otp_store, otp_message,
+                  otp_throttled_error, send_sms)
+from .provisioning import UsernameTaken, provision_user
+from .rendering import render_page
+from .utils import (ban_user_if_necessary, get_ban_remaining_time,
+                    get_ban_remaining_times, reset_user_attempts, throttle_otp)
+from .validators import canonical_phonenumber, normalize_phonenumber
 
 # Create your views here.
 
 auth_user = get_user_model()
 
 
+def login_page(request, phonenumber):
+    """
+    The login form of a registered phonenumber, kept for the login step
+    """
+    request.wizard["username"] = phonenumber
+    return render_page(
+        request,
+        "users/login.html",
+        {"form": LoginForm(initial={"username": phonenumber})},
+    )
+
+
+def otp_throttled_page(request, remaining):
+    """
+    The phonenumber form, telling no more otps are texted for a while
+    """
+    return render_page(
+        request,
+        "users/phonenumber.html",
+        {"form": PhonenumberForm, "ban_error": [otp_throttled_error(remaining)]},
+    )
+
+
 def check_phonenumber(request):
     """
     Handle logging in with phonenumber
@@ -27,26 +51,17 @@ def check_phonenumber(request):
         form = PhonenumberForm(request.POST)
         if form.is_valid():
             phonenumber = form.cleaned_data.get("phonenumber")
-            # check if the user exists
-            try:
-                user = auth_user.objects.get(username=phonenumber)
-                # set username in session
-                request.session["username"] = phonenumber
+            # check if the user exists, new phonenumbers are told apart by the
+            # username index without a query
+            if username_exists(phonenumber):
                 # if exists, redirect a view that handles login
                 # get user's password
-                return render(
-                    request,
-                    "users/login.html",
-                    {"form": LoginForm(initial={"username": phonenumber})},
-                )
+                return login_page(request, phonenumber)
             # if user obj doesn't exist
-            except ObjectDoesNotExist:
-                # redirect to a register view with the phonenumber and the corresponding cache key
-                return HttpResponseRedirect(
-                    reverse("users:register", args=[phonenumber])
-                )
+            # redirect to a register view with the phonenumber
+            return HttpResponseRedirect(reverse("users:register", args=[phonenumber]))
         # if phonenumber is not valid
-        return render(
+        return render_page(
             request,
             "users/phonenumber.html",
             {"form": form},
@@ -54,11 +69,15 @@ def check_phonenumber(request):
     # first of all, show the phonenumber form to get the user's phonenumber
     # check if user is banned, and show user some feedback
     ctx = {"form": PhonenumberForm, "ban_error": []}
-    if check_is_user_banned(request.session.get("username")):
+    # both identifiers are checked in a single cache round trip
+    username_ban, ip_ban = get_ban_remaining_times(
+        request.wizard.get("username"), request.META.get("REMOTE_ADDR")
+    )
+    if username_ban:
         ctx["ban_error"].append("user (phonenumber) already banned")
-    if check_is_user_banned(request.META.get("REMOTE_ADDR")):
+    if ip_ban:
         ctx["ban_error"].append("ip already banned")
-    return render(request, "users/phonenumber.html", ctx)
+    return render_page(request, "users/phonenumber.html", ctx)
 
 
 def logout_user(request):
@@ -75,20 +94,19 @@ def login_user(request):
     """
     Handle login
     """
-    username = request.session.get("username")
+    username = request.wizard.get("username")
     user_ip_address = request.META["REMOTE_ADDR"]
     # set ban time remaining to be the greater of banned by ip or banned by username
     # this way, ban period is insured to be at least BAN_PERIOD_MINUTE
-    ban_remaining_time = max(
-        get_ban_remaining_time(username), get_ban_remaining_time(user_ip_address)
-    )
+    ban_remaining_time = get_ban_remaining_time(username, user_ip_address)
     is_user_banned = bool(ban_remaining_time)
     if request.method == "POST":
         # first check whether the user is banned or not
-        username = request.POST.get("username")
+        # the same ban key however the phonenumber was typed
+        username = canonical_phonenumber(request.POST.get("username"))
         if is_user_banned:
             # if user is already banned
-            return render(
+            return render_page(
                 request,
                 "users/login.html",
                 {
@@ -98,59 +116,40 @@ def login_user(request):
             )
         # user is posting to this view and not banned
         form = LoginForm(data=request.POST)
+        # validating the form authenticates the user, a single hash
         if form.is_valid():
-            # then authenticate the user
-            user = authenticate(
-                username=form.cleaned_data.get("username"),
-                password=form.cleaned_data.get("password"),
-            )
-            if user:
-                # if authenticated, login
-                login(request, form.get_user())
-                # clear the cache used in login attempts
-                cache.delete(username)
-                return render(request, "users/success.html")
-            else:
-                # user obj might be None due to user not registered
-                return render(
-                    request,
-                    "users/login.html",
-                    {
-                        "form": form,
-                        "user_error": "user not logged in and/or user doesn't exist",
-                    },
-                )
+            login(request, form.get_user())
+            # clear the cache used in login attempts
+            reset_user_attempts(username)
+            request.wizard.clear()
+            return render_page(request, "users/success.html")
         else:
             ctx = {"form": form}
-            # check conditions separately
-            is_user_banned_by_username = ban_user_if_necessary(username)
-            is_user_banned_by_ip = ban_user_if_necessary(user_ip_address)
-            is_user_banned = is_user_banned_by_username or is_user_banned_by_ip
-            ban_remaining_time = max(
-                get_ban_remaining_time(username),
-                get_ban_remaining_time(user_ip_address),
-            )
+            # record the failure for username and ip together
+            is_user_banned = ban_user_if_necessary(username, user_ip_address)
             if is_user_banned:
                 return HttpResponseRedirect(reverse("users:check"))
 
-            return render(request, "users/login.html", ctx)
+            return render_page(request, "users/login.html", ctx)
     # if user redirected to this view from another view since the user exists
     # check whether the user is banned or not
     if is_user_banned:
         return HttpResponseRedirect(reverse("users:check"))
 
     # on a get request, just render the form
-    return render(request, "users/login.html", {"form": LoginForm})
+    return render_page(request, "users/login.html", {"form": LoginForm})
 
 
 def register_otp(request, phonenumber):
     """
     Handle registration
     """
+    # the url may carry any form of the phonenumber, only the canonical one is used
+    phonenumber = normalize_phonenumber(phonenumber)
+    if phonenumber is None:
+        return HttpResponseRedirect(reverse("users:check"))
     user_ip_address = request.META["REMOTE_ADDR"]
-    ban_remaining_time = max(
-        get_ban_remaining_time(phonenumber), get_ban_remaining_time(user_ip_address)
-    )
+    ban_remaining_time = get_ban_remaining_time(phonenumber, user_ip_address)
     is_user_banned = bool(ban_remaining_time)
     # user has been redirected to get registered
     if request.method == "GET":
@@ -159,16 +158,26 @@ def register_otp(request, phonenumber):
         if is_user_banned:
             # redirect to the check_user_phonenumber view
             return HttpResponseRedirect(reverse("users:check"))
-        # initiate an otp process
-        # create a random 6 digit string
-        random_otp = generate_random_otp()
-        print(f"🔴🟢   {random_otp = }")
-        # store the otp in cache
-        # generate a url_safe token as cache key, reason being it can be sent back as post and cannot be guessed
-        otp_cache_key = token_urlsafe(20)[:20]
-        # save it in cache
-        cache.set(otp_cache_key, random_otp)
-        return render(
+        # the username index may miss a user written without its signal, no
+        # otp for a registered phonenumber
+        if username_exists(phonenumber, confirm_miss=True):
+            return login_page(request, phonenumber)
+        store = get_otp_store()
+        # a reload shows the otp already texted, while it can still be typed in
+        otp_cache_key = request.wizard.get("otp_token")
+        if not store.pending(otp_cache_key, phonenumber):
+            # a text costs, at most a few per phonenumber and per ip
+            throttled = throttle_otp(phonenumber, user_ip_address)
+            if throttled:
+                return otp_throttled_page(request, throttled)
+            # initiate an otp process
+            # the otp is stored bound to the phonenumber, under a token that cannot
+            # be guessed and is sent back with the post
+            otp_cache_key, random_otp = store.issue(phonenumber)
+            # queued for the sms workers, the request doesn't wait for the gateway
+            send_sms(phonenumber, otp_message(random_otp))
+            request.wizard["otp_token"] = otp_cache_key
+        return render_page(
             request,
             "users/register.html",
             {"form": OTPForm(initial={"otp_cache_key": otp_cache_key})},
@@ -183,43 +192,36 @@ def register_otp(request, phonenumber):
         form = OTPForm(request.POST)
         if form.is_valid():
             # if otp and cache_key validations pass
-            # check whether otp value is correct
-            # get user's otp value
-            user_otp_value = form.cleaned_data.get("otp")
-            # retrieve otp value from cache
-            otp_cache_key = form.cleaned_data.get("otp_cache_key")
-            server_otp_value = cache.get(otp_cache_key)
-            if user_otp_value == server_otp_value:
+            # check whether otp value is correct, this consumes a guess of the token
+            otp_result = get_otp_store().verify(
+                form.cleaned_data.get("otp_cache_key"),
+                phonenumber,
+                form.cleaned_data.get("otp"),
+            )
+            if otp_result is OTPResult.VERIFIED:
                 # proceed with registration process
                 # clear the cache used in otp attempts
-                cache.delete(phonenumber)
-                # pass phonenumber as session, so that the user can be created with all
-                # the gathered info in subsequent views at the last step
-                request.session["username"] = phonenumber
+                reset_user_attempts(phonenumber)
+                # pass phonenumber in the wizard state, so that the user can be created
+                # with all the gathered info in subsequent views at the last step
+                request.wizard["username"] = phonenumber
                 return HttpResponseRedirect(reverse("users:register_info"))
             else:
                 # the same as login, but already use url arg (phonenumber) as identifier instead
-                # getting value off of session
-                ctx = {"form": form}
+                # getting value off of the wizard state
                 ctx = {
                     "form": form,
-                    "otp_error": "otp doesn't match",
+                    "otp_error": OTP_ERRORS[otp_result],
                 }
-                # check ban conditions (separably)
-                is_user_banned_by_username = ban_user_if_necessary(phonenumber)
-                is_user_banned_by_ip = ban_user_if_necessary(user_ip_address)
-                is_user_banned = is_user_banned_by_username or is_user_banned_by_ip
-                ban_remaining_time = max(
-                    get_ban_remaining_time(phonenumber),
-                    get_ban_remaining_time(user_ip_address),
-                )
+                # record the failure for phonenumber and ip together
+                is_user_banned = ban_user_if_necessary(phonenumber, user_ip_address)
                 if is_user_banned:
                     return HttpResponseRedirect(reverse("users:check"))
 
-                return render(request, "users/register.html", ctx)
+                return render_page(request, "users/register.html", ctx)
 
         # if otp form validation doesn't pass
-        return render(
+        return render_page(
             request,
             "users/register.html",
             {"form": form},
@@ -234,60 +236,80 @@ def register_info(request):
         form = RegisterInfoForm(request.POST)
         if form.is_valid():
             # if user entered correct format of the data, proceed to password form
-            # update session first
-            request.session["first_name"] = form.cleaned_data.get("first_name")
-            request.session["last_name"] = form.cleaned_data.get("last_name")
-            request.session["email"] = form.cleaned_data.get("email")
+            # update the wizard state first, the session isn't written until login
+            request.wizard.update(
+                {
+                    "first_name": form.cleaned_data.get("first_name"),
+                    "last_name": form.cleaned_data.get("last_name"),
+                    "email": form.cleaned_data.get("email"),
+                }
+            )
             return HttpResponseRedirect(reverse("users:register_password"))
 
     # if user is redirected here
     # check whether user is redirected with a phonenumber
-    if request.session.get("username"):
+    if request.wizard.get("username"):
         # render info entry form
-        return render(request, "users/register_info.html", {"form": RegisterInfoForm})
+        return render_page(
+            request, "users/register_info.html", {"form": RegisterInfoForm}
+        )
     # if not redirected with a phonenumber
     else:
         # return to home
-        return HttpResponseRedirect(reverse("users:check_user_phonenumber"))
+        return HttpResponseRedirect(reverse("users:check"))
 
 
 def register_password(request):
     """
     Register user password and finally create a user object
     """
-    # get all the user data from cache
+    # get all the user data from the wizard state
     user_data = {
-        "first_name": request.session.get("first_name"),
-        "last_name": request.session.get("last_name"),
-        "email": request.session.get("email"),
-        "username": request.session.get("username"),
+        "first_name": request.wizard.get("first_name"),
+        "last_name": request.wizard.get("last_name"),
+        "email": request.wizard.get("email"),
+        "username": request.wizard.get("username"),
     }
     # if user is redirected here
     if request.method == "GET":
         # if user have completed previous steps (user data exists)
         if all(user_data.values()):
             # get user's password
-            return render(
+            return render_page(
                 request, "users/register_password.html", {"form": RegisterPasswordForm}
             )
         # if user data is not complete
         return HttpResponseRedirect(reverse("users:check"))
     if request.method == "POST":
-        # update user_data dictionary with password from form
-        user_data["password1"] = request.POST.get("password1")
-        user_data["password2"] = user_data["password1"]
-        # populate `registration form` with all the user data
-        # using RegisterForm since all the data is gathered now
-        form = RegisterForm(user_data)
+        if not all(user_data.values()):
+            return HttpResponseRedirect(reverse("users:check"))
+        # validate the password against the user's attributes, on an unsaved user
+        # the username was verified by the otp and the rest by RegisterInfoForm,
+        # so nothing is queried before the insert
+        form = RegisterPasswordForm(request.POST, instance=auth_user(**user_data))
         if form.is_valid():
-            # if data is valid, create a user object
-            user = form.save()
+            try:
+                # a single insert, duplicates are caught by the unique constraint
+                user = provision_user(form.instance, form.cleaned_data["password1"])
+            except UsernameTaken:
+                # registered in the meantime, e.g. a double submit, go log in
+                request.wizard.clear()
+                return login_page(request, user_data["username"])
             login(request, user)
-            return render(request, "users/success.html")
-        # if data were not valid (since we are instantiating RegisterForm with all the user data
-        # redirect to register_info)
-        return render(
-            request,
-            "users/register_info.html",
-            {"form": RegisterInfoForm},
-        )
+            # the flow is over, drop its state
+            request.wizard.clear()
+            return render_page(request, "users/success.html")
+        # if the password was rejected by the validators
+        return render_page(request, "users/register_password.html", {"form": form})
+
+
+def metrics(request):
+    """
+    Metrics of every worker process in the prometheus text format
+    """
+    store = get_metrics_store()
+    if store is None:
+        return HttpResponse(status=404)
+    return HttpResponse(
+        store.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
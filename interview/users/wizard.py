@@ -0,0 +1,241 @@
+"""
+Registration wizard state
+
+the login and sign up flow carries the phonenumber and the user info across
+its steps. keeping them in the database backed session cost a session row
+write per step, all of them queued on sqlite's single writer. `request.wizard`
+holds them instead, in a short lived store chosen by `USERS_WIZARD["BACKEND"]`:
+
+    `SignedCookieWizardStore`, the state itself in a signed, timestamped cookie,
+    no server side writes at all
+    `CacheWizardStore`, the state in a cache alias under a random id kept in
+    the cookie, for state that shouldn't travel to the client
+
+both expire `TTL` seconds after the last change, and the session is only
+written once, by `login()` at the end of the flow.
+
+`request.wizard` is set by `users.middleware.WizardMiddleware` and reads like
+the session: `get`, `[]`, `update`, `clear` and their async versions `aget`,
+`aset`, `aupdate`, `aclear`. changes are stored when the response goes out.
+"""
+
+from secrets import token_urlsafe
+
+from django.conf import settings
+from django.core import signing
+from django.utils.module_loading import import_string
+
+from .metrics import metered_cache
+
+DEFAULTS = {
+    "BACKEND": "users.wizard.SignedCookieWizardStore",
+    # seconds the state is kept after its last change
+    "TTL": 900,
+    "COOKIE_NAME": "users_wizard",
+    # for CacheWizardStore
+    "CACHE": "default",
+}
+SIGNING_SALT = "users.wizard"
+
+
+def get_wizard_settings():
+    return {**DEFAULTS, **getattr(settings, "USERS_WIZARD", {})}
+
+
+class BaseWizardStore:
+    """
+    Loads and stores the wizard state of a request, a dict
+    """
+
+    def __init__(self, ttl=DEFAULTS["TTL"], cookie_name=DEFAULTS["COOKIE_NAME"]):
+        self.ttl = ttl
+        self.cookie_name = cookie_name
+
+    def load(self, request):
+        raise NotImplementedError
+
+    def save(self, request, response, data):
+        raise NotImplementedError
+
+    async def aload(self, request):
+        return self.load(request)
+
+    async def asave(self, request, response, data):
+        self.save(request, response, data)
+
+    def set_cookie(self, response, value):
+        response.set_cookie(
+            self.cookie_name,
+            value,
+            max_age=self.ttl,
+            secure=settings.SESSION_COOKIE_SECURE,
+            httponly=True,
+            samesite=settings.SESSION_COOKIE_SAMESITE,
+        )
+
+    def delete_cookie(self, response):
+        response.delete_cookie(
+            self.cookie_name, samesite=settings.SESSION_COOKIE_SAMESITE
+        )
+
+
+class SignedCookieWizardStore(BaseWizardStore):
+    """
+    The state in a signed cookie, nothing stored server side
+    """
+
+    def load(self, request):
+        value = request.COOKIES.get(self.cookie_name)
+        if not value:
+            return {}
+        try:
+            return signing.loads(value, salt=SIGNING_SALT, max_age=self.ttl)
+        except signing.BadSignature:
+            # tampered with or expired
+            return {}
+
+    def save(self, request, response, data):
+        if not data:
+            if self.cookie_name in request.COOKIES:
+                self.delete_cookie(response)
+            return
+        self.set_cookie(
+            response, signing.dumps(data, salt=SIGNING_SALT, compress=True)
+        )
+
+
+class CacheWizardStore(BaseWizardStore):
+    """
+    The state in a cache alias, under a random id kept in the cookie
+    """
+
+    def __init__(self, alias=DEFAULTS["CACHE"], **kwargs):
+        super().__init__(**kwargs)
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return metered_cache(self.alias)
+
+    @staticmethod
+    def key(wizard_id):
+        return f"wizard:{wizard_id}"
+
+    def _wizard_id(self, request):
+        return request.COOKIES.get(self.cookie_name)
+
+    def load(self, request):
+        wizard_id = self._wizard_id(request)
+        if not wizard_id:
+            return {}
+        return self.cache.get(self.key(wizard_id)) or {}
+
+    async def aload(self, request):
+        wizard_id = self._wizard_id(request)
+        if not wizard_id:
+            return {}
+        return await self.cache.aget(self.key(wizard_id)) or {}
+
+    def save(self, request, response, data):
+        wizard_id = self._wizard_id(request)
+        if not data:
+            if wizard_id:
+                self.cache.delete(self.key(wizard_id))
+                self.delete_cookie(response)
+            return
+        wizard_id = wizard_id or token_urlsafe(24)
+        self.cache.set(self.key(wizard_id), data, timeout=self.ttl)
+        self.set_cookie(response, wizard_id)
+
+    async def asave(self, request, response, data):
+        wizard_id = self._wizard_id(request)
+        if not data:
+            if wizard_id:
+                await self.cache.adelete(self.key(wizard_id))
+                self.delete_cookie(response)
+            return
+        wizard_id = wizard_id or token_urlsafe(24)
+        await self.cache.aset(self.key(wizard_id), data, timeout=self.ttl)
+        self.set_cookie(response, wizard_id)
+
+
+class WizardState:
+    """
+    The wizard state of one request, loaded on first use
+    """
+
+    def __init__(self, store, request):
+        self.store = store
+        self.request = request
+        self.modified = False
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            self._data = self.store.load(self.request)
+        return self._data
+
+    async def _aload(self):
+        if self._data is None:
+            self._data = await self.store.aload(self.request)
+        return self._data
+
+    def get(self, key, default=None):
+        return self._load().get(key, default)
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def update(self, values):
+        self._load().update(values)
+        self.modified = True
+
+    def clear(self):
+        self._data = {}
+        self.modified = True
+
+    async def aget(self, key, default=None):
+        return (await self._aload()).get(key, default)
+
+    async def aset(self, key, value):
+        (await self._aload())[key] = value
+        self.modified = True
+
+    async def aupdate(self, values):
+        (await self._aload()).update(values)
+        self.modified = True
+
+    async def aclear(self):
+        self.clear()
+
+    def save(self, response):
+        if self.modified:
+            self.store.save(self.request, response, self._data)
+
+    async def asave(self, response):
+        if self.modified:
+            await self.store.asave(self.request, response, self._data)
+
+
+_store = None
+
+
+def get_wizard_store():
+    global _store
+    if _store is None:
+        options = get_wizard_settings()
+        kwargs = {"ttl": options["TTL"], "cookie_name": options["COOKIE_NAME"]}
+        store_class = import_string(options["BACKEND"])
+        if issubclass(store_class, CacheWizardStore):
+            kwargs["alias"] = options["CACHE"]
+        _store = store_class(**kwargs)
+    return _store
+
+
+def reset_wizard_store(**kwargs):
+    global _store
+    _store = None